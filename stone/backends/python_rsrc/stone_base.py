@@ -19,29 +19,103 @@ _MYPY = False
 if _MYPY:
     import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
 
+# Kinds of tags in a union's _tag_table, which determine how the value of a tag
+# is validated when constructing an instance.
+_TAG_VOID = 0
+_TAG_COMPOSITE = 1  # Only the type of struct and union values is checked.
+_TAG_VALUE = 2
+
+
+def _values_equal(a, b):
+    """
+    Compares two field or tag values, either of which may be a NumPy array
+    accepted by a list validator. Arrays compare element-wise with ==, so
+    they're compared with numpy.array_equal() instead.
+    """
+    if isinstance(a, bv._array_types) or isinstance(b, bv._array_types):
+        return (a is not None and b is not None and len(a) == len(b) and
+                bool(bv.np.array_equal(a, b)))
+    return a == b
+
 
 class Union(object):
-    # TODO(kelkabany): Possible optimization is to remove _value if a
-    # union is composed of only symbols.
-    __slots__ = ['_tag', '_value']
+    __slots__ = ['_tag']
     _tagmap = {}  # type: typing.Dict[typing.Text, bv.Validator]
     _permissioned_tagmaps = set()  # type: typing.Set[typing.Text]
+    # Maps each tag to (validator, kind, permission), where permission is the
+    # name of the permission required to see the tag, or None if it's public.
+    # Generated classes build it with _build_tag_table() once all their
+    # tagmaps are set. Read it with _get_tag_table(), which builds it for
+    # other classes.
+    _tag_table = {}  # type: typing.Dict[typing.Text, typing.Tuple[bv.Validator, int, typing.Optional[typing.Text]]] # noqa: E501
+
+    # Set by classes generated with --frozen-types, whose list and map values
+    # are stored read-only. See bv.freeze().
+    _is_frozen = False
+
+    # Unions composed of only symbols don't have a _value slot and fall back
+    # to this. Generated classes declare the slot themselves if they or one of
+    # their parents have a tag with a value.
+    _value = None
 
     def __init__(self, tag, value=None):
-        validator = None
-        tagmap_names = ['_{}_tagmap'.format(map_name) for map_name in self._permissioned_tagmaps]
-        for tagmap_name in ['_tagmap'] + tagmap_names:
-            if tag in getattr(self, tagmap_name):
-                validator = getattr(self, tagmap_name)[tag]
-        assert validator is not None, 'Invalid tag %r.' % tag
-        if isinstance(validator, bv.Void):
+        entry = self._get_tag_table().get(tag)
+        assert entry is not None, 'Invalid tag %r.' % tag
+        validator, kind, _ = entry
+        if kind == _TAG_VOID:
             assert value is None, 'Void type union member must have None value.'
-        elif isinstance(validator, (bv.Struct, bv.Union)):
+        elif kind == _TAG_COMPOSITE:
             validator.validate_type_only(value)
+        elif self._is_frozen:
+            value = bv.freeze(validator, validator.validate(value))
         else:
             validator.validate(value)
         self._tag = tag
-        self._value = value
+        if value is not None or type(self)._value is not None:
+            # The class has a _value slot.
+            self._value = value
+
+    @classmethod
+    def _new_validated(cls, tag, value=None):
+        """
+        Creates an instance without the checks done by __init__. Only use this
+        when ``tag`` is known to be valid for the class and ``value`` has
+        already been validated against it.
+        """
+        ins = cls.__new__(cls)
+        ins._tag = tag
+        if cls._is_frozen and value is not None:
+            value = bv.freeze(cls._get_tag_table()[tag][0], value)
+        if value is not None or cls._value is not None:
+            ins._value = value
+        return ins
+
+    @classmethod
+    def _get_symbol(cls, tag):
+        """
+        Returns the instance of this class shared by all values set to ``tag``
+        if it's a tag with no value, such as the ``Cls.other`` class attribute,
+        and None otherwise. Unions have no setters, so decoders can return the
+        same instance every time instead of creating a new one.
+        """
+        symbols = cls.__dict__.get('_symbols')
+        if symbols is None:
+            symbols = {}
+            cls._symbols = symbols
+        try:
+            return symbols[tag]
+        except KeyError:
+            pass
+        symbol = None
+        entry = cls._get_tag_table().get(tag)
+        if entry is not None and entry[1] == _TAG_VOID:
+            # Symbol creators only exist for a union's own tags, so this is an
+            # instance of a parent for inherited ones.
+            symbol = cls.__dict__.get(tag)
+            if type(symbol) is not cls or symbol._tag != tag:
+                symbol = cls._new_validated(tag)
+        symbols[tag] = symbol
+        return symbol
 
     def __eq__(self, other):
         # Also need to check if one class is a subclass of another. If one union extends another,
@@ -49,7 +123,7 @@ class Union(object):
         return (
             isinstance(other, Union) and
             (isinstance(self, other.__class__) or isinstance(other, self.__class__)) and
-            self._tag == other._tag and self._value == other._value
+            self._tag == other._tag and _values_equal(self._value, other._value)
         )
 
     def __ne__(self, other):
@@ -59,29 +133,58 @@ class Union(object):
         return hash((self._tag, self._value))
 
     @classmethod
-    def _is_tag_present(cls, tag, caller_permissions):
-        assert tag, 'tag value should not be None'
+    def _get_tag_table(cls):
+        """
+        Returns _tag_table. Classes that set their tagmaps without building
+        it, like hand-written ones, have it built on first use. A table
+        inherited from a parent isn't used, since it lacks the tags of the
+        class.
+        """
+        table = cls.__dict__.get('_tag_table')
+        if table is None:
+            table = cls._build_tag_table()
+            cls._tag_table = table
+        return table
 
-        if tag in cls._tagmap:
-            return True
+    @classmethod
+    def _build_tag_table(cls):
+        """
+        Merges _tagmap and each _<permission>_tagmap of the class into the
+        table stored as _tag_table.
+        """
+        table = {}
+        for permission in [None] + sorted(cls._permissioned_tagmaps):
+            if permission is None:
+                tagmap = cls._tagmap
+            else:
+                tagmap = getattr(cls, '_{}_tagmap'.format(permission))
+            for tag, validator in tagmap.items():
+                if isinstance(validator, bv.Void):
+                    kind = _TAG_VOID
+                elif isinstance(validator, (bv.Struct, bv.Union)):
+                    kind = _TAG_COMPOSITE
+                else:
+                    kind = _TAG_VALUE
+                table[tag] = (validator, kind, permission)
+        return table
 
-        for extra_permission in caller_permissions.permissions:
-            tagmap_name = '_{}_tagmap'.format(extra_permission)
-            if hasattr(cls, tagmap_name) and tag in getattr(cls, tagmap_name):
-                return True
+    @classmethod
+    def _is_tag_present(cls, tag, caller_permissions):
+        assert tag, 'tag value should not be None'
 
-        return False
+        entry = cls._get_tag_table().get(tag)
+        if entry is None:
+            return False
+        return entry[2] is None or entry[2] in caller_permissions.permissions
 
     @classmethod
     def _get_val_data_type(cls, tag, caller_permissions):
         assert tag, 'tag value should not be None'
 
-        for extra_permission in caller_permissions.permissions:
-            tagmap_name = '_{}_tagmap'.format(extra_permission)
-            if hasattr(cls, tagmap_name) and tag in getattr(cls, tagmap_name):
-                return getattr(cls, tagmap_name)[tag]
-
-        return cls._tagmap[tag]
+        validator, _, permission = cls._get_tag_table()[tag]
+        if permission is not None and permission not in caller_permissions.permissions:
+            raise KeyError(tag)
+        return validator
 
 class Route(object):
 
@@ -1,9 +1,9 @@
 """
 Serializers for Stone data types.
 
-Currently, only JSON is officially supported, but there's an experimental
-msgpack integration. If possible, serializers should be kept separate from the
-RPC format.
+JSON and a compact binary format are always supported, and msgpack is when
+the msgpack package is installed. If possible, serializers should be kept
+separate from the RPC format.
 
 This module should be dropped into a project that requires the use of Stone. In
 the future, this could be imported from a pre-installed Python package, rather
@@ -13,23 +13,33 @@ than being added to a project.
 from __future__ import absolute_import, unicode_literals
 
 import base64
+import codecs
 import collections
+import copy
 import datetime
 import functools
+import io
 import json
 import re
 import six
+import struct
+import threading
 import time
 
 try:
-    from . import stone_base as bb  # noqa: F401 # pylint: disable=unused-import
+    from . import stone_base as bb
     from . import stone_validators as bv
 except (ImportError, SystemError, ValueError):
     # Catch errors raised when importing a relative module when not in a package.
     # This makes testing this file directly (outside of a package) easier.
-    import stone_validators as bb  # type: ignore # noqa: F401 # pylint: disable=unused-import
+    import stone_base as bb  # type: ignore
     import stone_validators as bv  # type: ignore
 
+try:
+    import orjson  # type: ignore
+except ImportError:
+    orjson = None
+
 _MYPY = False
 if _MYPY:
     import typing  # noqa: F401 # pylint: disable=import-error,unused-import,useless-suppression
@@ -52,6 +62,135 @@ class CallerPermissionsDefault(CallerPermissionsInterface):
     def permissions(self):
         return []
 
+# ------------------------------------------------------------------------
+class JsonCodec(object):
+    """
+    A JSON library that json_encode() and json_decode() can use. Codecs are
+    made available by name with register_json_codec().
+    """
+
+    name = None  # type: typing.Optional[str]
+
+    def dumps(self, obj):
+        # type: (typing.Any) -> typing.Text
+        """
+        Returns the JSON text for ``obj``, which consists of Python primitives
+        as produced by ``StoneToPythonPrimitiveSerializer``.
+        """
+        raise NotImplementedError
+
+    def dumps_bytes(self, obj):
+        # type: (typing.Any) -> bytes
+        """
+        Like ``dumps``, but returns the JSON text encoded as UTF-8.
+        """
+        raise NotImplementedError
+
+    def loads(self, data):
+        # type: (typing.Union[typing.Text, bytes, bytearray, memoryview]) -> typing.Any
+        """
+        Parses JSON text given as a string or as UTF-8 encoded bytes. Raises
+        ``ValueError`` if ``data`` isn't valid JSON.
+        """
+        raise NotImplementedError
+
+
+class StdlibJsonCodec(JsonCodec):
+    """
+    Uses the standard library's ``json`` module. This is the default codec.
+    """
+
+    name = 'json'
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def dumps_bytes(self, obj):
+        # The output is ASCII since ensure_ascii is on.
+        return json.dumps(obj).encode('ascii')
+
+    def loads(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        if isinstance(data, (bytes, bytearray)):
+            data = data.decode('utf-8')
+        return json.loads(data)
+
+
+class OrjsonCodec(JsonCodec):
+    """
+    Uses the optional ``orjson`` library, which works on bytes natively.
+    Unlike ``json.dumps``, it produces compact output and doesn't escape
+    non-ASCII characters.
+    """
+
+    name = 'orjson'
+
+    def dumps(self, obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+_json_codecs = {}  # type: typing.Dict[str, JsonCodec]
+_default_json_codec = None  # type: typing.Optional[JsonCodec]
+
+
+def register_json_codec(codec):
+    # type: (JsonCodec) -> None
+    """
+    Makes ``codec`` available under ``codec.name``, replacing any codec that
+    was registered under the same name.
+    """
+    _json_codecs[codec.name] = codec
+
+
+def get_json_codec(codec=None):
+    # type: (typing.Union[None, str, JsonCodec]) -> JsonCodec
+    """
+    Returns the codec registered under the name ``codec``, or the default
+    codec if ``codec`` is None. JsonCodec instances are returned as is.
+
+    The names of the built-in codecs are always accepted. If the library a
+    built-in codec needs isn't installed, the stdlib codec is returned in its
+    place.
+    """
+    if codec is None:
+        return _default_json_codec
+    elif isinstance(codec, JsonCodec):
+        return codec
+    try:
+        return _json_codecs[codec]
+    except KeyError:
+        if codec == OrjsonCodec.name:
+            return _json_codecs[StdlibJsonCodec.name]
+        raise ValueError('No JSON codec named %r.' % codec)
+
+
+def set_default_json_codec(codec):
+    # type: (typing.Union[str, JsonCodec]) -> None
+    """
+    Sets the codec used by json_encode() and json_decode() when they aren't
+    passed one. See get_json_codec() for the accepted values.
+    """
+    global _default_json_codec  # pylint: disable=global-statement
+    _default_json_codec = get_json_codec(codec)
+
+
+register_json_codec(StdlibJsonCodec())
+if orjson is not None:
+    register_json_codec(OrjsonCodec())
+set_default_json_codec(StdlibJsonCodec.name)
+
+# Serializes the compilation of encode and decode plans. Compiling a struct
+# plan registers it before its fields are compiled, to allow for recursive
+# types, so other threads must not see the cache until it's done.
+_plan_lock = threading.RLock()
+
 # ------------------------------------------------------------------------
 class StoneEncoderInterface(object):
     """
@@ -98,6 +237,7 @@ class StoneSerializerBase(StoneEncoderInterface):
         """
         self.caller_permissions = (caller_permissions if
             caller_permissions else CallerPermissionsDefault())
+        self._permissions = tuple(self.caller_permissions.permissions)
         self._alias_validators = {}  # type: typing.Dict[bv.Validator, typing.Callable[[typing.Any], None]] # noqa: E501
 
         if alias_validators is not None:
@@ -115,6 +255,15 @@ class StoneSerializerBase(StoneEncoderInterface):
     def encode(self, validator, value):
         return self.encode_sub(validator, value)
 
+    def _get_all_fields(self, definition):
+        """
+        Returns the fields of the struct class ``definition`` that are
+        visible with the caller permissions.
+        """
+        if self._permissions:
+            return bv.get_permissions_view(definition, self._permissions).all_fields
+        return definition._all_fields_
+
     def encode_sub(self, validator, value):
         # type: (bv.Validator, typing.Any) -> typing.Any
         """
@@ -123,13 +272,14 @@ class StoneSerializerBase(StoneEncoderInterface):
         as with the ``encode`` method.
         """
         if isinstance(validator, bv.List):
-            # Because Lists are mutable, we always validate them during
-            # serialization
-            validate_f = validator.validate
+            # Because Lists are mutable, encode_list() validates them during
+            # serialization, unless they haven't been modified since they
+            # were last validated.
+            validate_f = None
             encode_f = self.encode_list
         elif isinstance(validator, bv.Map):
-            # Also validate maps during serialization because they are also mutable
-            validate_f = validator.validate
+            # Likewise for maps, which encode_map() validates.
+            validate_f = None
             encode_f = self.encode_map
         elif isinstance(validator, bv.Nullable):
             validate_f = validator.validate
@@ -139,7 +289,7 @@ class StoneSerializerBase(StoneEncoderInterface):
             encode_f = self.encode_primitive
         elif isinstance(validator, bv.Struct):
             if isinstance(validator, bv.StructTree):
-                if self.caller_permissions.permissions:
+                if self._permissions:
                     def validate_with_permissions(val):
                         validator.validate_with_permissions(val, self.caller_permissions)
 
@@ -149,7 +299,7 @@ class StoneSerializerBase(StoneEncoderInterface):
                 encode_f = self.encode_struct_tree
             else:
                 # Fields are already validated on assignment
-                if self.caller_permissions.permissions:
+                if self._permissions:
                     def validate_with_permissions(val):
                         validator.validate_with_permissions(val, self.caller_permissions)
 
@@ -164,7 +314,8 @@ class StoneSerializerBase(StoneEncoderInterface):
         else:
             raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
 
-        validate_f(value)
+        if validate_f is not None:
+            validate_f(value)
 
         return encode_f(validator, value)
 
@@ -172,7 +323,8 @@ class StoneSerializerBase(StoneEncoderInterface):
         # type: (bv.List, typing.Any) -> typing.Any
         """
         Callback for serializing a ``stone_validators.List``. Arguments
-        have the same semantics as with the ``encode`` method.
+        have the same semantics as with the ``encode`` method. Unlike most
+        values, ``value`` hasn't been validated by ``encode_sub``.
         """
         raise NotImplementedError
 
@@ -180,7 +332,8 @@ class StoneSerializerBase(StoneEncoderInterface):
         # type: (bv.Map, typing.Any) -> typing.Any
         """
         Callback for serializing a ``stone_validators.Map``. Arguments
-        have the same semantics as with the ``encode`` method.
+        have the same semantics as with the ``encode`` method. Unlike most
+        values, ``value`` hasn't been validated by ``encode_sub``.
         """
         raise NotImplementedError
 
@@ -225,10 +378,42 @@ class StoneSerializerBase(StoneEncoderInterface):
         raise NotImplementedError
 
 # ------------------------------------------------------------------------
+def _is_struct_list(validator):
+    """
+    Whether ``validator`` is a list of structs without enumerated subtypes,
+    which are encoded by column when the ``columnar`` option is set.
+    """
+    item_validator = validator.item_validator
+    return isinstance(item_validator, bv.Struct) and not isinstance(item_validator, bv.StructTree)
+
+
+def _make_fields_encoder(fields):
+    """
+    Returns a callable that encodes the fields of a struct that are set,
+    given ``(name, presence_key, plan)`` for each field to consider.
+    """
+    def encode_fields(value):
+        d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+        for field_name, presence_key, field_plan in fields:
+            try:
+                field_value = getattr(value, field_name)
+            except AttributeError as exc:
+                raise bv.ValidationError(exc.args[0])
+            if field_value is not None and getattr(value, presence_key):
+                try:
+                    d[field_name] = field_plan(field_value)
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+                    raise
+        return d
+    return encode_fields
+
+
 class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
 
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact):
-        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool) -> None # noqa: E501
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 use_plans=False, columnar=False):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, bool, bool) -> None # noqa: E501
         """
         Args:
             alias_validators (``typing.Mapping``, optional): Passed
@@ -239,12 +424,28 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                 Defaults to ``False``.
             should_redact (bool, optional): Whether to perform redaction on
                 marked fields. Defaults to ``False``.
+            use_plans (bool, optional): Whether ``encode`` should go through
+                compiled encode plans. See :meth:`get_encode_plan`. Defaults
+                to ``False``.
+            columnar (bool, optional): Whether lists of structs are encoded
+                by column. See json_encode(). Defaults to ``False``.
         """
         super(StoneToPythonPrimitiveSerializer, self).__init__(
             caller_permissions, alias_validators=alias_validators)
         self._for_msgpack = for_msgpack
         self._old_style = old_style
         self.should_redact = should_redact
+        self.use_plans = use_plans
+        self.columnar = columnar
+        self._plan_key = (for_msgpack, old_style, should_redact, self._permissions, columnar)
+        self._local_encode_plans = {}  # type: typing.Dict[bv.Validator, typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+        # Whether the _stone_encode() methods generated with
+        # --specialize-serializers can be used. See _is_specialized().
+        self._use_specialized = not (self._permissions or self.alias_validators)
+        # The options the encodings memoized by instances of classes generated
+        # with --frozen-types depend on, or None if they can't be memoized.
+        self._encoding_cache_key = ((for_msgpack, old_style, columnar)
+                                    if self._use_specialized else None)
 
     @property
     def for_msgpack(self):
@@ -265,8 +466,13 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         """
         return self._old_style
 
+    def encode(self, validator, value):
+        if self.use_plans:
+            return self.get_encode_plan(validator)(value)
+        return super(StoneToPythonPrimitiveSerializer, self).encode(validator, value)
+
     def encode_sub(self, validator, value):
-        if self.should_redact and hasattr(validator, '_redact'):
+        if self.should_redact and validator._redact is not None:
             if isinstance(value, list):
                 return [validator._redact.apply(v) for v in value]
             elif isinstance(value, dict):
@@ -278,13 +484,81 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         return super(StoneToPythonPrimitiveSerializer, self).encode_sub(validator, value)
 
     def encode_list(self, validator, value):
-        validated_value = validator.validate(value)
+        if self.columnar and _is_struct_list(validator):
+            fields = [(field_name, functools.partial(self.encode_sub, field_validator))
+                      for field_name, field_validator in
+                      self._get_all_fields(validator.item_validator.definition)]
+            return self._encode_columns(validator, fields, value)
+
+        if isinstance(value, bv._array_types):
+            return self._encode_array(validator, value)
+
+        if validator.is_validated(value) and self._is_copied_as_is(validator.item_validator):
+            return list(value)
+
+        validated_value = validator.validate_if_modified(value)
 
         return [self.encode_sub(validator.item_validator, value_item) for value_item in
                 validated_value]
 
+    def _encode_array(self, validator, value):
+        """
+        Encodes ``value``, a NumPy array given for a list of numbers. It's
+        validated as a whole and converted to Python numbers with a single
+        tolist() rather than item by item, unless the items have an alias
+        validator or are redacted.
+        """
+        items = validator.validate(value).tolist()
+        item_validator = validator.item_validator
+        if (item_validator in self.alias_validators or
+                (self.should_redact and item_validator._redact is not None)):
+            return [self.encode_sub(item_validator, item) for item in items]
+        return items
+
+    def _encode_columns(self, validator, fields, value):
+        """
+        Returns the columnar encoding of ``value``, a list of structs, given
+        ``(name, encode)`` for each field of the structs.
+        """
+        validate_item = self._get_struct_validate(validator.item_validator)
+        items = validator.validate_if_modified(value)
+        for item in items:
+            validate_item(item)
+        n = len(items)
+        columns = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+        for field_name, encode in fields:
+            presence_key = '_%s_present' % field_name
+            values = []
+            present = bytearray((n + 7) // 8)
+            for i, item in enumerate(items):
+                try:
+                    field_value = getattr(item, field_name)
+                except AttributeError as exc:
+                    raise bv.ValidationError(exc.args[0])
+                if field_value is not None and getattr(item, presence_key):
+                    try:
+                        values.append(encode(field_value))
+                    except bv.ValidationError as exc:
+                        exc.add_parent(field_name)
+                        raise
+                    present[i >> 3] |= 1 << (i & 7)
+            if not values:
+                continue
+            elif len(values) == n:
+                columns[field_name] = values
+            else:
+                column = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+                column['present'] = (bytes(present) if self.for_msgpack else
+                                     base64.b64encode(bytes(present)).decode('ascii'))
+                column['values'] = values
+                columns[field_name] = column
+        encoded = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+        encoded['length'] = n
+        encoded['columns'] = columns
+        return encoded
+
     def encode_map(self, validator, value):
-        validated_value = validator.validate(value)
+        validated_value = validator.validate_if_modified(value)
 
         return {
             self.encode_sub(validator.key_validator, key):
@@ -305,7 +579,7 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         if isinstance(validator, bv.Void):
             return None
         elif isinstance(validator, bv.Timestamp):
-            return _strftime(value, validator.format)
+            return _format_timestamp(value, validator.format)
         elif isinstance(validator, bv.Bytes):
             if self.for_msgpack:
                 return value
@@ -320,16 +594,63 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         else:
             return value
 
+    def _is_copied_as_is(self, validator):
+        """
+        Whether validated values of ``validator`` are their own encoding, so
+        that the items of a validated list of them can be copied over
+        without encoding each one.
+        """
+        return (isinstance(validator, (bv.String, bv.Boolean, bv.Real)) and
+                validator not in self.alias_validators and
+                not (self.should_redact and validator._redact is not None))
+
+    def _get_encoding_cache_key(self, definition):
+        """
+        Returns the key under which instances of ``definition`` memoize their
+        encoding by this serializer, or None if they don't. Only classes
+        generated with --frozen-types do, and only when serializing without
+        caller permissions or alias validators. When redacting, only those
+        whose values can't contain redacted fields do.
+
+        The definition is part of the key since a struct can also be encoded
+        as its super type.
+        """
+        if self._encoding_cache_key is None or not getattr(definition, '_is_frozen', False):
+            return None
+        if self.should_redact and getattr(definition, '_has_redactions', True):
+            return None
+        return (definition,) + self._encoding_cache_key
+
+    def _is_specialized(self, definition):
+        """
+        Whether the _stone_encode() method generated for ``definition`` with
+        --specialize-serializers can be used. Generated encoders don't redact,
+        so when redacting, they're only used for classes whose values can't
+        contain redacted fields.
+        """
+        return (self._use_specialized and '_stone_encode' in definition.__dict__ and
+                not (self.should_redact and definition._has_redactions))
+
     def encode_struct(self, validator, value):
+        cache_key = self._get_encoding_cache_key(validator.definition)
+        if cache_key is None:
+            return self._encode_struct(validator, value)
+        cached = getattr(value, '_cached_encoding', None)
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+        d = self._encode_struct(validator, value)
+        value._cached_encoding = (cache_key, d)
+        return d
+
+    def _encode_struct(self, validator, value):
         # Skip validation of fields with primitive data types because
         # they've already been validated on assignment
         d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
 
-        all_fields = validator.definition._all_fields_
+        if self._is_specialized(validator.definition):
+            return validator.definition._stone_encode(self, value, d)
 
-        for extra_permission in self.caller_permissions.permissions:
-            all_fields_name = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(validator.definition, all_fields_name, [])
+        all_fields = self._get_all_fields(validator.definition)
 
         for field_name, field_validator in all_fields:
             try:
@@ -373,9 +694,23 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
         return d
 
     def encode_union(self, validator, value):
+        cache_key = self._get_encoding_cache_key(validator.definition)
+        if cache_key is None:
+            return self._encode_union(validator, value)
+        cached = getattr(value, '_cached_encoding', None)
+        if cached is not None and cached[0] == cache_key:
+            return cached[1]
+        encoded = self._encode_union(validator, value)
+        value._cached_encoding = (cache_key, encoded)
+        return encoded
+
+    def _encode_union(self, validator, value):
         if value._tag is None:
             raise bv.ValidationError('no tag set')
 
+        if self._is_specialized(validator.definition):
+            return validator.definition._stone_encode(self, value)
+
         if not validator.definition._is_tag_present(value._tag, self.caller_permissions):
             raise bv.ValidationError(
                 "caller does not have access to '{}' tag".format(value._tag))
@@ -430,131 +765,1038 @@ class StoneToPythonPrimitiveSerializer(StoneSerializerBase):
                     (value._tag, encoded_val),
                 ))
 
-# ------------------------------------------------------------------------
-class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
-    def encode(self, validator, value):
-        return json.dumps(super(StoneToJsonSerializer, self).encode(validator, value))
+    # ------------------------------------------------------------------
+    # Encode plans
+    #
+    # An encode plan is a callable ``plan(value)`` that returns exactly what
+    # ``encode_sub(validator, value)`` would, but with the validator type
+    # dispatch, field table concatenation and option checks done once when
+    # the plan is compiled rather than on every value.
 
-# --------------------------------------------------------------
-# JSON Encoder
-#
-# These interfaces are preserved for backward compatibility and symmetry with deserialization
-# functions.
+    def get_encode_plan(self, validator):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        """
+        Returns the encode plan for ``validator`` under this serializer's
+        options, compiling it on first use.
+
+        Plans are cached on the validator itself, keyed by ``for_msgpack``,
+        ``old_style``, ``should_redact`` and the caller permissions, so they
+        are shared by every serializer with the same options. Plans that
+        depend on ``alias_validators`` are only cached on this serializer.
+        Plans can be compiled and used from several threads at once.
+        """
+        plans = self._get_encode_plans(validator)
+        plan = plans.get(self._plan_key)
+        if plan is None:
+            with _plan_lock:
+                plans = self._get_encode_plans(validator)
+                plan = plans.get(self._plan_key)
+                if plan is None:
+                    plan = self._compile_encode_plan(validator)
+                    plans[self._plan_key] = plan
+        return plan
+
+    def _get_encode_plans(self, validator):
+        if self.alias_validators:
+            return self._local_encode_plans.setdefault(validator, {})
+        try:
+            return validator._encode_plans
+        except AttributeError:
+            plans = validator._encode_plans = {}
+            return plans
+
+    def _compile_encode_plan(self, validator):
+        if self.should_redact and validator._redact is not None:
+            return self._compile_redact_plan(validator)
+        elif isinstance(validator, bv.List):
+            return self._compile_list_plan(validator)
+        elif isinstance(validator, bv.Map):
+            return self._compile_map_plan(validator)
+        elif isinstance(validator, bv.Nullable):
+            return self._compile_nullable_plan(validator)
+        elif isinstance(validator, bv.Primitive):
+            return self._compile_primitive_plan(validator)
+        elif isinstance(validator, bv.StructTree):
+            return self._compile_struct_tree_plan(validator)
+        elif isinstance(validator, bv.Struct):
+            return self._compile_struct_plan(validator)
+        elif isinstance(validator, bv.Union):
+            return self._compile_union_plan(validator)
+        else:
+            message = 'Unsupported data type {}'.format(type(validator).__name__)
 
-def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
-                should_redact=False):
-    """Encodes an object into JSON based on its type.
+            def unsupported(value):  # pylint: disable=unused-argument
+                raise bv.ValidationError(message)
+            return unsupported
 
-    Args:
-        data_type (Validator): Validator for obj.
-        obj (object): Object to be serialized.
-        caller_permissions (list): The list of raw-string caller permissions with which
-                to serialize.
-        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
-            Custom validation functions. These must raise bv.ValidationError on
-            failure.
+    def _compile_redact_plan(self, validator):
+        redact = validator._redact.apply
 
-    Returns:
-        str: JSON-encoded object.
+        def plan(value):
+            if isinstance(value, list):
+                return [redact(v) for v in value]
+            elif isinstance(value, dict):
+                return {k: redact(v) for k, v in value.items()}
+            else:
+                return redact(value)
+        return plan
+
+    def _compile_list_plan(self, validator):
+        if self.columnar and _is_struct_list(validator):
+            return self._compile_columns_plan(validator)
+
+        validate = validator.validate_if_modified
+        item_plan = self.get_encode_plan(validator.item_validator)
+
+        if self._is_copied_as_is(validator.item_validator):
+            is_validated = validator.is_validated
+
+            def copying_plan(value):
+                if is_validated(value):
+                    return list(value)
+                elif isinstance(value, bv._array_types):
+                    return self._encode_array(validator, value)
+                return [item_plan(item) for item in validate(value)]
+            return copying_plan
+
+        def plan(value):
+            if isinstance(value, bv._array_types):
+                return self._encode_array(validator, value)
+            return [item_plan(item) for item in validate(value)]
+        return plan
+
+    def _compile_columns_plan(self, validator):
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        def plan(value):
+            return self._encode_columns(validator, fields, value)
+
+        # Register before compiling the fields so that recursive types find
+        # this (still incomplete) plan instead of recursing forever.
+        plans = self._get_encode_plans(validator)
+        plans[self._plan_key] = plan
+        try:
+            for field_name, field_validator in \
+                    self._get_all_fields(validator.item_validator.definition):
+                fields.append((field_name, self.get_encode_plan(field_validator)))
+        except Exception:
+            del plans[self._plan_key]
+            raise
+        return plan
+
+    def _compile_map_plan(self, validator):
+        validate = validator.validate_if_modified
+        key_plan = self.get_encode_plan(validator.key_validator)
+        value_plan = self.get_encode_plan(validator.value_validator)
+
+        def plan(value):
+            return {key_plan(k): value_plan(v) for k, v in validate(value).items()}
+        return plan
+
+    def _compile_nullable_plan(self, validator):
+        inner_plan = self.get_encode_plan(validator.validator)
+
+        if isinstance(validator.validator, (bv.Struct, bv.Union)):
+            # Nullable.validate() fully validates composites (e.g. required
+            # struct fields), which the inner plan alone wouldn't.
+            validate = validator.validator.validate
+
+            def validated_plan(value):
+                if value is None:
+                    return None
+                validate(value)
+                return inner_plan(value)
+            return validated_plan
+
+        def plan(value):
+            if value is None:
+                return None
+            return inner_plan(value)
+        return plan
+
+    def _compile_primitive_plan(self, validator):
+        validate = validator.validate
+        alias_validator = self.alias_validators.get(validator)
 
-    This function will also do additional validation that wasn't done by the
-    objects themselves:
+        if isinstance(validator, bv.Void):
+            def convert(value):  # pylint: disable=unused-argument
+                return None
+        elif isinstance(validator, bv.Timestamp):
+            fmt = validator.format
 
-    1. The passed in obj may not have been validated with data_type yet.
-    2. If an object that should be a Struct was assigned to a field, its
-       type has been validated, but the presence of all required fields
-       hasn't been.
-    3. If an object that should be a Union was assigned to a field, whether
-       or not a tag has been set has not been validated.
-    4. A list may have passed validation initially, but been mutated since.
+            def convert(value):
+                return _format_timestamp(value, fmt)
+        elif isinstance(validator, bv.Bytes) and not self.for_msgpack:
+            def convert(value):
+                return base64.b64encode(value).decode('ascii')
+        elif isinstance(validator, bv.Integer):
+            def convert(value):
+                return int(value) if isinstance(value, bool) else value
+        else:
+            convert = None
+
+        if alias_validator is not None:
+            def aliased_plan(value):
+                validate(value)
+                alias_validator(value)
+                return value if convert is None else convert(value)
+            return aliased_plan
+        elif convert is not None:
+            def plan(value):
+                validate(value)
+                return convert(value)
+            return plan
+        else:
+            def identity_plan(value):
+                validate(value)
+                return value
+            return identity_plan
 
-    Example of serializing a struct to JSON:
+    def _get_struct_validate(self, validator):
+        if self._permissions:
+            caller_permissions = self.caller_permissions
 
-    struct FileRef
-       path String
-       rev String
+            def validate_with_permissions(val):
+                validator.validate_with_permissions(val, caller_permissions)
+            return validate_with_permissions
+        elif isinstance(validator, bv.StructTree):
+            return validator.validate
+        else:
+            # Fields are already validated on assignment
+            return validator.validate_type_only
 
-    > fr = FileRef()
-    > fr.path = 'a/b/c'
-    > fr.rev = '1234'
-    > JsonEncoder.encode(fr)
-    "{'path': 'a/b/c', 'rev': '1234'}"
+    def _get_struct_fields_plan(self, validator):
+        """
+        Returns a callable that encodes the fields of a struct, like
+        ``encode_struct``, without validating the struct itself.
+        """
+        plans = self._get_encode_plans(validator)
+        key = ('fields',) + self._plan_key
+        fields_plan = plans.get(key)
+        if fields_plan is not None:
+            return fields_plan
+
+        definition = validator.definition
+        if self._is_specialized(definition):
+            def encode_specialized(value):
+                return definition._stone_encode(self, value, collections.OrderedDict())
+            fields_plan = plans[key] = self._memoize_encoding(definition, encode_specialized)
+            return fields_plan
+
+        fields = []  # type: typing.List[typing.Tuple[str, str, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+
+        # Register before compiling the fields so that recursive types find
+        # this (still incomplete) plan instead of recursing forever.
+        fields_plan = plans[key] = self._memoize_encoding(definition,
+                                                          _make_fields_encoder(fields))
+        try:
+            for field_name, field_validator in self._get_all_fields(validator.definition):
+                fields.append((field_name, '_%s_present' % field_name,
+                               self.get_encode_plan(field_validator)))
+        except Exception:
+            del plans[key]
+            raise
+        return fields_plan
 
-    Example of serializing a union to JSON:
+    def _memoize_encoding(self, definition, encode):
+        """
+        Wraps ``encode``, the encode plan of a struct or union, so that
+        instances memoize their encoding if they should. See
+        _get_encoding_cache_key().
+        """
+        cache_key = self._get_encoding_cache_key(definition)
+        if cache_key is None:
+            return encode
+
+        def encode_memoized(value):
+            cached = getattr(value, '_cached_encoding', None)
+            if cached is not None and cached[0] == cache_key:
+                return cached[1]
+            encoded = encode(value)
+            value._cached_encoding = (cache_key, encoded)
+            return encoded
+        return encode_memoized
+
+    def _compile_struct_plan(self, validator):
+        validate = self._get_struct_validate(validator)
+        encode_fields = self._get_struct_fields_plan(validator)
+
+        def plan(value):
+            validate(value)
+            return encode_fields(value)
+        return plan
+
+    def _compile_struct_tree_plan(self, validator):
+        validate = self._get_struct_validate(validator)
+        old_style = self.old_style
+
+        # Only leaf subtypes are precompiled. Anything else goes through
+        # encode_struct_tree() so that it fails the same way.
+        subtypes = {}
+        for pytype, (tags, subtype) in \
+                validator.definition._pytype_to_tag_and_subtype_.items():
+            if len(tags) == 1 and not isinstance(subtype, bv.StructTree):
+                subtypes[pytype] = (tags[0], self._get_struct_fields_plan(subtype))
+
+        def plan(value):
+            validate(value)
+            try:
+                tag, encode_fields = subtypes[type(value)]
+            except KeyError:
+                return self.encode_struct_tree(validator, value)
+            if old_style:
+                return {tag: encode_fields(value)}
+            d = collections.OrderedDict()
+            d['.tag'] = tag
+            d.update(encode_fields(value))
+            return d
+        return plan
+
+    def _compile_union_plan(self, validator):
+        validate = validator.validate_type_only
+        definition = validator.definition
+        caller_permissions = self.caller_permissions
+        old_style = self.old_style
+
+        # Tags are resolved on first use since the set of accessible tags
+        # depends on the caller permissions.
+        tags = {}  # type: typing.Dict[str, typing.Tuple[bool, bool, bool, typing.Any]]
+
+        def resolve_tag(tag):
+            if not definition._is_tag_present(tag, caller_permissions):
+                raise bv.ValidationError(
+                    "caller does not have access to '{}' tag".format(tag))
+            field_validator = definition._get_val_data_type(tag, caller_permissions)
+            is_void = field_validator is None or isinstance(field_validator, bv.Void)
+            is_nullable = isinstance(field_validator, bv.Nullable)
+            inner_validator = field_validator.validator if is_nullable else field_validator
+            is_merged = isinstance(inner_validator, bv.Struct) \
+                and not isinstance(inner_validator, bv.StructTree)
+            sub_plan = None if is_void else self.get_encode_plan(field_validator)
+            entry = tags[tag] = (is_void, is_nullable, is_merged, sub_plan)
+            return entry
+
+        if self._is_specialized(definition):
+            def specialized_plan(value):
+                validate(value)
+                if value._tag is None:
+                    raise bv.ValidationError('no tag set')
+                return definition._stone_encode(self, value)
+            return self._memoize_encoding(definition, specialized_plan)
+
+        def plan(value):
+            validate(value)
+            tag = value._tag
+            if tag is None:
+                raise bv.ValidationError('no tag set')
+            entry = tags.get(tag)
+            if entry is None:
+                entry = resolve_tag(tag)
+            is_void, is_nullable, is_merged, sub_plan = entry
+
+            if is_void or (is_nullable and value._value is None):
+                return tag if old_style else {'.tag': tag}
 
-    union UploadMode
-        add
-        overwrite
-        update FileRef
+            try:
+                encoded_val = sub_plan(value._value)
+            except bv.ValidationError as exc:
+                exc.add_parent(tag)
+                raise
 
-    > um = UploadMode()
-    > um.set_add()
-    > JsonEncoder.encode(um)
-    '"add"'
-    > um.update = fr
-    > JsonEncoder.encode(um)
-    "{'update': {'path': 'a/b/c', 'rev': '1234'}}"
-    """
-    for_msgpack = False
-    serializer = StoneToJsonSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
-    return serializer.encode(data_type, obj)
+            if old_style:
+                return {tag: encoded_val}
+            elif is_merged:
+                d = collections.OrderedDict()  # type: typing.Dict[str, typing.Any]
+                d['.tag'] = tag
+                d.update(encoded_val)
+                return d
+            else:
+                return collections.OrderedDict((
+                    ('.tag', tag),
+                    (tag, encoded_val),
+                ))
+        return self._memoize_encoding(definition, plan)
 
-def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
-                           old_style=False, for_msgpack=False, should_redact=False):
-    """Encodes an object into a JSON-compatible dict based on its type.
+    # ------------------------------------------------------------------
+    # Field masks
+    #
+    # The plans of a FieldMask only differ from the regular ones down to the
+    # structs it selects fields of. The selected fields without a mask of
+    # their own are encoded by the regular plans.
 
-    Args:
-        data_type (Validator): Validator for obj.
-        obj (object): Object to be serialized.
-        caller_permissions (list): The list of raw-string caller permissions
-            with which to serialize.
+    def _compile_masked_plan(self, validator, mask):
+        """
+        Returns an encode plan for ``validator`` that only encodes the fields
+        selected by ``mask``, which is None if the value is selected whole.
+        See FieldMask.
+        """
+        if mask is None:
+            return self.get_encode_plan(validator)
+        elif self.should_redact and validator._redact is not None:
+            return self._compile_redact_plan(validator)
+        elif isinstance(validator, bv.List):
+            validate = validator.validate_if_modified
+            if self.columnar and _is_struct_list(validator):
+                definition = validator.item_validator.definition
+                fields = [(field_name, self._compile_masked_plan(field_validator, mask[field_name]))
+                          for field_name, field_validator in self._get_all_fields(definition)
+                          if field_name in mask]
+
+                def columns_plan(value):
+                    return self._encode_columns(validator, fields, value)
+                return columns_plan
+
+            item_plan = self._compile_masked_plan(validator.item_validator, mask)
+
+            def list_plan(value):
+                return [item_plan(item) for item in validate(value)]
+            return list_plan
+        elif isinstance(validator, bv.Map):
+            validate = validator.validate_if_modified
+            key_plan = self.get_encode_plan(validator.key_validator)
+            value_plan = self._compile_masked_plan(validator.value_validator, mask)
+
+            def map_plan(value):
+                return {key_plan(key): value_plan(item)
+                        for key, item in validate(value).items()}
+            return map_plan
+        elif isinstance(validator, bv.Nullable):
+            inner_plan = self._compile_masked_plan(validator.validator, mask)
+
+            def nullable_plan(value):
+                if value is None:
+                    return None
+                return inner_plan(value)
+            return nullable_plan
+
+        # Only the type of structs is checked, since the presence of required
+        # fields that aren't selected doesn't matter.
+        validate = validator.validate_type_only
+        if isinstance(validator, bv.StructTree):
+            old_style = self.old_style
+            subtypes = {}
+            for pytype, (tags, subtype) in \
+                    validator.definition._pytype_to_tag_and_subtype_.items():
+                if len(tags) == 1 and not isinstance(subtype, bv.StructTree):
+                    subtypes[pytype] = (tags[0], self._compile_masked_fields_plan(subtype, mask))
+
+            def struct_tree_plan(value):
+                validate(value)
+                try:
+                    tag, encode_fields = subtypes[type(value)]
+                except KeyError:
+                    return self.encode_struct_tree(validator, value)
+                if old_style:
+                    return {tag: encode_fields(value)}
+                d = collections.OrderedDict()
+                d['.tag'] = tag
+                d.update(encode_fields(value))
+                return d
+            return struct_tree_plan
 
-    Returns:
-        An object that when passed to json.dumps() will produce a string
-        giving the JSON-encoded object.
+        encode_fields = self._compile_masked_fields_plan(validator, mask)
 
-    See json_encode() for additional information about validation.
-    """
-    serializer = StoneToPythonPrimitiveSerializer(
-        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
-    return serializer.encode(data_type, obj)
+        def struct_plan(value):
+            validate(value)
+            return encode_fields(value)
+        return struct_plan
 
-# --------------------------------------------------------------
-# JSON Decoder
-class PythonPrimitiveToStoneDecoder(object):
-    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict):
-        self.caller_permissions = (caller_permissions if
-            caller_permissions else CallerPermissionsDefault())
-        self.alias_validators = alias_validators
-        self.strict = strict
-        self._old_style = old_style
-        self._for_msgpack = for_msgpack
+    def _compile_masked_fields_plan(self, validator, mask):
+        return _make_fields_encoder([
+            (field_name, '_%s_present' % field_name,
+             self._compile_masked_plan(field_validator, mask[field_name]))
+            for field_name, field_validator in self._get_all_fields(validator.definition)
+            if field_name in mask])
 
-    @property
-    def for_msgpack(self):
+# ------------------------------------------------------------------------
+class StoneToJsonSerializer(StoneToPythonPrimitiveSerializer):
+
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+                 use_plans=False, json_codec=None, columnar=False):
+        # type: (CallerPermissionsInterface, typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]], bool, bool, bool, bool, typing.Union[None, str, JsonCodec], bool) -> None # noqa: E501
         """
-        EXPERIMENTAL: A flag associated with the serializer indicating
-        whether objects produced by the ``encode`` method should be
-        encoded for msgpack.
+        Args:
+            json_codec (optional): The name of the JSON codec to use, or a
+                ``JsonCodec``. Defaults to the default codec. See
+                get_json_codec().
+
+        See ``StoneToPythonPrimitiveSerializer.__init__`` for the other
+        arguments.
         """
-        return self._for_msgpack
+        super(StoneToJsonSerializer, self).__init__(
+            caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+            use_plans=use_plans, columnar=columnar)
+        self.json_codec = get_json_codec(json_codec)
 
-    @property
-    def old_style(self):
+    def encode(self, validator, value):
+        return self.json_codec.dumps(super(StoneToJsonSerializer, self).encode(validator, value))
+
+    def encode_bytes(self, validator, value):
         """
-        A flag associated with the serializer indicating whether objects
-        produced by the ``encode`` method should be encoded according to
-        Dropbox's old or new API styles.
+        Like ``encode``, but returns the JSON text encoded as UTF-8.
         """
-        return self._old_style
+        return self.json_codec.dumps_bytes(
+            super(StoneToJsonSerializer, self).encode(validator, value))
 
-    def json_compat_obj_decode_helper(self, data_type, obj):
+# ------------------------------------------------------------------------
+class StoneToJsonStreamSerializer(StoneToPythonPrimitiveSerializer):
+    """
+    Writes the JSON encoding of a value piece by piece while walking it,
+    instead of building the tree of Python primitives that
+    ``StoneToJsonSerializer`` hands to ``json.dumps``. The output is identical
+    to that of ``StoneToJsonSerializer``.
+
+    Only leaf values (and redacted values) go through ``json.dumps``, so peak
+    memory is bounded by the nesting depth and the write buffer rather than by
+    the size of the value.
+    """
+
+    # Number of characters buffered before they're passed to the sink.
+    chunk_size = 64 * 1024
+
+    def encode(self, validator, value):
+        chunks = []  # type: typing.List[typing.Text]
+        self.encode_to(validator, value, chunks.append)
+        return ''.join(chunks)
+
+    def encode_to(self, validator, value, write):
+        # type: (bv.Validator, typing.Any, typing.Callable[[typing.Text], typing.Any]) -> None
         """
-        See json_compat_obj_decode() for argument descriptions.
+        Validates ``value`` using ``validator`` and passes its JSON encoding
+        to ``write`` in chunks of about ``chunk_size`` characters.
+
+        If a ``stone_validators.ValidationError`` is raised, part of the
+        encoding may already have been written.
         """
-        if isinstance(data_type, bv.StructTree):
-            return self.decode_struct_tree(data_type, obj)
+        buf = []  # type: typing.List[typing.Text]
+        buf_size = [0]
+
+        def buffered_write(token):
+            buf.append(token)
+            buf_size[0] += len(token)
+            if buf_size[0] >= self.chunk_size:
+                write(''.join(buf))
+                del buf[:]
+                buf_size[0] = 0
+
+        self.write_sub(validator, value, buffered_write)
+        if buf:
+            write(''.join(buf))
+
+    def write_sub(self, validator, value, write):
+        """
+        Counterpart of ``encode_sub`` that writes the encoding of ``value``
+        to ``write`` rather than returning it.
+        """
+        if self.should_redact and validator._redact is not None:
+            write(json.dumps(self.encode_sub(validator, value)))
+        elif isinstance(validator, bv.List):
+            if isinstance(value, bv._array_types):
+                write(json.dumps(self._encode_array(validator, value)))
+            else:
+                self.write_list(validator, validator.validate_if_modified(value), write)
+        elif isinstance(validator, bv.Map):
+            self.write_map(validator, validator.validate_if_modified(value), write)
+        elif isinstance(validator, bv.Nullable):
+            validator.validate(value)
+            if value is None:
+                write('null')
+            else:
+                self.write_sub(validator.validator, value, write)
+        elif isinstance(validator, bv.Primitive):
+            validator.validate(value)
+            write(json.dumps(self.encode_primitive(validator, value)))
+        elif isinstance(validator, bv.Struct):
+            self._validate_struct(validator, value)
+            if isinstance(validator, bv.StructTree):
+                self.write_struct_tree(validator, value, write)
+            else:
+                write('{')
+                self.write_struct_fields(validator, value, write, True)
+                write('}')
+        elif isinstance(validator, bv.Union):
+            validator.validate_type_only(value)
+            self.write_union(validator, value, write)
+        else:
+            raise bv.ValidationError('Unsupported data type {}'.format(type(validator).__name__))
+
+    def _validate_struct(self, validator, value):
+        # Same checks as encode_sub() makes before encode_struct() and
+        # encode_struct_tree().
+        if self._permissions:
+            validator.validate_with_permissions(value, self.caller_permissions)
+        elif isinstance(validator, bv.StructTree):
+            validator.validate(value)
+        else:
+            validator.validate_type_only(value)
+
+    def write_list(self, validator, value, write):
+        item_validator = validator.item_validator
+        write('[')
+        for i, item in enumerate(value):
+            if i:
+                write(', ')
+            self.write_sub(item_validator, item, write)
+        write(']')
+
+    def write_map(self, validator, value, write):
+        key_validator = validator.key_validator
+        value_validator = validator.value_validator
+        write('{')
+        for i, (key, item) in enumerate(value.items()):
+            if i:
+                write(', ')
+            write(json.dumps(self.encode_sub(key_validator, key)))
+            write(': ')
+            self.write_sub(value_validator, item, write)
+        write('}')
+
+    def write_struct_fields(self, validator, value, write, first):
+        """
+        Writes the members of the struct ``value`` without the enclosing
+        braces. Unless ``first`` is true, a separator is written before the
+        first member.
+        """
+        all_fields = self._get_all_fields(validator.definition)
+
+        for field_name, field_validator in all_fields:
+            try:
+                field_value = getattr(value, field_name)
+            except AttributeError as exc:
+                raise bv.ValidationError(exc.args[0])
+
+            presence_key = '_%s_present' % field_name
+
+            if field_value is not None \
+                    and getattr(value, presence_key):
+                if not first:
+                    write(', ')
+                first = False
+                write(json.dumps(field_name))
+                write(': ')
+                try:
+                    self.write_sub(field_validator, field_value, write)
+                except bv.ValidationError as exc:
+                    exc.add_parent(field_name)
+
+                    raise
+
+    def write_struct_tree(self, validator, value, write):
+        assert type(value) in validator.definition._pytype_to_tag_and_subtype_, \
+            '%r is not a serializable subtype of %r.' % (type(value), validator.definition)
+
+        tags, subtype = validator.definition._pytype_to_tag_and_subtype_[type(value)]
+
+        assert len(tags) == 1, tags
+        assert not isinstance(subtype, bv.StructTree), \
+            'Cannot serialize type %r because it enumerates subtypes.' % subtype.definition
+
+        if self.old_style:
+            write('{')
+            write(json.dumps(tags[0]))
+            write(': {')
+            self.write_struct_fields(subtype, value, write, True)
+            write('}}')
+        else:
+            write('{".tag": ')
+            write(json.dumps(tags[0]))
+            self.write_struct_fields(subtype, value, write, False)
+            write('}')
+
+    def write_union(self, validator, value, write):
+        if value._tag is None:
+            raise bv.ValidationError('no tag set')
+
+        if not validator.definition._is_tag_present(value._tag, self.caller_permissions):
+            raise bv.ValidationError(
+                "caller does not have access to '{}' tag".format(value._tag))
+
+        field_validator = validator.definition._get_val_data_type(value._tag,
+                                                                  self.caller_permissions)
+
+        is_none = isinstance(field_validator, bv.Void) \
+            or (isinstance(field_validator, bv.Nullable)
+                and value._value is None)
+
+        tag = json.dumps(value._tag)
+
+        if self.old_style:
+            if field_validator is None or is_none:
+                write(tag)
+                return
+            write('{')
+            write(tag)
+            write(': ')
+        elif is_none:
+            write('{".tag": ')
+            write(tag)
+            write('}')
+            return
+        else:
+            write('{".tag": ')
+            write(tag)
+
+            struct_validator = field_validator
+            if isinstance(struct_validator, bv.Nullable):
+                struct_validator = struct_validator.validator
+
+            if isinstance(struct_validator, bv.Struct) \
+                    and not isinstance(struct_validator, bv.StructTree) \
+                    and not (self.should_redact and field_validator._redact is not None):
+                # The struct's fields are merged into the union's object.
+                try:
+                    if isinstance(field_validator, bv.Nullable):
+                        field_validator.validate(value._value)
+                    self._validate_struct(struct_validator, value._value)
+                    self.write_struct_fields(struct_validator, value._value, write, False)
+                except bv.ValidationError as exc:
+                    exc.add_parent(value._tag)
+
+                    raise
+                write('}')
+                return
+
+            write(', ')
+            write(tag)
+            write(': ')
+
+        try:
+            self.write_sub(field_validator, value._value, write)
+        except bv.ValidationError as exc:
+            exc.add_parent(value._tag)
+
+            raise
+        write('}')
+
+# --------------------------------------------------------------
+# JSON Encoder
+#
+# These interfaces are preserved for backward compatibility and symmetry with deserialization
+# functions.
+
+def json_encode(data_type, obj, caller_permissions=None, alias_validators=None, old_style=False,
+                should_redact=False, use_plans=False, json_codec=None, as_bytes=False,
+                columnar=False, fields=None):
+    """Encodes an object into JSON based on its type.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        caller_permissions (list): The list of raw-string caller permissions with which
+                to serialize.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+        use_plans (bool): If true, encode through a compiled encode plan that
+            is cached per validator and set of options. The result is
+            identical, but repeated encodes of the same type are faster.
+        json_codec (Union[None, str, JsonCodec]): The JSON library to use. See
+            get_json_codec(). Defaults to the codec set with
+            set_default_json_codec(), which is the stdlib ``json`` module
+            unless changed.
+        as_bytes (bool): If true, return UTF-8 encoded bytes instead of str.
+            This saves a copy with codecs that produce bytes natively.
+        columnar (bool): If true, lists of structs without enumerated
+            subtypes are encoded by column rather than as a list of objects,
+            as ``{"length": n, "columns": {field: column}}``. The column of a
+            field set in every struct is the list of its values. Otherwise,
+            it's ``{"present": bitmap, "values": values}``, where the bitmap
+            has bit ``i % 8`` of byte ``i // 8`` set if the field is set in
+            struct ``i``, and values only has those. Bitmaps are base64 in
+            JSON and bytes in msgpack. Fields set in no struct are left out.
+            The result can only be decoded with ``columnar`` set too.
+        fields (Union[None, FieldMask, Iterable, dict]): If set, only the
+            selected fields are encoded, as a FieldMask or the ``fields``
+            argument of its constructor. Reuse a FieldMask for repeated
+            calls.
+
+    Returns:
+        str: JSON-encoded object, or bytes if ``as_bytes`` is set.
+
+    This function will also do additional validation that wasn't done by the
+    objects themselves:
+
+    1. The passed in obj may not have been validated with data_type yet.
+    2. If an object that should be a Struct was assigned to a field, its
+       type has been validated, but the presence of all required fields
+       hasn't been.
+    3. If an object that should be a Union was assigned to a field, whether
+       or not a tag has been set has not been validated.
+    4. A list may have passed validation initially, but been mutated since.
+
+    Example of serializing a struct to JSON:
+
+    struct FileRef
+       path String
+       rev String
+
+    > fr = FileRef()
+    > fr.path = 'a/b/c'
+    > fr.rev = '1234'
+    > JsonEncoder.encode(fr)
+    "{'path': 'a/b/c', 'rev': '1234'}"
+
+    Example of serializing a union to JSON:
+
+    union UploadMode
+        add
+        overwrite
+        update FileRef
+
+    > um = UploadMode()
+    > um.set_add()
+    > JsonEncoder.encode(um)
+    '"add"'
+    > um.update = fr
+    > JsonEncoder.encode(um)
+    "{'update': {'path': 'a/b/c', 'rev': '1234'}}"
+    """
+    for_msgpack = False
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       for_msgpack=for_msgpack, should_redact=should_redact,
+                       use_plans=use_plans, json_codec=json_codec, columnar=columnar)
+    return codec.encode(obj, as_bytes=as_bytes, fields=fields)
+
+def json_compat_obj_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                           old_style=False, for_msgpack=False, should_redact=False,
+                           use_plans=False, columnar=False, fields=None):
+    """Encodes an object into a JSON-compatible dict based on its type.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to serialize.
+        use_plans (bool): See json_encode().
+        columnar (bool): See json_encode().
+        fields (Union[None, FieldMask, Iterable, dict]): See json_encode().
+
+    Returns:
+        An object that when passed to json.dumps() will produce a string
+        giving the JSON-encoded object.
+
+    See json_encode() for additional information about validation.
+    """
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       for_msgpack=for_msgpack, should_redact=should_redact,
+                       use_plans=use_plans, columnar=columnar)
+    return codec.compat_obj_encode(obj, fields)
+
+def json_encode_to(data_type, obj, sink, caller_permissions=None, alias_validators=None,
+                   old_style=False, should_redact=False):
+    """Encodes an object into JSON based on its type, writing the result to
+    ``sink`` as it goes.
+
+    Unlike json_encode(), the object is never converted into an intermediate
+    tree of dicts and lists, so memory use stays bounded for large values.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+        sink: A ``bytearray``, which is extended with the UTF-8 encoded JSON, a
+            text stream (``io.TextIOBase``), which is written ``str``, or any
+            other object with a ``write`` method, which is written ``bytes``.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to serialize.
+        alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
+            Custom validation functions. These must raise bv.ValidationError on
+            failure.
+
+    The output is the same as that of json_encode() with the same arguments.
+    If a ``bv.ValidationError`` is raised, anything appended to a
+    ``bytearray`` sink is removed again, while a stream may have been written
+    a partial encoding.
+
+    See json_encode() for additional information about validation.
+    """
+    for_msgpack = False
+    serializer = StoneToJsonStreamSerializer(
+        caller_permissions, alias_validators, for_msgpack, old_style, should_redact)
+    if isinstance(sink, bytearray):
+        start = len(sink)
+
+        def write_bytearray(text):
+            sink.extend(text.encode('utf-8'))
+
+        try:
+            serializer.encode_to(data_type, obj, write_bytearray)
+        except bv.ValidationError:
+            del sink[start:]
+            raise
+    elif isinstance(sink, io.TextIOBase):
+        serializer.encode_to(data_type, obj, sink.write)
+    else:
+        def write_bytes(text):
+            sink.write(text.encode('utf-8'))
+
+        serializer.encode_to(data_type, obj, write_bytes)
+
+# --------------------------------------------------------------
+# Lazy decoding
+
+class LazyFields(object):
+    """
+    The fields of a lazily decoded struct that haven't been decoded yet.
+
+    Generated structs keep one in their _lazy_fields slot. Their getters call
+    load() when a field isn't set, and their setters and deleters call
+    discard().
+    """
+
+    __slots__ = ['decoder', 'pending', 'loaded', 'lock']
+
+    def __init__(self, decoder, pending):
+        """
+        Args:
+            decoder (PythonPrimitiveToStoneDecoder): Decodes the fields.
+            pending (dict): Maps the name of each field to decode to a tuple
+                of its validator and JSON-compatible value.
+        """
+        self.decoder = decoder
+        self.pending = pending
+        # The fields decoded so far, as long as they haven't been set since.
+        self.loaded = set()  # type: typing.Set[str]
+        # Held while a field is decoded. A field stays pending until its slot
+        # is set, so that threads that read it meanwhile wait for the lock
+        # rather than find it neither pending nor loaded.
+        self.lock = threading.RLock()
+
+    def load(self, ins, name):
+        """
+        Decodes field ``name`` of ``ins``, the struct this belongs to, and
+        sets it. Returns whether the field was decoded lazily, which means its
+        value may be read from its slot.
+        """
+        if name not in self.pending:
+            # Fields are added to loaded before they're removed from pending.
+            return name in self.loaded
+        with self.lock:
+            entry = self.pending.get(name)
+            if entry is None:
+                # Decoded by another thread in the meantime.
+                return name in self.loaded
+            data_type, obj = entry
+            try:
+                value = self.decoder.json_compat_obj_decode_helper(data_type, obj)
+                validate = self.decoder._get_setter_validate(data_type)
+                if validate is not None and value is not None:
+                    value = validate(value)
+            except bv.ValidationError as e:
+                # Leave the field pending, so that it fails the same way the
+                # next time it's accessed.
+                e.add_parent(name)
+                raise
+            # The slot is set directly rather than through the setter, which
+            # frozen instances don't allow.
+            if value is not None:
+                if getattr(ins, '_is_frozen', False):
+                    value = bv.freeze(data_type, value)
+                setattr(ins, '_%s_value' % name, value)
+                ins._present_mask |= ins._field_bits[name]
+            self.loaded.add(name)
+            del self.pending[name]
+        return True
+
+    def load_all(self, ins):
+        """
+        Decodes every pending field of ``ins``.
+        """
+        for name in list(self.pending):
+            self.load(ins, name)
+
+    def discard(self, name):
+        """
+        Forgets field ``name``, which is being set or deleted.
+        """
+        with self.lock:
+            self.pending.pop(name, None)
+            self.loaded.discard(name)
+
+
+def force(value):
+    """
+    Decodes every field left pending by a lazy decode of ``value``, which
+    may be any decoded value, including those of nested structs, unions,
+    lists and maps. Use this to get all decoding errors up front.
+
+    Raises:
+        bv.ValidationError: The first field that fails to decode.
+    """
+    if isinstance(value, list):
+        for item in value:
+            force(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            force(item)
+    elif getattr(value, '_lazy_fields', None) is not None:
+        lazy_fields = value._lazy_fields
+        for name in sorted(set(lazy_fields.pending) | lazy_fields.loaded):
+            field_value = getattr(value, name)
+            try:
+                force(field_value)
+            except bv.ValidationError as e:
+                e.add_parent(name)
+                raise
+    elif hasattr(value, '_tag'):
+        try:
+            force(value._value)
+        except bv.ValidationError as e:
+            e.add_parent(value._tag)
+            raise
+
+
+# --------------------------------------------------------------
+# JSON Decoder
+class PythonPrimitiveToStoneDecoder(object):
+    def __init__(self, caller_permissions, alias_validators, for_msgpack, old_style, strict,
+                 use_plans=False, lazy=False, trusted=False, columnar=False):
+        self.caller_permissions = (caller_permissions if
+            caller_permissions else CallerPermissionsDefault())
+        self._permissions = tuple(self.caller_permissions.permissions)
+        self.alias_validators = alias_validators
+        self.strict = strict
+        self._old_style = old_style
+        self._for_msgpack = for_msgpack
+        self.lazy = lazy
+        # Whether to skip the validation of primitive values and the check
+        # for missing required fields. See json_decode().
+        self.trusted = trusted
+        # Whether lists of structs are expected to be encoded by column.
+        self.columnar = columnar
+        # Lazy decoding is only implemented by decode_struct().
+        self.use_plans = use_plans and not lazy
+        self._plan_key = (strict, old_style, for_msgpack, trusted, self._permissions, columnar)
+        self._local_decode_plans = {}  # type: typing.Dict[bv.Validator, typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]]] # noqa: E501
+        # Whether the _stone_decode() methods generated with
+        # --specialize-serializers can be used. They validate every field.
+        self._use_specialized = not (self._permissions or alias_validators or trusted)
+
+    @property
+    def for_msgpack(self):
+        """
+        EXPERIMENTAL: A flag associated with the serializer indicating
+        whether objects produced by the ``encode`` method should be
+        encoded for msgpack.
+        """
+        return self._for_msgpack
+
+    @property
+    def old_style(self):
+        """
+        A flag associated with the serializer indicating whether objects
+        produced by the ``encode`` method should be encoded according to
+        Dropbox's old or new API styles.
+        """
+        return self._old_style
+
+    def json_compat_obj_decode_helper(self, data_type, obj):
+        """
+        See json_compat_obj_decode() for argument descriptions.
+        """
+        if self.use_plans:
+            return self.get_decode_plan(data_type)(obj)
+        elif isinstance(data_type, bv.StructTree):
+            return self.decode_struct_tree(data_type, obj)
         elif isinstance(data_type, bv.Struct):
             return self.decode_struct(data_type, obj)
         elif isinstance(data_type, bv.Union):
@@ -588,28 +1830,92 @@ class PythonPrimitiveToStoneDecoder(object):
         elif not isinstance(obj, dict):
             raise bv.ValidationError('expected object, got %s' %
                                      bv.generic_type_name(obj))
-        all_fields = data_type.definition._all_fields_
-        for extra_permission in self.caller_permissions.permissions:
-            all_extra_fields = '_all_{}_fields_'.format(extra_permission)
-            all_fields = all_fields + getattr(data_type.definition, all_extra_fields, [])
-
-        if self.strict:
+        if self._permissions:
+            view = bv.get_permissions_view(data_type.definition, self._permissions)
+            all_fields = view.all_fields
+            all_field_names = view.all_field_names
+        else:
+            all_fields = data_type.definition._all_fields_
             all_field_names = data_type.definition._all_field_names_
-            for extra_permission in self.caller_permissions.permissions:
-                all_extra_field_names = '_all_{}_field_names_'.format(extra_permission)
-                all_field_names = all_field_names.union(
-                    getattr(data_type.definition, all_extra_field_names, {}))
 
+        if self.strict:
             for key in obj:
                 if (key not in all_field_names and
                         not key.startswith('.tag')):
                     raise bv.ValidationError("unknown field '%s'" % key)
+        # Only generated classes have the slot for their pending fields.
+        if self.lazy and hasattr(data_type.definition, '_lazy_fields'):
+            return self.decode_struct_lazily(data_type, all_fields, obj)
+        if self.trusted and '_new_validated' in data_type.definition.__dict__:
+            return self.decode_struct_trusted(data_type, all_fields, obj)
+        if self._use_specialized and '_stone_decode' in data_type.definition.__dict__:
+            return data_type.definition._stone_decode(self, obj)
         ins = data_type.definition()
+        frozen = getattr(data_type.definition, '_is_frozen', False)
+        if frozen:
+            # Instances of classes generated with --frozen-types are only
+            # mutable while they're being decoded.
+            ins._frozen = False
         self.decode_struct_fields(ins, all_fields, obj)
         # Check that all required fields have been set.
         data_type.validate_fields_only_with_permissions(ins, self.caller_permissions)
+        if frozen:
+            ins._frozen = True
+        return ins
+
+    def decode_struct_lazily(self, data_type, fields, obj):
+        """
+        Decodes a struct without decoding the fields present in ``obj``.
+        Instead, each is decoded and validated when it's first accessed, or
+        when force() is called. Only missing required fields are reported
+        right away.
+
+        Args:
+            data_type (Struct): The validator of the struct.
+            fields: A tuple of (field_name: str, field_validator: Validator)
+            obj (dict): JSON-compatible dict that is being decoded.
+        """
+        ins = data_type.definition()
+        frozen = getattr(data_type.definition, '_is_frozen', False)
+        if frozen:
+            ins._frozen = False
+        pending = {}
+        for name, field_data_type in fields:
+            if name in obj:
+                pending[name] = (field_data_type, obj[name])
+            elif field_data_type.has_default():
+                setattr(ins, name, field_data_type.get_default())
+            elif not hasattr(ins, name):
+                raise bv.ValidationError("missing required field '%s'" % name)
+        if frozen:
+            ins._frozen = True
+        if pending:
+            ins._lazy_fields = LazyFields(self, pending)
         return ins
 
+    def decode_struct_trusted(self, data_type, fields, obj):
+        """
+        Decodes a struct through the _new_validated() constructor of its
+        generated class, which skips the setters. Required fields aren't
+        checked for.
+
+        Args:
+            data_type (Struct): The validator of the struct.
+            fields: A tuple of (field_name: str, field_validator: Validator)
+            obj (dict): JSON-compatible dict that is being decoded.
+        """
+        values = {}
+        for name, field_data_type in fields:
+            if name in obj:
+                try:
+                    values[name] = self.json_compat_obj_decode_helper(field_data_type, obj[name])
+                except bv.ValidationError as e:
+                    e.add_parent(name)
+                    raise
+            elif field_data_type.has_default():
+                values[name] = field_data_type.get_default()
+        return data_type.definition._new_validated(values)
+
     def decode_struct_fields(self, ins, fields, obj):
         """
         Args:
@@ -656,12 +1962,42 @@ class PythonPrimitiveToStoneDecoder(object):
             else:
                 raise bv.ValidationError("unknown tag '%s'" % tag)
         elif isinstance(obj, dict):
+            if self._can_decode_union_specialized(data_type.definition, obj):
+                return data_type.definition._stone_decode(self, obj)
             tag, val = self.decode_union_dict(
                 data_type, obj)
         else:
             raise bv.ValidationError("expected string or object, got %s" %
                                      bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+        return self._make_union(data_type.definition, tag, val)
+
+    def _make_union(self, definition, tag, val):
+        """
+        Creates an instance of the union class ``definition``. Tags with no
+        value return the instance shared by the class. When trusted, ``val``
+        isn't validated again.
+        """
+        if val is None:
+            # Hand-written union classes may not derive from bb.Union.
+            get_symbol = getattr(definition, '_get_symbol', None)
+            symbol = get_symbol(tag) if get_symbol else None
+            if symbol is not None:
+                return symbol
+        if self.trusted:
+            return definition._new_validated(tag, val)
+        return definition(tag, val)
+
+    def _can_decode_union_specialized(self, definition, obj):
+        """
+        Whether the generated _stone_decode() of a union class can decode
+        ``obj``, which must be a dict. It only handles public tags other than
+        the catch-all.
+        """
+        if not (self._use_specialized and '_stone_decode' in definition.__dict__):
+            return False
+        tag = obj.get('.tag')
+        return (isinstance(tag, six.string_types) and tag in definition._tagmap and
+                tag != definition._catch_all)
 
     def decode_union_dict(self, data_type, obj):
         if '.tag' not in obj:
@@ -788,7 +2124,7 @@ class PythonPrimitiveToStoneDecoder(object):
         else:
             raise bv.ValidationError("expected string or object, got %s" %
                                      bv.generic_type_name(obj))
-        return data_type.definition(tag, val)
+        return self._make_union(data_type.definition, tag, val)
 
     def decode_struct_tree(self, data_type, obj):
         """
@@ -838,13 +2174,85 @@ class PythonPrimitiveToStoneDecoder(object):
         The data_type argument must be a List.
         See json_compat_obj_decode() for argument descriptions.
         """
-        if not isinstance(obj, list):
+        if self.columnar and _is_struct_list(data_type):
+            obj = self.columns_to_rows(data_type, obj)
+        elif not isinstance(obj, list):
             raise bv.ValidationError(
                 'expected list, got %s' % bv.generic_type_name(obj))
         return [
             self.json_compat_obj_decode_helper(data_type.item_validator, item)
             for item in obj]
 
+    def columns_to_rows(self, data_type, obj):
+        """
+        Converts the columnar encoding of a list of structs into the list of
+        JSON-compatible dicts of the structs, which are left to be decoded.
+        """
+        n, columns = self.parse_columns(obj)
+        rows = [{} for _ in range(n)]  # type: typing.List[typing.Dict[str, typing.Any]]
+        for field_name, indexes, values in columns:
+            for i, value in zip(indexes, values):
+                rows[i][field_name] = value
+        return rows
+
+    def parse_columns(self, obj):
+        """
+        Checks the structure of the columnar encoding of a list of structs.
+
+        Returns:
+            The length of the list, and for each column, the name of its
+            field, the indexes of the structs it has values for, and the
+            values, which are left to be decoded.
+        """
+        if not isinstance(obj, dict):
+            raise bv.ValidationError(
+                'expected columns, got %s' % bv.generic_type_name(obj))
+        if self.strict:
+            for key in obj:
+                if key not in ('length', 'columns'):
+                    raise bv.ValidationError("unexpected key '%s'" % key)
+        n = obj.get('length')
+        if not isinstance(n, six.integer_types) or isinstance(n, bool) or n < 0:
+            raise bv.ValidationError('expected length, got %s' % bv.generic_type_name(n))
+        columns = obj.get('columns', {})
+        if not isinstance(columns, dict):
+            raise bv.ValidationError(
+                'expected columns, got %s' % bv.generic_type_name(columns))
+        parsed = []  # type: typing.List[typing.Tuple[str, typing.Sequence[int], typing.List[typing.Any]]] # noqa: E501
+        for field_name, column in columns.items():
+            if isinstance(column, list):
+                indexes = range(n)  # type: typing.Sequence[int]
+                values = column
+            elif isinstance(column, dict):
+                present = column.get('present')
+                try:
+                    if self.for_msgpack:
+                        if not isinstance(present, bytes):
+                            raise TypeError
+                        present = bytearray(present)
+                    else:
+                        present = bytearray(base64.b64decode(present))
+                except (TypeError, ValueError):
+                    raise bv.ValidationError('invalid presence bitmap', parent=field_name)
+                if len(present) != (n + 7) // 8:
+                    raise bv.ValidationError('presence bitmap has the wrong size',
+                                             parent=field_name)
+                indexes = [i for i in range(n) if present[i >> 3] & (1 << (i & 7))]
+                values = column.get('values')
+                if not isinstance(values, list):
+                    raise bv.ValidationError(
+                        'expected list, got %s' % bv.generic_type_name(values),
+                        parent=field_name)
+            else:
+                raise bv.ValidationError(
+                    'expected column, got %s' % bv.generic_type_name(column),
+                    parent=field_name)
+            if len(values) != len(indexes):
+                raise bv.ValidationError('expected %d values, got %d' % (
+                    len(indexes), len(values)), parent=field_name)
+            parsed.append((field_name, indexes, values))
+        return n, parsed
+
     def decode_map(self, data_type, obj):
         """
         The data_type argument must be a Map.
@@ -878,7 +2286,7 @@ class PythonPrimitiveToStoneDecoder(object):
         """
         if isinstance(data_type, bv.Timestamp):
             try:
-                ret = datetime.datetime.strptime(val, data_type.format)
+                ret = _parse_timestamp(val, data_type.format)
             except (TypeError, ValueError) as e:
                 raise bv.ValidationError(e.args[0])
         elif isinstance(data_type, bv.Bytes):
@@ -897,8 +2305,8 @@ class PythonPrimitiveToStoneDecoder(object):
                 raise bv.ValidationError("expected null, got value")
             return None
         else:
-            if validate:
-                if self.caller_permissions.permissions:
+            if validate and not self.trusted:
+                if self._permissions:
                     data_type.validate_with_permissions(val, self.caller_permissions)
                 else:
                     data_type.validate(val)
@@ -907,13 +2315,675 @@ class PythonPrimitiveToStoneDecoder(object):
             self.alias_validators[data_type](ret)
         return ret
 
+    # ------------------------------------------------------------------
+    # Decode plans
+    #
+    # A decode plan is a callable ``plan(obj)`` that returns exactly what
+    # ``json_compat_obj_decode_helper(data_type, obj)`` would. Field tables,
+    # known-key sets and tag lookups are resolved when the plan is compiled,
+    # so decoding a large list does no per-element dispatch.
+
+    def get_decode_plan(self, data_type):
+        # type: (bv.Validator) -> typing.Callable[[typing.Any], typing.Any]
+        """
+        Returns the decode plan for ``data_type`` under this decoder's
+        options, compiling it on first use.
+
+        Plans are cached on the validator itself, keyed by ``strict``,
+        ``old_style``, ``for_msgpack``, ``trusted`` and the caller
+        permissions. Plans that
+        depend on ``alias_validators`` are only cached on this decoder.
+        """
+        plans = self._get_decode_plans(data_type)
+        plan = plans.get(self._plan_key)
+        if plan is None:
+            with _plan_lock:
+                plans = self._get_decode_plans(data_type)
+                plan = plans.get(self._plan_key)
+                if plan is None:
+                    plan = self._compile_decode_plan(data_type)
+                    plans[self._plan_key] = plan
+        return plan
+
+    def _get_decode_plans(self, data_type):
+        if self.alias_validators:
+            return self._local_decode_plans.setdefault(data_type, {})
+        try:
+            return data_type._decode_plans
+        except AttributeError:
+            plans = data_type._decode_plans = {}
+            return plans
+
+    def _compile_decode_plan(self, data_type):
+        if isinstance(data_type, bv.StructTree):
+            return self._compile_struct_tree_decode_plan(data_type)
+        elif isinstance(data_type, bv.Struct):
+            return self._get_struct_decode_plan(data_type)
+        elif isinstance(data_type, bv.Union):
+            if self.old_style:
+                return self._compile_union_old_decode_plan(data_type)
+            else:
+                return self._compile_union_decode_plan(data_type)
+        elif isinstance(data_type, bv.List):
+            return self._compile_list_decode_plan(data_type)
+        elif isinstance(data_type, bv.Map):
+            return self._compile_map_decode_plan(data_type)
+        elif isinstance(data_type, bv.Nullable):
+            return self._compile_nullable_decode_plan(data_type)
+        elif isinstance(data_type, bv.Primitive):
+            return self._compile_primitive_decode_plan(data_type)
+        else:
+            raise AssertionError('Cannot handle type %r.' % data_type)
+
+    def _get_struct_decode_plan(self, data_type):
+        """
+        Returns the plan equivalent of ``decode_struct``. This is also used
+        for the subtypes of a StructTree, so it's cached separately.
+        """
+        plans = self._get_decode_plans(data_type)
+        key = ('struct',) + self._plan_key
+        plan = plans.get(key)
+        if plan is not None:
+            return plan
+
+        definition = data_type.definition
+        has_default = data_type.has_default()
+        get_default = data_type.get_default
+        validate_fields = data_type.validate_fields_only_with_permissions
+        caller_permissions = self.caller_permissions
+        # (name, plan, has_default, get_default) for each field
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Callable[[typing.Any], typing.Any], bool, typing.Callable[[], typing.Any]]] # noqa: E501
+        known_keys = None  # type: typing.Optional[typing.Set[str]]
+        specialized = self._use_specialized and '_stone_decode' in definition.__dict__
+        new_validated = (definition._new_validated
+                         if self.trusted and '_new_validated' in definition.__dict__ else None)
+        frozen = getattr(definition, '_is_frozen', False)
+
+        if self.strict:
+            known_keys = set(definition._all_field_names_)
+            if self._permissions:
+                known_keys.update(
+                    bv.get_permissions_view(definition, self._permissions).all_field_names)
+
+        def decode_struct(obj):
+            if obj is None and has_default:
+                return get_default()
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if known_keys is not None:
+                for key in obj:
+                    if key not in known_keys and not key.startswith('.tag'):
+                        raise bv.ValidationError("unknown field '%s'" % key)
+            if specialized:
+                return definition._stone_decode(self, obj)
+            if new_validated is not None:
+                values = {}
+                for name, field_plan, field_has_default, field_get_default in fields:
+                    if name in obj:
+                        try:
+                            values[name] = field_plan(obj[name])
+                        except bv.ValidationError as e:
+                            e.add_parent(name)
+                            raise
+                    elif field_has_default:
+                        values[name] = field_get_default()
+                return new_validated(values)
+            ins = definition()
+            if frozen:
+                ins._frozen = False
+            for name, field_plan, field_has_default, field_get_default in fields:
+                if name in obj:
+                    try:
+                        setattr(ins, name, field_plan(obj[name]))
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_has_default:
+                    setattr(ins, name, field_get_default())
+            # Check that all required fields have been set.
+            validate_fields(ins, caller_permissions)
+            if frozen:
+                ins._frozen = True
+            return ins
+
+        # Register before compiling the fields so that recursive types find
+        # this (still incomplete) plan instead of recursing forever.
+        plans[key] = decode_struct
+        try:
+            all_fields = definition._all_fields_
+            if self._permissions:
+                all_fields = bv.get_permissions_view(definition, self._permissions).all_fields
+            for name, field_data_type in all_fields:
+                fields.append((name, self.get_decode_plan(field_data_type),
+                               field_data_type.has_default(), field_data_type.get_default))
+        except Exception:
+            del plans[key]
+            raise
+        return decode_struct
+
+    def _compile_struct_tree_decode_plan(self, data_type):
+        # Only tags that refer to leaf subtypes are precompiled. Everything
+        # else, including errors and catch-alls, goes through
+        # determine_struct_tree_subtype().
+        subtypes = {}
+        for tags, subtype in data_type.definition._tag_to_subtype_.items():
+            if not isinstance(subtype, bv.StructTree):
+                subtypes[tags] = self._get_struct_decode_plan(subtype)
+
+        def plan(obj):
+            if isinstance(obj, dict):
+                tag = obj.get('.tag')
+                if isinstance(tag, six.string_types):
+                    decode_struct = subtypes.get((tag,))
+                    if decode_struct is not None:
+                        return decode_struct(obj)
+            subtype = self.determine_struct_tree_subtype(data_type, obj)
+            return self._get_struct_decode_plan(subtype)(obj)
+        return plan
+
+    def _resolve_union_tag(self, data_type, tag):
+        """
+        Returns ``(val_data_type, inner_data_type, nullable, plan)`` for a tag
+        that is accessible to the caller, or None otherwise.
+        """
+        definition = data_type.definition
+        if not definition._is_tag_present(tag, self.caller_permissions):
+            return None
+        val_data_type = definition._get_val_data_type(tag, self.caller_permissions)
+        if isinstance(val_data_type, bv.Nullable):
+            inner_data_type = val_data_type.validator
+            nullable = True
+        else:
+            inner_data_type = val_data_type
+            nullable = False
+        if isinstance(val_data_type, bv.Void):
+            plan = None
+        elif self.old_style:
+            plan = self.get_decode_plan(val_data_type)
+        else:
+            plan = self.get_decode_plan(inner_data_type)
+        return val_data_type, inner_data_type, nullable, plan
+
+    def _compile_union_decode_plan(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        # Trusted decodes don't validate the value again.
+        new_union = definition._new_validated if self.trusted else definition
+        get_symbol = getattr(definition, '_get_symbol', None)
+        # Only tags known to the caller are cached, so that unknown tags in
+        # the input can't grow this without bound.
+        tags = {}  # type: typing.Dict[str, typing.Any]
+
+        def lookup(tag):
+            entry = tags.get(tag)
+            if entry is None:
+                entry = self._resolve_union_tag(data_type, tag)
+                if entry is not None:
+                    tags[tag] = entry
+            return entry
+
+        def decode_union_dict(obj):
+            if '.tag' not in obj:
+                raise bv.ValidationError("missing '.tag' key")
+            tag = obj['.tag']
+            if not isinstance(tag, six.string_types):
+                raise bv.ValidationError(
+                    'tag must be string, got %s' % bv.generic_type_name(tag))
+
+            entry = lookup(tag)
+            if entry is None:
+                if not strict and definition._catch_all:
+                    return definition._catch_all, None
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            if tag == definition._catch_all:
+                raise bv.ValidationError(
+                    "unexpected use of the catch-all tag '%s'" % tag)
+
+            _, inner_data_type, nullable, plan = entry
+            if isinstance(inner_data_type, bv.Void):
+                if strict:
+                    # See decode_union_dict() for why this is only checked in
+                    # strict mode.
+                    if tag in obj:
+                        if obj[tag] is not None:
+                            raise bv.ValidationError('expected null, got %s' %
+                                                     bv.generic_type_name(obj[tag]))
+                    for key in obj:
+                        if key != tag and key != '.tag':
+                            raise bv.ValidationError("unexpected key '%s'" % key)
+                val = None
+            elif isinstance(inner_data_type,
+                            (bv.Primitive, bv.List, bv.StructTree, bv.Union, bv.Map)):
+                if tag in obj:
+                    try:
+                        val = plan(obj[tag])
+                    except bv.ValidationError as e:
+                        e.add_parent(tag)
+                        raise
+                elif nullable:
+                    val = None
+                else:
+                    raise bv.ValidationError("missing '%s' key" % tag)
+                for key in obj:
+                    if key != tag and key != '.tag':
+                        raise bv.ValidationError("unexpected key '%s'" % key)
+            elif isinstance(inner_data_type, bv.Struct):
+                if nullable and len(obj) == 1:  # only has a .tag key
+                    val = None
+                else:
+                    try:
+                        val = plan(obj)
+                    except bv.ValidationError as e:
+                        e.add_parent(tag)
+                        raise
+            else:
+                assert False, type(inner_data_type)
+            return tag, val
+
+        def plan(obj):
+            val = None
+            if isinstance(obj, six.string_types):
+                tag = obj
+                entry = lookup(tag)
+                if entry is not None:
+                    if not isinstance(entry[0], (bv.Void, bv.Nullable)):
+                        raise bv.ValidationError(
+                            "expected object for '%s', got symbol" % tag)
+                    if tag == definition._catch_all:
+                        raise bv.ValidationError(
+                            "unexpected use of the catch-all tag '%s'" % tag)
+                elif not strict and definition._catch_all:
+                    tag = definition._catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            elif isinstance(obj, dict):
+                if self._can_decode_union_specialized(definition, obj):
+                    return definition._stone_decode(self, obj)
+                tag, val = decode_union_dict(obj)
+            else:
+                raise bv.ValidationError("expected string or object, got %s" %
+                                         bv.generic_type_name(obj))
+            if val is None and get_symbol:
+                symbol = get_symbol(tag)
+                if symbol is not None:
+                    return symbol
+            return new_union(tag, val)
+        return plan
+
+    def _compile_union_old_decode_plan(self, data_type):
+        definition = data_type.definition
+        strict = self.strict
+        # Trusted decodes don't validate the value again.
+        new_union = definition._new_validated if self.trusted else definition
+        get_symbol = getattr(definition, '_get_symbol', None)
+        tags = {}  # type: typing.Dict[str, typing.Any]
+
+        def lookup(tag):
+            entry = tags.get(tag)
+            if entry is None:
+                entry = self._resolve_union_tag(data_type, tag)
+                if entry is not None:
+                    tags[tag] = entry
+            return entry
+
+        def plan(obj):
+            val = None
+            if isinstance(obj, six.string_types):
+                # Union member has no associated value
+                tag = obj
+                entry = lookup(tag)
+                if entry is not None:
+                    if not isinstance(entry[0], (bv.Void, bv.Nullable)):
+                        raise bv.ValidationError(
+                            "expected object for '%s', got symbol" % tag)
+                elif not strict and definition._catch_all:
+                    tag = definition._catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            elif isinstance(obj, dict):
+                # Union member has value
+                if len(obj) != 1:
+                    raise bv.ValidationError('expected 1 key, got %s' % len(obj))
+                tag = list(obj)[0]
+                raw_val = obj[tag]
+                entry = lookup(tag)
+                if entry is not None:
+                    val_data_type, _, _, val_plan = entry
+                    if isinstance(val_data_type, bv.Nullable) and raw_val is None:
+                        val = None
+                    elif isinstance(val_data_type, bv.Void):
+                        if raw_val is not None and strict:
+                            raise bv.ValidationError('expected null, got %s' %
+                                                     bv.generic_type_name(raw_val))
+                    else:
+                        try:
+                            val = val_plan(raw_val)
+                        except bv.ValidationError as e:
+                            e.add_parent(tag)
+                            raise
+                elif not strict and definition._catch_all:
+                    tag = definition._catch_all
+                else:
+                    raise bv.ValidationError("unknown tag '%s'" % tag)
+            else:
+                raise bv.ValidationError("expected string or object, got %s" %
+                                         bv.generic_type_name(obj))
+            if val is None and get_symbol:
+                symbol = get_symbol(tag)
+                if symbol is not None:
+                    return symbol
+            return new_union(tag, val)
+        return plan
+
+    def _compile_list_decode_plan(self, data_type):
+        item_plan = self.get_decode_plan(data_type.item_validator)
+
+        if self.columnar and _is_struct_list(data_type):
+            return self._compile_columns_decode_plan(data_type, item_plan)
+
+        def plan(obj):
+            if not isinstance(obj, list):
+                raise bv.ValidationError(
+                    'expected list, got %s' % bv.generic_type_name(obj))
+            return [item_plan(item) for item in obj]
+        return plan
+
+    def _compile_columns_decode_plan(self, data_type, item_plan):
+        definition = data_type.item_validator.definition
+        if (self._permissions or self.alias_validators or
+                '_new_validated' not in definition.__dict__):
+            columns_to_rows = self.columns_to_rows
+
+            def rows_plan(obj):
+                return [item_plan(row) for row in columns_to_rows(data_type, obj)]
+            return rows_plan
+
+        # Each column is decoded and validated like the setter of its field
+        # would, and the structs are then created without going through the
+        # setters.
+        parse_columns = self.parse_columns
+        new_validated = definition._new_validated
+        validate_fields = data_type.item_validator.validate_fields_only
+        strict = self.strict
+        trusted = self.trusted
+        # Maps the name of each field to its decode plan and validation.
+        fields = {}  # type: typing.Dict[str, typing.Tuple[typing.Callable[[typing.Any], typing.Any], typing.Optional[typing.Callable[[typing.Any], typing.Any]]]] # noqa: E501
+        # (name, get_default) for each field with a default.
+        defaults = []  # type: typing.List[typing.Tuple[str, typing.Callable[[], typing.Any]]]
+
+        def columns_plan(obj):
+            n, columns = parse_columns(obj)
+            rows = [{} for _ in range(n)]  # type: typing.List[typing.Dict[str, typing.Any]]
+            for field_name, indexes, values in columns:
+                entry = fields.get(field_name)
+                if entry is None:
+                    if strict:
+                        raise bv.ValidationError("unknown field '%s'" % field_name)
+                    continue
+                field_plan, validate = entry
+                try:
+                    if validate is None:
+                        for i, value in zip(indexes, values):
+                            rows[i][field_name] = field_plan(value)
+                    else:
+                        for i, value in zip(indexes, values):
+                            rows[i][field_name] = validate(field_plan(value))
+                except bv.ValidationError as e:
+                    e.add_parent(field_name)
+                    raise
+            items = []
+            for row in rows:
+                for field_name, get_default in defaults:
+                    if field_name not in row:
+                        row[field_name] = get_default()
+                ins = new_validated(row)
+                if not trusted:
+                    validate_fields(ins)
+                items.append(ins)
+            return items
+
+        for field_name, field_data_type in definition._all_fields_:
+            if not isinstance(field_data_type, bv.Nullable) and field_data_type.has_default():
+                defaults.append((field_name, field_data_type.get_default))
+            fields[field_name] = (self.get_decode_plan(field_data_type),
+                                  self._get_setter_validate(field_data_type))
+        return columns_plan
+
+    def _get_setter_validate(self, field_data_type):
+        """
+        Returns a callable that validates a decoded field value like the
+        setter of the field would, for values that are passed to
+        _new_validated(), or None if values aren't validated.
+        """
+        if self.trusted:
+            return None
+        inner_data_type = field_data_type
+        if isinstance(field_data_type, bv.Nullable):
+            inner_data_type = field_data_type.validator
+        if not isinstance(inner_data_type, (bv.Struct, bv.Union)):
+            return field_data_type.validate
+        # Like the setters, only check the type of values that were validated
+        # when they were decoded.
+        validate_type_only = field_data_type.validate_type_only
+
+        def check_type(value):
+            validate_type_only(value)
+            return value
+        return check_type
+
+    def _compile_map_decode_plan(self, data_type):
+        key_plan = self.get_decode_plan(data_type.key_validator)
+        value_plan = self.get_decode_plan(data_type.value_validator)
+
+        def plan(obj):
+            if not isinstance(obj, dict):
+                raise bv.ValidationError(
+                    'expected dict, got %s' % bv.generic_type_name(obj))
+            return {key_plan(key): value_plan(value) for key, value in obj.items()}
+        return plan
+
+    def _compile_nullable_decode_plan(self, data_type):
+        inner_plan = self.get_decode_plan(data_type.validator)
+
+        def plan(obj):
+            if obj is not None:
+                return inner_plan(obj)
+            else:
+                return None
+        return plan
+
+    def _compile_primitive_decode_plan(self, data_type):
+        if isinstance(data_type, bv.Void):
+            strict = self.strict
+
+            def void_plan(obj):
+                if strict and obj is not None:
+                    raise bv.ValidationError("expected null, got value")
+                return None
+            return void_plan
+
+        # As with json_compat_obj_decode_helper(), validation is left to the
+        # containing struct or union when the field is assigned.
+        if isinstance(data_type, (bv.Timestamp, bv.Bytes)):
+            make_stone_friendly = self.make_stone_friendly
+
+            def plan(obj):
+                return make_stone_friendly(data_type, obj, False)
+            return plan
+
+        alias_validator = (self.alias_validators or {}).get(data_type)
+        if alias_validator is not None:
+            def aliased_plan(obj):
+                alias_validator(obj)
+                return obj
+            return aliased_plan
+
+        def identity_plan(obj):
+            return obj
+        return identity_plan
+
+    # ------------------------------------------------------------------
+    # Field masks
+    #
+    # See the like-named section of StoneToPythonPrimitiveSerializer.
+
+    def _compile_masked_decode_plan(self, data_type, mask):
+        """
+        Returns a decode plan for ``data_type`` that only decodes the fields
+        selected by ``mask``, which is None if the value is selected whole.
+        See FieldMask.
+        """
+        if mask is None:
+            return self.get_decode_plan(data_type)
+        elif isinstance(data_type, bv.List):
+            item_plan = self._compile_masked_decode_plan(data_type.item_validator, mask)
+            if self.columnar and _is_struct_list(data_type):
+                columns_to_rows = self.columns_to_rows
+
+                def rows_plan(obj):
+                    return [item_plan(row) for row in columns_to_rows(data_type, obj)]
+                return rows_plan
+
+            def list_plan(obj):
+                if not isinstance(obj, list):
+                    raise bv.ValidationError(
+                        'expected list, got %s' % bv.generic_type_name(obj))
+                return [item_plan(item) for item in obj]
+            return list_plan
+        elif isinstance(data_type, bv.Map):
+            key_plan = self.get_decode_plan(data_type.key_validator)
+            value_plan = self._compile_masked_decode_plan(data_type.value_validator, mask)
+
+            def map_plan(obj):
+                if not isinstance(obj, dict):
+                    raise bv.ValidationError(
+                        'expected dict, got %s' % bv.generic_type_name(obj))
+                return {key_plan(key): value_plan(value) for key, value in obj.items()}
+            return map_plan
+        elif isinstance(data_type, bv.Nullable):
+            inner_plan = self._compile_masked_decode_plan(data_type.validator, mask)
+
+            def nullable_plan(obj):
+                if obj is not None:
+                    return inner_plan(obj)
+                else:
+                    return None
+            return nullable_plan
+        elif isinstance(data_type, bv.StructTree):
+            subtypes = {}
+            for tags, subtype in data_type.definition._tag_to_subtype_.items():
+                if not isinstance(subtype, bv.StructTree):
+                    subtypes[tags] = self._compile_masked_struct_decode_plan(subtype, mask)
+
+            def struct_tree_plan(obj):
+                if isinstance(obj, dict):
+                    tag = obj.get('.tag')
+                    if isinstance(tag, six.string_types):
+                        decode_struct = subtypes.get((tag,))
+                        if decode_struct is not None:
+                            return decode_struct(obj)
+                subtype = self.determine_struct_tree_subtype(data_type, obj)
+                return self._compile_masked_struct_decode_plan(subtype, mask)(obj)
+            return struct_tree_plan
+        return self._compile_masked_struct_decode_plan(data_type, mask)
+
+    def _compile_masked_struct_decode_plan(self, data_type, mask):
+        """
+        Like _get_struct_decode_plan(), but fields that aren't selected by
+        ``mask`` are skipped, and left unset even if they're required.
+        """
+        definition = data_type.definition
+        has_default = data_type.has_default()
+        get_default = data_type.get_default
+        trusted = self.trusted
+        new_validated = (definition._new_validated
+                         if '_new_validated' in definition.__dict__ else None)
+        frozen = getattr(definition, '_is_frozen', False)
+        known_keys = None  # type: typing.Optional[typing.Set[str]]
+        all_fields = definition._all_fields_
+        if self._permissions:
+            view = bv.get_permissions_view(definition, self._permissions)
+            all_fields = view.all_fields
+            if self.strict:
+                known_keys = set(view.all_field_names)
+        elif self.strict:
+            known_keys = set(definition._all_field_names_)
+        # (name, plan, validate, has_default, get_default) for each selected
+        # field. Structs are created with _new_validated() if possible, since
+        # their setters would reject partially decoded values. Fields selected
+        # whole are then validated like their setter would, while values
+        # decoded with a mask of their own already are.
+        fields = []  # type: typing.List[typing.Tuple[str, typing.Callable[[typing.Any], typing.Any], typing.Optional[typing.Callable[[typing.Any], typing.Any]], bool, typing.Callable[[], typing.Any]]] # noqa: E501
+        for name, field_data_type in all_fields:
+            if name not in mask:
+                continue
+            if new_validated is not None and mask[name] is None:
+                validate = self._get_setter_validate(field_data_type)
+            else:
+                validate = None
+            fields.append((name, self._compile_masked_decode_plan(field_data_type, mask[name]),
+                           validate,
+                           (field_data_type.has_default() and
+                            not isinstance(field_data_type, bv.Nullable)),
+                           field_data_type.get_default))
+
+        def decode_struct(obj):
+            if obj is None and has_default:
+                return get_default()
+            elif not isinstance(obj, dict):
+                raise bv.ValidationError('expected object, got %s' %
+                                         bv.generic_type_name(obj))
+            if known_keys is not None:
+                for key in obj:
+                    if key not in known_keys and not key.startswith('.tag'):
+                        raise bv.ValidationError("unknown field '%s'" % key)
+            values = {}
+            missing = []
+            for name, field_plan, validate, field_has_default, field_get_default in fields:
+                if name in obj:
+                    try:
+                        value = field_plan(obj[name])
+                        values[name] = value if validate is None else validate(value)
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                elif field_has_default:
+                    values[name] = field_get_default()
+                else:
+                    missing.append(name)
+            if new_validated is not None:
+                ins = new_validated(values)
+            else:
+                ins = definition()
+                if frozen:
+                    ins._frozen = False
+                for name, value in values.items():
+                    try:
+                        setattr(ins, name, value)
+                    except bv.ValidationError as e:
+                        e.add_parent(name)
+                        raise
+                if frozen:
+                    ins._frozen = True
+            if not trusted:
+                # Only the selected required fields must be present.
+                for name in missing:
+                    if not hasattr(ins, name):
+                        raise bv.ValidationError("missing required field '%s'" % name)
+            return ins
+        return decode_struct
+
 def json_decode(data_type, serialized_obj, caller_permissions=None,
-                alias_validators=None, strict=True, old_style=False):
+                alias_validators=None, strict=True, old_style=False, use_plans=False,
+                json_codec=None, lazy=False, trusted=False, columnar=False, fields=None):
     """Performs the reverse operation of json_encode.
 
     Args:
         data_type (Validator): Validator for serialized_obj.
-        serialized_obj (str): The JSON string to deserialize.
+        serialized_obj (Union[str, bytes, bytearray, memoryview]): The JSON
+            string to deserialize, or its UTF-8 encoding.
         caller_permissions (list): The list of raw-string caller permissions
             with which to serialize.
         alias_validators (Optional[Mapping[bv.Validator, Callable[[], None]]]):
@@ -925,59 +2995,696 @@ def json_decode(data_type, serialized_obj, caller_permissions=None,
             recipient of serialized JSON if it's guaranteed that its Stone
             specs are at least as recent as the senders it receives messages
             from.
+        use_plans (bool): If true, decode through a compiled decode plan that
+            is cached per validator and set of options. The result is
+            identical, but repeated decodes of the same type are faster.
+        json_codec (Union[None, str, JsonCodec]): The JSON library to use. See
+            json_encode().
+        lazy (bool): If true, the fields of generated structs are only
+            decoded and validated when they're first accessed. Missing
+            required fields are still reported right away. Call force() on
+            the result to decode everything and raise any error up front.
+            ``use_plans`` is ignored.
+        trusted (bool): If true, primitive values aren't validated against
+            their data types (e.g. string patterns and integer ranges), and
+            structs aren't checked for missing required fields. Generated
+            structs and unions are created without going through their
+            validating setters. Malformed input, like an unknown tag or
+            invalid base64, is still rejected. Only use this for input
+            produced by json_encode() from the same specs, such as calls
+            between internal services. Fields decoded with ``lazy`` are
+            still validated.
+        columnar (bool): If true, lists of structs are expected to be
+            encoded by column. See json_encode().
+        fields (Union[None, FieldMask, Iterable, dict]): If set, only the
+            selected fields are decoded. The others are skipped without
+            being validated, and left unset. See json_encode().
+
+    Returns:
+        The returned object depends on the input data_type.
+            - Boolean -> bool
+            - Bytes -> bytes
+            - Float -> float
+            - Integer -> long
+            - List -> list
+            - Map -> dict
+            - Nullable -> None or its wrapped type.
+            - String -> unicode (PY2) or str (PY3)
+            - Struct -> An instance of its definition attribute.
+            - Timestamp -> datetime.datetime
+            - Union -> An instance of its definition attribute.
+    """
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       strict=strict, use_plans=use_plans, json_codec=json_codec, lazy=lazy,
+                       trusted=trusted, columnar=columnar)
+    return codec.decode(serialized_obj, fields)
+
+
+def json_compat_obj_decode(data_type, obj, caller_permissions=None,
+                           alias_validators=None, strict=True,
+                           old_style=False, for_msgpack=False, use_plans=False, lazy=False,
+                           trusted=False, columnar=False, fields=None):
+    """
+    Decodes a JSON-compatible object based on its data type into a
+    representative Python object.
+
+    Args:
+        data_type (Validator): Validator for serialized_obj.
+        obj: The JSON-compatible object to decode based on data_type.
+        caller_permissions (list): The list of raw-string caller permissions
+            with which to serialize.
+        strict (bool): If strict, then unknown struct fields will raise an
+            error, and unknown union variants will raise an error even if a
+            catch all field is specified. See json_decode() for more.
+        use_plans (bool): See json_decode().
+        lazy (bool): See json_decode().
+        trusted (bool): See json_decode().
+        columnar (bool): See json_decode().
+        fields (Union[None, FieldMask, Iterable, dict]): See json_decode().
+
+    Returns:
+        See json_decode().
+    """
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       for_msgpack=for_msgpack, strict=strict, use_plans=use_plans, lazy=lazy,
+                       trusted=trusted, columnar=columnar)
+    return codec.compat_obj_decode(obj, fields)
+
+
+# --------------------------------------------------------------
+# Field masks
+class FieldMask(object):
+    """
+    Selects the fields of a data type to encode or decode, for callers that
+    only need a few fields of large values.
+
+    ``fields`` is a collection of field names, or a dict from field names to
+    a mask for the value of each field, or None to select it whole. A mask
+    for a list, map or nullable value applies to its items, map values or
+    value. For example, ``{'entries': {'name', 'id'}}`` selects the name
+    and id of each entry of a listing. The fields of a struct with
+    enumerated subtypes include those of its subtypes.
+
+    Fields that aren't selected are skipped without being validated or
+    converted, and are left unset in decoded structs even if they're
+    required. Selected fields the caller doesn't have the permissions for
+    are skipped as well.
+
+    The mask is checked against the data type once, and the plans compiled
+    for it are kept, so create a FieldMask once and pass it to every call.
+    Masked values always go through compiled plans, whatever ``use_plans``
+    is, and are never decoded lazily.
+    """
+
+    def __init__(self, data_type, fields):
+        # type: (bv.Validator, typing.Any) -> None
+        """
+        Raises:
+            ValueError: A field doesn't exist, or fields are selected from a
+                value that isn't a struct.
+        """
+        self.data_type = data_type
+        self._mask = _compile_field_mask(data_type, fields, None)
+        # Plans by the _plan_key of the serializer or decoder.
+        self._encode_plans = {}  # type: typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]] # noqa: E501
+        self._decode_plans = {}  # type: typing.Dict[typing.Any, typing.Callable[[typing.Any], typing.Any]] # noqa: E501
+
+    def _get_encode_plan(self, serializer):
+        if serializer.alias_validators:
+            return serializer._compile_masked_plan(self.data_type, self._mask)
+        plan = self._encode_plans.get(serializer._plan_key)
+        if plan is None:
+            with _plan_lock:
+                plan = self._encode_plans.get(serializer._plan_key)
+                if plan is None:
+                    plan = serializer._compile_masked_plan(self.data_type, self._mask)
+                    self._encode_plans[serializer._plan_key] = plan
+        return plan
+
+    def _get_decode_plan(self, decoder):
+        if decoder.alias_validators:
+            return decoder._compile_masked_decode_plan(self.data_type, self._mask)
+        plan = self._decode_plans.get(decoder._plan_key)
+        if plan is None:
+            with _plan_lock:
+                plan = self._decode_plans.get(decoder._plan_key)
+                if plan is None:
+                    plan = decoder._compile_masked_decode_plan(self.data_type, self._mask)
+                    self._decode_plans[decoder._plan_key] = plan
+        return plan
+
+
+def _compile_field_mask(data_type, fields, path):
+    """
+    Returns ``fields`` as a dict from the name of each selected field to its
+    own mask, or None if it's selected whole, checking them against
+    ``data_type``. ``path`` is the dotted path of the value for errors.
+    """
+    validator = data_type
+    while isinstance(validator, (bv.List, bv.Map, bv.Nullable)):
+        if isinstance(validator, bv.List):
+            validator = validator.item_validator
+        elif isinstance(validator, bv.Map):
+            validator = validator.value_validator
+        else:
+            validator = validator.validator
+    if not isinstance(validator, bv.Struct):
+        raise ValueError("cannot select fields of '%s', which is not a struct"
+                         % (path or validator))
+    if isinstance(fields, six.string_types):
+        raise ValueError('expected a collection of field names, got %r' % fields)
+    items = fields.items() if isinstance(fields, dict) else [(name, None) for name in fields]
+
+    mask = {}  # type: typing.Dict[str, typing.Any]
+    for name, field_mask in items:
+        field_path = '%s.%s' % (path, name) if path else name
+        field_validators = _get_field_validators(validator, name)
+        if not field_validators:
+            raise ValueError("unknown field '%s'" % field_path)
+        mask[name] = None
+        if field_mask is not None:
+            for field_validator in field_validators:
+                mask[name] = _compile_field_mask(field_validator, field_mask, field_path)
+    return mask
+
+
+def _get_field_validators(validator, name):
+    """
+    Returns the validators of the fields named ``name`` of the struct
+    ``validator``, or of any of its subtypes if it's a struct tree.
+    """
+    definitions = [validator.definition]
+    if isinstance(validator, bv.StructTree):
+        definitions.extend(subtype.definition for subtype in
+                           validator.definition._tag_to_subtype_.values())
+    field_validators = []
+    for definition in definitions:
+        field_validator = dict(definition._all_fields_).get(name)
+        if field_validator is None:
+            # Fields that require permissions only have their validator.
+            field_validator = getattr(definition, '_%s_validator' % name, None)
+        if isinstance(field_validator, bv.Validator):
+            field_validators.append(field_validator)
+    return field_validators
+
+
+# --------------------------------------------------------------
+# Codecs
+class Codec(object):
+    """
+    Encodes and decodes values of a single data type with a fixed set of
+    options.
+
+    Creating a codec once and reusing it avoids setting up a serializer and
+    decoder on every call, and keeps their compiled encode and decode plans
+    at hand. A codec is never modified after construction, so it can be
+    shared between threads.
+
+    The module-level json_encode(), json_decode() and compat obj functions
+    use codecs from a bounded cache.
+    """
+
+    def __init__(self, data_type, caller_permissions=None, alias_validators=None,
+                 old_style=False, for_msgpack=False, should_redact=False, strict=True,
+                 use_plans=True, json_codec=None, lazy=False, trusted=False, columnar=False):
+        # type: (bv.Validator, typing.Optional[CallerPermissionsInterface], typing.Optional[typing.Mapping[bv.Validator, typing.Callable[[typing.Any], None]]], bool, bool, bool, bool, bool, typing.Union[None, str, JsonCodec], bool, bool, bool) -> None # noqa: E501
+        """
+        Args:
+            data_type (Validator): Validator for the values to encode and
+                decode.
+            use_plans (bool): Whether to use compiled encode and decode
+                plans. Defaults to ``True``, unlike the module-level
+                functions.
+
+        See json_encode() and json_decode() for the other arguments. Options
+        that only apply to encoding, like ``should_redact``, or to decoding,
+        like ``strict``, are ignored by the other direction.
+        """
+        self.data_type = data_type
+        self._serializer = StoneToPythonPrimitiveSerializer(
+            caller_permissions, alias_validators, for_msgpack, old_style, should_redact,
+            use_plans=use_plans, columnar=columnar)
+        self._decoder = PythonPrimitiveToStoneDecoder(
+            caller_permissions, alias_validators, for_msgpack, old_style, strict,
+            use_plans=use_plans, lazy=lazy, trusted=trusted, columnar=columnar)
+        self._json_codec = get_json_codec(json_codec)
+        # Whether JSON-compatible objects are copied before they're returned,
+        # since they may share the encodings memoized by instances of classes
+        # generated with --frozen-types.
+        self._copies_encodings = (self._serializer._encoding_cache_key is not None and
+                                  _has_frozen_types(data_type))
+
+    def encode(self, obj, as_bytes=False, fields=None):
+        """
+        Encodes ``obj`` into JSON like json_encode().
+        """
+        if as_bytes:
+            return self._json_codec.dumps_bytes(self._compat_obj_encode(obj, fields))
+        return self._json_codec.dumps(self._compat_obj_encode(obj, fields))
+
+    def decode(self, serialized_obj, fields=None):
+        """
+        Decodes JSON given as str or UTF-8 encoded bytes like json_decode().
+        """
+        try:
+            deserialized_obj = self._json_codec.loads(serialized_obj)
+        except ValueError:
+            raise bv.ValidationError('could not decode input as JSON')
+        else:
+            return self.compat_obj_decode(deserialized_obj, fields)
+
+    def compat_obj_encode(self, obj, fields=None):
+        """
+        Encodes ``obj`` into a JSON-compatible object like
+        json_compat_obj_encode().
+        """
+        encoded = self._compat_obj_encode(obj, fields)
+        if self._copies_encodings:
+            return _copy_compat_obj(encoded)
+        return encoded
+
+    def _compat_obj_encode(self, obj, fields=None):
+        """
+        Like compat_obj_encode(), but the result may share memoized encodings,
+        so it must not be modified or handed to callers.
+        """
+        if fields is not None:
+            return self._get_field_mask(fields)._get_encode_plan(self._serializer)(obj)
+        return self._serializer.encode(self.data_type, obj)
+
+    def compat_obj_decode(self, obj, fields=None):
+        """
+        Decodes a JSON-compatible object like json_compat_obj_decode().
+        """
+        if fields is not None:
+            return self._get_field_mask(fields)._get_decode_plan(self._decoder)(obj)
+        elif isinstance(self.data_type, bv.Primitive):
+            return self._decoder.make_stone_friendly(
+                self.data_type, obj, True)
+        else:
+            return self._decoder.json_compat_obj_decode_helper(
+                self.data_type, obj)
+
+    def encode_many(self, objs, as_bytes=False, return_errors=False):
+        """
+        Returns a list with the JSON encoding of each of ``objs``.
+
+        If ``return_errors`` is true, the ``bv.ValidationError`` for an item
+        that can't be encoded takes the place of its encoding, rather than
+        being raised.
+        """
+        return self._map(functools.partial(self.encode, as_bytes=as_bytes), objs,
+                         return_errors)
+
+    def decode_many(self, serialized_objs, return_errors=False):
+        """
+        Returns a list with the decoding of each of ``serialized_objs``.
+        ``return_errors`` works like with ``encode_many``.
+        """
+        return self._map(self.decode, serialized_objs, return_errors)
+
+    def _get_field_mask(self, fields):
+        """
+        Returns ``fields`` as a FieldMask for the data type of this codec.
+        """
+        if not isinstance(fields, FieldMask):
+            return FieldMask(self.data_type, fields)
+        elif fields.data_type is not self.data_type:
+            raise ValueError('field mask is for %r rather than %r'
+                             % (fields.data_type, self.data_type))
+        return fields
+
+    @staticmethod
+    def _map(f, items, return_errors):
+        if not return_errors:
+            return [f(item) for item in items]
+        results = []
+        for item in items:
+            try:
+                results.append(f(item))
+            except bv.ValidationError as e:
+                results.append(e)
+        return results
+
+
+def _has_frozen_types(data_type):
+    """
+    Whether values of ``data_type`` may contain instances of classes
+    generated with --frozen-types, which memoize their encodings.
+    """
+    seen = set()
+    pending = [data_type]
+    while pending:
+        validator = pending.pop()
+        if validator in seen:
+            continue
+        seen.add(validator)
+        if isinstance(validator, bv.Nullable):
+            pending.append(validator.validator)
+        elif isinstance(validator, bv.List):
+            pending.append(validator.item_validator)
+        elif isinstance(validator, bv.Map):
+            pending.append(validator.value_validator)
+        elif isinstance(validator, (bv.Struct, bv.Union)):
+            definition = validator.definition
+            if getattr(definition, '_is_frozen', False):
+                return True
+            if isinstance(validator, bv.Union):
+                if hasattr(definition, '_get_tag_table'):
+                    pending.extend(entry[0] for entry in definition._get_tag_table().values())
+            else:
+                pending.extend(field_validator for _, field_validator
+                               in getattr(definition, '_all_fields_', ()))
+                if isinstance(validator, bv.StructTree):
+                    pending.extend(definition._tag_to_subtype_.values())
+    return False
+
+
+def _copy_compat_obj(obj):
+    """
+    Returns a copy of the JSON-compatible object ``obj`` that shares none of
+    its dicts and lists.
+    """
+    if isinstance(obj, dict):
+        return type(obj)((key, _copy_compat_obj(value)) for key, value in obj.items())
+    elif isinstance(obj, list):
+        return [_copy_compat_obj(item) for item in obj]
+    return obj
+
+
+def json_encode_many(data_type, objs, caller_permissions=None, alias_validators=None,
+                     old_style=False, should_redact=False, use_plans=True, json_codec=None,
+                     as_bytes=False, columnar=False):
+    """Encodes each of ``objs``, which must all be of the same type, into
+    JSON.
+
+    The validator dispatch, caller permissions and options are resolved once
+    for the whole batch rather than once per object, and compiled plans are
+    used by default.
+
+    Args:
+        data_type (Validator): Validator for each of objs.
+        objs (Iterable): Objects to be serialized.
+
+    See json_encode() for the other arguments.
+
+    Returns:
+        list: The encoding of each object, in the order of ``objs``. An
+        object that fails validation gets its ``bv.ValidationError`` in place
+        of an encoding, so one bad object doesn't abort the batch.
+    """
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       should_redact=should_redact, use_plans=use_plans,
+                       json_codec=json_codec, columnar=columnar)
+    return codec.encode_many(objs, as_bytes=as_bytes, return_errors=True)
+
+
+def json_decode_many(data_type, serialized_objs, caller_permissions=None,
+                     alias_validators=None, strict=True, old_style=False, use_plans=True,
+                     json_codec=None, trusted=False, columnar=False):
+    """Performs the reverse operation of json_encode_many.
+
+    Args:
+        data_type (Validator): Validator for each of serialized_objs.
+        serialized_objs (Iterable): JSON payloads as str or UTF-8 encoded
+            bytes.
+
+    See json_decode() for the other arguments.
 
     Returns:
-        The returned object depends on the input data_type.
-            - Boolean -> bool
-            - Bytes -> bytes
-            - Float -> float
-            - Integer -> long
-            - List -> list
-            - Map -> dict
-            - Nullable -> None or its wrapped type.
-            - String -> unicode (PY2) or str (PY3)
-            - Struct -> An instance of its definition attribute.
-            - Timestamp -> datetime.datetime
-            - Union -> An instance of its definition attribute.
+        list: The decoding of each payload, in the order of
+        ``serialized_objs``. A payload that can't be decoded gets its
+        ``bv.ValidationError`` in place of a decoded object.
     """
-    try:
-        deserialized_obj = json.loads(serialized_obj)
-    except ValueError:
-        raise bv.ValidationError('could not decode input as JSON')
-    else:
-        return json_compat_obj_decode(
-            data_type, deserialized_obj, caller_permissions=caller_permissions,
-            alias_validators=alias_validators, strict=strict, old_style=old_style)
+    codec = _get_codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                       strict=strict, use_plans=use_plans, json_codec=json_codec,
+                       trusted=trusted, columnar=columnar)
+    return codec.decode_many(serialized_objs, return_errors=True)
 
 
-def json_compat_obj_decode(data_type, obj, caller_permissions=None,
-                           alias_validators=None, strict=True,
-                           old_style=False, for_msgpack=False):
+# Maximum number of codecs kept by _get_codec().
+_CODEC_CACHE_SIZE = 256
+_codec_cache = collections.OrderedDict()  # type: typing.Dict[typing.Tuple[typing.Any, ...], Codec] # noqa: E501
+_codec_cache_lock = threading.Lock()
+
+
+def _get_codec(data_type, caller_permissions, alias_validators, old_style=False,
+               for_msgpack=False, should_redact=False, strict=True, use_plans=False,
+               json_codec=None, lazy=False, trusted=False, columnar=False):
     """
-    Decodes a JSON-compatible object based on its data type into a
-    representative Python object.
+    Returns a codec for the given options from a least-recently-used cache.
+    Codecs with alias validators aren't cached since the mapping may change
+    between calls.
+    """
+    json_codec = get_json_codec(json_codec)
+    if alias_validators:
+        return Codec(data_type, caller_permissions, alias_validators, old_style=old_style,
+                     for_msgpack=for_msgpack, should_redact=should_redact, strict=strict,
+                     use_plans=use_plans, json_codec=json_codec, lazy=lazy, trusted=trusted,
+                     columnar=columnar)
+
+    permissions = tuple(caller_permissions.permissions) if caller_permissions else ()
+    key = (data_type, permissions, old_style, for_msgpack, should_redact, strict, use_plans,
+           json_codec, lazy, trusted, columnar)
+    with _codec_cache_lock:
+        codec = _codec_cache.pop(key, None)
+        if codec is None:
+            codec = Codec(data_type, caller_permissions, old_style=old_style,
+                          for_msgpack=for_msgpack, should_redact=should_redact, strict=strict,
+                          use_plans=use_plans, json_codec=json_codec, lazy=lazy,
+                          trusted=trusted, columnar=columnar)
+            if len(_codec_cache) >= _CODEC_CACHE_SIZE:
+                _codec_cache.popitem(last=False)
+        _codec_cache[key] = codec
+    return codec
+
+def json_decode_iter(data_type, stream, field=None, caller_permissions=None,
+                     alias_validators=None, strict=True, old_style=False, use_plans=False,
+                     chunk_size=64 * 1024):
+    """Decodes the items of a JSON list one at a time as they're read from
+    ``stream``.
+
+    Unlike json_decode(), the JSON text is never held in memory as a whole,
+    only the item being decoded is.
 
     Args:
-        data_type (Validator): Validator for serialized_obj.
-        obj: The JSON-compatible object to decode based on data_type.
-        caller_permissions (list): The list of raw-string caller permissions
-            with which to serialize.
-        strict (bool): If strict, then unknown struct fields will raise an
-            error, and unknown union variants will raise an error even if a
-            catch all field is specified. See json_decode() for more.
+        data_type (Validator): Validator for the list, or, if ``field`` is
+            given, for the struct containing the list.
+        stream: A file-like object opened in binary or text mode. Bytes are
+            decoded as UTF-8.
+        field (str): The name of a list field of ``data_type``, which must
+            then be a Struct. The items of that field are decoded, while the
+            other members of the JSON object are only checked to be valid
+            JSON. Nothing is yielded if the member is missing or null.
+        chunk_size (int): The number of bytes or characters read from
+            ``stream`` at a time.
+
+    See json_decode() for the other arguments.
 
     Returns:
-        See json_decode().
+        An iterator over the decoded list items. Each item is validated by the
+        list's item validator. A ``bv.ValidationError`` is raised by the
+        iterator when the input is malformed or an item is invalid.
     """
+    if field is None:
+        list_type = data_type
+    else:
+        assert isinstance(data_type, bv.Struct), \
+            'A field can only be given for a struct, not %r.' % data_type
+        permissions = tuple(caller_permissions.permissions) if caller_permissions else ()
+        fields = dict(bv.get_permissions_view(data_type.definition, permissions).all_fields)
+        assert field in fields, '%r has no field %r.' % (data_type.definition, field)
+        list_type = fields[field]
+        if isinstance(list_type, bv.Nullable):
+            list_type = list_type.validator
+    assert isinstance(list_type, bv.List), 'Cannot decode %r incrementally.' % list_type
+
     decoder = PythonPrimitiveToStoneDecoder(caller_permissions,
-        alias_validators, for_msgpack, old_style, strict)
+        alias_validators, False, old_style, strict, use_plans=use_plans)
+    reader = _JsonStreamReader(stream, chunk_size)
+    return _json_decode_iter(decoder, list_type.item_validator, reader, field)
+
 
-    if isinstance(data_type, bv.Primitive):
-        return decoder.make_stone_friendly(
-            data_type, obj, True)
+def _json_decode_iter(decoder, item_validator, reader, field):
+    if field is not None:
+        if reader.peek() != '{':
+            raise bv.ValidationError('expected object, got %s' %
+                                     bv.generic_type_name(reader.read_value()))
+        reader.expect('{')
+        # Skip members up to the one holding the list.
+        found = False
+        if reader.peek() != '}':
+            while True:
+                key = reader.read_value()
+                if not isinstance(key, six.string_types):
+                    raise bv.ValidationError('could not decode input as JSON')
+                reader.expect(':')
+                if key == field:
+                    found = True
+                    break
+                reader.read_value()
+                if reader.peek() != ',':
+                    break
+                reader.expect(',')
+        if not found:
+            reader.expect('}')
+            reader.expect_end()
+            return
+
+    if reader.peek() != '[':
+        obj = reader.read_value()
+        if obj is not None or field is None:
+            raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(obj))
     else:
-        return decoder.json_compat_obj_decode_helper(
-            data_type, obj)
+        reader.expect('[')
+        if reader.peek() != ']':
+            while True:
+                try:
+                    item = item_validator.validate(decoder.json_compat_obj_decode_helper(
+                        item_validator, reader.read_value()))
+                except bv.ValidationError as e:
+                    if field is not None:
+                        e.add_parent(field)
+                    raise
+                yield item
+                if reader.peek() != ',':
+                    break
+                reader.expect(',')
+        reader.expect(']')
+
+    if field is not None:
+        # Check that the rest of the object is well-formed.
+        while reader.peek() == ',':
+            reader.expect(',')
+            if not isinstance(reader.read_value(), six.string_types):
+                raise bv.ValidationError('could not decode input as JSON')
+            reader.expect(':')
+            reader.read_value()
+        reader.expect('}')
+    reader.expect_end()
+
+
+class _JsonStreamReader(object):
+    """
+    Incremental tokenizer for the JSON text in a stream.
+
+    Structural characters are consumed one at a time, while whole values are
+    located by tracking string and bracket nesting and then parsed with
+    ``json.loads``. Only the text from the start of the value being read is
+    kept in memory.
+    """
+
+    _ws_re = re.compile(r'[ \t\n\r]*')
+    # Characters that matter outside and inside of strings, respectively.
+    _special_re = re.compile(r'["\[\]{},:]')
+    _string_special_re = re.compile(r'["\\]')
+
+    def __init__(self, stream, chunk_size):
+        self._read = stream.read
+        self._chunk_size = chunk_size
+        self._utf8_decoder = codecs.getincrementaldecoder('utf-8')()
+        self._buf = ''
+        # Position of the next character to scan.
+        self._pos = 0
+        # Everything before this position can be dropped.
+        self._mark = 0
+        self._eof = False
+
+    def _fill(self):
+        """
+        Appends the next chunk of the stream to the buffer, dropping the
+        characters before the mark. Returns False at the end of the stream.
+        """
+        if self._eof:
+            return False
+        chunk = self._read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+        if isinstance(chunk, six.binary_type):
+            try:
+                chunk = self._utf8_decoder.decode(chunk, self._eof)
+            except UnicodeDecodeError:
+                raise bv.ValidationError('could not decode input as JSON')
+        self._buf = self._buf[self._mark:] + chunk
+        self._pos -= self._mark
+        self._mark = 0
+        return True
+
+    def peek(self):
+        """
+        Skips whitespace and returns the next character, or an empty string
+        at the end of the input.
+        """
+        while True:
+            self._pos = self._ws_re.match(self._buf, self._pos).end()
+            self._mark = self._pos
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char):
+        if self.peek() != char:
+            raise bv.ValidationError('could not decode input as JSON')
+        self._pos += 1
+        self._mark = self._pos
+
+    def expect_end(self):
+        if self.peek():
+            raise bv.ValidationError('could not decode input as JSON')
+
+    def read_value(self):
+        """
+        Reads the next complete value and returns it as parsed by
+        ``json.loads``.
+        """
+        if not self.peek():
+            raise bv.ValidationError('could not decode input as JSON')
+        depth = 0
+        in_string = False
+        while True:
+            if in_string:
+                m = self._string_special_re.search(self._buf, self._pos)
+            else:
+                m = self._special_re.search(self._buf, self._pos)
+            if m is None:
+                self._pos = len(self._buf)
+                if self._fill():
+                    continue
+                elif depth or in_string:
+                    raise bv.ValidationError('could not decode input as JSON')
+                break
+            c = m.group()
+            self._pos = m.end()
+            if in_string:
+                if c == '"':
+                    in_string = False
+                    if not depth:
+                        break
+                else:
+                    # Skip the escaped character.
+                    while self._pos >= len(self._buf):
+                        if not self._fill():
+                            raise bv.ValidationError('could not decode input as JSON')
+                    self._pos += 1
+            elif c == '"':
+                in_string = True
+            elif c in '[{':
+                depth += 1
+            elif depth and c in ']}':
+                depth -= 1
+                if not depth:
+                    break
+            elif not depth:
+                # A delimiter ends a number or literal.
+                self._pos -= 1
+                break
+        text = self._buf[self._mark:self._pos]
+        self._mark = self._pos
+        try:
+            return json.loads(text)
+        except ValueError:
+            raise bv.ValidationError('could not decode input as JSON')
 
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
@@ -1047,28 +3754,1213 @@ def _strftime(dt, fmt):
     return s
 
 
+class _LruCache(object):
+    """
+    A small mapping that forgets its least recently used entries. Lookups
+    and updates are safe to make from several threads, but may lose entries.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._data = collections.OrderedDict()  # type: typing.Dict[typing.Any, typing.Any]
+
+    def get(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            self._data[key] = value
+        return value
+
+    def put(self, key, value):
+        self._data[key] = value
+        if len(self._data) > self._size:
+            try:
+                self._data.popitem(last=False)
+            except KeyError:
+                pass
+
+# The format of most timestamps in Stone specs, which is handled without
+# strftime() and strptime().
+_ISO_8601_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_ISO_8601_RE = re.compile(
+    r'([0-9]{4})-([0-9]{2})-([0-9]{2})T([0-9]{2}):([0-9]{2}):([0-9]{2})Z\Z')
+_formatted_timestamps = _LruCache(256)
+_parsed_timestamps = _LruCache(256)
+
+def _format_timestamp(dt, fmt):
+    """
+    Returns the same as ``_strftime(dt, fmt)``, but faster for the ISO 8601
+    format.
+    """
+    # strftime() doesn't pad years before 1000 to four digits on all
+    # platforms.
+    if fmt != _ISO_8601_FORMAT or dt.year < 1000:
+        return _strftime(dt, fmt)
+    s = _formatted_timestamps.get(dt)
+    if s is None:
+        s = '%04d-%02d-%02dT%02d:%02d:%02dZ' % (
+            dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second)
+        _formatted_timestamps.put(dt, s)
+    return s
+
+def _parse_timestamp(s, fmt):
+    """
+    Returns the same as ``datetime.datetime.strptime(s, fmt)``, but faster
+    for the ISO 8601 format. Raises the same exceptions.
+    """
+    if fmt != _ISO_8601_FORMAT or not isinstance(s, six.string_types):
+        return datetime.datetime.strptime(s, fmt)
+    dt = _parsed_timestamps.get(s)
+    if dt is None:
+        m = _ISO_8601_RE.match(s)
+        try:
+            if m is None:
+                raise ValueError
+            dt = datetime.datetime(*[int(g) for g in m.groups()])
+        except ValueError:
+            # Let strptime() handle anything unusual, including producing the
+            # error message.
+            return datetime.datetime.strptime(s, fmt)
+        _parsed_timestamps.put(s, dt)
+    return dt
+
+
+# --------------------------------------------------------------
+# Msgpack
+#
+# Bytes are packed as msgpack bin rather than base64 strings, and strings as
+# UTF-8 str. Timestamps are strings in the format of their data type, like in
+# JSON. The functions are only defined if the msgpack package is installed.
+
 try:
     import msgpack
 except ImportError:
     pass
 else:
+    # Malformed input raises ValueError with msgpack 1.0, and some of these
+    # with earlier versions.
+    _MSGPACK_ERRORS = (ValueError, msgpack.exceptions.UnpackException)
+
     msgpack_compat_obj_encode = functools.partial(json_compat_obj_encode,
                                                   for_msgpack=True)
 
-    def msgpack_encode(data_type, obj):
-        return msgpack.dumps(
-            msgpack_compat_obj_encode(data_type, obj), encoding='utf-8')
-
     msgpack_compat_obj_decode = functools.partial(json_compat_obj_decode,
                                                   for_msgpack=True)
 
-    def msgpack_decode(
-            data_type, serialized_obj, alias_validators=None, strict=True):
-        # We decode everything as utf-8 because we want all object keys to be
-        # unicode. Otherwise, we need to do a lot more refactoring to make
-        # json/msgpack share the same code. We expect byte arrays to fail
-        # decoding, but when they don't, we have to convert them to bytes.
-        deserialized_obj = msgpack.loads(
-            serialized_obj, encoding='utf-8', unicode_errors='ignore')
-        return msgpack_compat_obj_decode(
-            data_type, deserialized_obj, alias_validators, strict)
+    def msgpack_encode(data_type, obj, caller_permissions=None, alias_validators=None,
+                       old_style=False, should_redact=False, use_plans=False, columnar=False):
+        """Encodes an object into msgpack based on its type.
+
+        See json_encode() for the arguments.
+
+        Returns:
+            bytes: The msgpack encoding. Encodings can be concatenated to
+            write a sequence of objects that msgpack_decode_iter() reads back.
+        """
+        codec = _get_codec(data_type, caller_permissions, alias_validators,
+                           old_style=old_style, for_msgpack=True,
+                           should_redact=should_redact, use_plans=use_plans,
+                           columnar=columnar)
+        return msgpack.packb(codec._compat_obj_encode(obj), use_bin_type=True)
+
+    def msgpack_decode(data_type, serialized_obj, alias_validators=None, strict=True,
+                       caller_permissions=None, old_style=False, use_plans=False,
+                       trusted=False, columnar=False):
+        """Performs the reverse operation of msgpack_encode.
+
+        Args:
+            serialized_obj (bytes): A single msgpack object.
+
+        See json_decode() for the other arguments, and for the returned
+        object. Strings that aren't valid UTF-8 are rejected.
+        """
+        codec = _get_codec(data_type, caller_permissions, alias_validators,
+                           old_style=old_style, for_msgpack=True, strict=strict,
+                           use_plans=use_plans, trusted=trusted, columnar=columnar)
+        try:
+            deserialized_obj = msgpack.unpackb(serialized_obj, raw=False)
+        except _MSGPACK_ERRORS:
+            raise bv.ValidationError('could not decode input as msgpack')
+        return codec.compat_obj_decode(deserialized_obj)
+
+    def msgpack_decode_iter(data_type, stream, alias_validators=None, strict=True,
+                            caller_permissions=None, old_style=False, use_plans=False,
+                            trusted=False, chunk_size=64 * 1024, columnar=False):
+        """Decodes a sequence of concatenated msgpack objects, such as those
+        written one after another with msgpack_encode(), as they're read from
+        ``stream``.
+
+        Only the objects that have been read but not yet decoded are held in
+        memory, so this suits unbounded streams like RPC connections.
+
+        Args:
+            data_type (Validator): Validator for each object.
+            stream: A file-like object opened in binary mode, or a socket.
+                Reading stops when it returns no more data.
+            chunk_size (int): The number of bytes read from ``stream`` at a
+                time.
+
+        See json_decode() for the other arguments.
+
+        Returns:
+            An iterator over the decoded objects. A ``bv.ValidationError`` is
+            raised by the iterator when an object is invalid, or when the
+            input is malformed or ends partway through an object.
+        """
+        codec = _get_codec(data_type, caller_permissions, alias_validators,
+                           old_style=old_style, for_msgpack=True, strict=strict,
+                           use_plans=use_plans, trusted=trusted, columnar=columnar)
+        read = stream.read if hasattr(stream, 'read') else stream.recv
+        return _msgpack_decode_iter(codec, read, chunk_size)
+
+    def _msgpack_decode_iter(codec, read, chunk_size):
+        unpacker = msgpack.Unpacker(raw=False)
+        fed = 0
+        # The offset of the end of the last complete object. Unpacker.tell()
+        # also counts the start of an incomplete one.
+        end = 0
+        while True:
+            try:
+                obj = next(unpacker)
+            except StopIteration:
+                chunk = read(chunk_size)
+                if not chunk:
+                    break
+                unpacker.feed(chunk)
+                fed += len(chunk)
+                continue
+            except _MSGPACK_ERRORS:
+                raise bv.ValidationError('could not decode input as msgpack')
+            end = unpacker.tell()
+            yield codec.compat_obj_decode(obj)
+        if end != fed:
+            raise bv.ValidationError('unexpected end of msgpack input')
+
+
+# --------------------------------------------------------------
+# Compact binary format
+#
+# A schema-driven encoding that identifies fields, tags and subtypes by their
+# index in the _ordinal_fields_, _ordinal_tags_ and _ordinal_subtypes_ lists
+# of generated classes rather than by name:
+#
+# - Booleans are a byte. Signed integers are zigzag varints and unsigned ones
+#   varints. Floats are 8-byte little-endian doubles.
+# - Strings and bytes are a varint length followed by the UTF-8 or raw bytes.
+#   Timestamps are strings in the format of their data type, like in JSON.
+# - Void is empty, and nullable values are a 0 or 1 byte followed by the
+#   value if it's 1.
+# - Lists are a varint count followed by the items, and maps by the keys and
+#   values in turn.
+# - Structs are a varint count of levels, one for each class from the root of
+#   the hierarchy down to the encoded one. Each level is a varint length
+#   followed, unless it's 0, by a varint mask of the fields of the class that
+#   are set, and their values in order. Since presence is recorded by the
+#   mask, optional fields are encoded without the nullable byte.
+# - Struct trees prefix the struct with a varint count and the index of each
+#   subtype on the way from the root to the encoded class.
+# - Unions are varint indexes of the class in the hierarchy and of the tag in
+#   the class, followed by the varint length of the value and the value.
+#
+# Everything of unknown length is prefixed with it, so that decoders can skip
+# fields, tags and subtypes added later. Only fields and tags without
+# permissions are encoded.
+
+_compact_end_error = 'unexpected end of compact input'
+_compact_float = struct.Struct('<d')
+
+
+def _write_varint(out, n):
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf, pos):
+    try:
+        b = buf[pos]
+    except IndexError:
+        raise bv.ValidationError(_compact_end_error)
+    if b < 0x80:
+        return b, pos + 1
+    result = 0
+    shift = 0
+    while True:
+        try:
+            b = buf[pos]
+        except IndexError:
+            raise bv.ValidationError(_compact_end_error)
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if not b & 0x80:
+            return result, pos
+        shift += 7
+        if shift > 70:
+            raise bv.ValidationError('varint is too long')
+
+
+def _read_length(buf, pos):
+    """
+    Returns a varint length at ``pos`` and the position of the data after it,
+    checking that the data doesn't extend past the end of ``buf``.
+    """
+    n, pos = _read_varint(buf, pos)
+    if pos + n > len(buf):
+        raise bv.ValidationError(_compact_end_error)
+    return n, pos
+
+
+def _hierarchy(definition, attribute):
+    """
+    Returns the classes of a struct or union that define ``attribute``
+    themselves, from the root of its hierarchy down to ``definition``.
+    """
+    return [cls for cls in reversed(definition.__mro__) if attribute in cls.__dict__]
+
+
+class _CompactCompiler(object):
+    """
+    Compiles writers, which append the encoding of a value to a bytearray, and
+    readers, which decode the value at a position in a buffer and return it
+    with the position after it.
+
+    Plans are only published on the validators once everything they refer to
+    is compiled. Until then, the plans of recursive types are found in
+    ``self._pending``.
+    """
+
+    def __init__(self, strict, arrays=False):
+        self.strict = strict
+        self.arrays = arrays and bv.np is not None
+        # Maps (id(validator), plan key) to the plans compiled so far.
+        self._pending = {}  # type: typing.Dict[typing.Tuple[int, typing.Tuple[typing.Any, ...]], typing.Callable[..., typing.Any]] # noqa: E501
+        self._compiled = []  # type: typing.List[typing.Tuple[bv.Validator, typing.Tuple[typing.Any, ...], typing.Callable[..., typing.Any]]] # noqa: E501
+
+    def get_plan(self, kind, validator):
+        key = _compact_plan_key(kind, self.strict, self.arrays)
+        plans = validator.__dict__.get('_compact_plans')
+        if plans is not None and key in plans:
+            return plans[key]
+        plan = self._pending.get((id(validator), key))
+        if plan is None:
+            plan = getattr(self, '_compile_' + kind)(validator, key)
+        return plan
+
+    def publish(self):
+        """
+        Caches the compiled plans on their validators. Must be called with
+        _plan_lock held.
+        """
+        for validator, key, plan in self._compiled:
+            try:
+                plans = validator._compact_plans
+            except AttributeError:
+                plans = validator._compact_plans = {}
+            plans[key] = plan
+
+    def _register(self, key, validator, plan):
+        self._pending[(id(validator), key)] = plan
+        self._compiled.append((validator, key, plan))
+
+    def _compile_write(self, validator, key):
+        if isinstance(validator, bv.StructTree):
+            return self._compile_write_struct_tree(validator, key)
+        elif isinstance(validator, bv.Struct):
+            validate = validator.validate_type_only
+
+            def write_struct(value, out):
+                validate(value)
+                write_body(value, out)
+            self._register(key, validator, write_struct)
+            write_body = self.get_plan('write_body', validator)
+            return write_struct
+        elif isinstance(validator, bv.Union):
+            return self._compile_write_union(validator, key)
+        elif isinstance(validator, bv.List):
+            # Like with JSON, lists and maps are validated unless they haven't
+            # been modified since they last were, and so are primitives.
+            validate = validator.validate_if_modified
+            packs_floats = isinstance(validator.item_validator, bv.Real)
+
+            def write_list(value, out):
+                value = validate(value)
+                _write_varint(out, len(value))
+                if isinstance(value, bv._array_types):
+                    if packs_floats:
+                        # Same as writing each item as a little-endian double
+                        out += value.astype('<f8', copy=False).tobytes()
+                        return
+                    value = value.tolist()
+                for item in value:
+                    write_item(item, out)
+            self._register(key, validator, write_list)
+            write_item = self.get_plan('write', validator.item_validator)
+            return write_list
+        elif isinstance(validator, bv.Map):
+            validate = validator.validate_if_modified
+
+            def write_map(value, out):
+                value = validate(value)
+                _write_varint(out, len(value))
+                for k, v in value.items():
+                    write_key(k, out)
+                    write_value(v, out)
+            self._register(key, validator, write_map)
+            write_key = self.get_plan('write', validator.key_validator)
+            write_value = self.get_plan('write', validator.value_validator)
+            return write_map
+        elif isinstance(validator, bv.Nullable):
+            def write_nullable(value, out):
+                if value is None:
+                    out.append(0)
+                else:
+                    out.append(1)
+                    write_inner(value, out)
+            self._register(key, validator, write_nullable)
+            write_inner = self.get_plan('write', validator.validator)
+            return write_nullable
+        else:
+            plan = self._compile_write_primitive(validator)
+            self._register(key, validator, plan)
+            return plan
+
+    def _compile_write_primitive(self, validator):
+        validate = validator.validate
+        if isinstance(validator, bv.Void):
+            def write_void(value, out):
+                validate(value)
+            return write_void
+        elif isinstance(validator, bv.Boolean):
+            def write_boolean(value, out):
+                out.append(1 if validate(value) else 0)
+            return write_boolean
+        elif isinstance(validator, bv.Integer):
+            if validator.minimum is not None and validator.minimum >= 0:
+                def write_unsigned(value, out):
+                    _write_varint(out, validate(value))
+                return write_unsigned
+
+            def write_signed(value, out):
+                value = validate(value)
+                _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+            return write_signed
+        elif isinstance(validator, bv.Real):
+            pack = _compact_float.pack
+
+            def write_real(value, out):
+                out += pack(validate(value))
+            return write_real
+        elif isinstance(validator, (bv.String, bv.Bytes, bv.Timestamp)):
+            if isinstance(validator, bv.String):
+                def to_bytes(value):
+                    return value.encode('utf-8')
+            elif isinstance(validator, bv.Bytes):
+                to_bytes = bytes
+            else:
+                fmt = validator.format
+
+                def to_bytes(value):
+                    return _format_timestamp(value, fmt).encode('utf-8')
+
+            def write_bytes(value, out):
+                data = to_bytes(validate(value))
+                _write_varint(out, len(data))
+                out += data
+            return write_bytes
+        else:
+            raise AssertionError('Cannot handle type %r.' % validator)
+
+    def _compile_write_body(self, validator, key):
+        """
+        Compiles a writer for the levels of a struct, without the check of
+        its type.
+        """
+        # The fields of each level as (name, presence_key, bit, writer).
+        levels = []  # type: typing.List[typing.List[typing.Tuple[str, str, int, typing.Callable[..., typing.Any]]]] # noqa: E501
+
+        def write_body(value, out):
+            _write_varint(out, len(levels))
+            for fields in levels:
+                mask = 0
+                data = bytearray()
+                for name, presence_key, bit, write in fields:
+                    try:
+                        field_value = getattr(value, name)
+                    except AttributeError as exc:
+                        raise bv.ValidationError(exc.args[0])
+                    if field_value is not None and getattr(value, presence_key):
+                        mask |= bit
+                        try:
+                            write(field_value, data)
+                        except bv.ValidationError as exc:
+                            exc.add_parent(name)
+                            raise
+                if mask:
+                    head = bytearray()
+                    _write_varint(head, mask)
+                    _write_varint(out, len(head) + len(data))
+                    out += head
+                    out += data
+                else:
+                    out.append(0)
+        self._register(key, validator, write_body)
+
+        for cls in _hierarchy(validator.definition, '_ordinal_fields_'):
+            fields = []
+            for i, (name, field_validator) in enumerate(cls._ordinal_fields_):
+                if isinstance(field_validator, bv.Nullable):
+                    # Null and absent are both left out of the mask.
+                    field_validator = field_validator.validator
+                fields.append((name, '_%s_present' % name, 1 << i,
+                               self.get_plan('write', field_validator)))
+            levels.append(fields)
+        return write_body
+
+    def _compile_write_struct_tree(self, validator, key):
+        validate = validator.validate
+        # Maps each class of the tree to the encoding of its path and the
+        # writer of its levels.
+        subtypes = {}  # type: typing.Dict[type, typing.Tuple[bytes, typing.Callable[..., typing.Any]]] # noqa: E501
+
+        def write_struct_tree(value, out):
+            validate(value)
+            entry = subtypes.get(type(value))
+            if entry is None:
+                for cls in type(value).__mro__:
+                    if cls in subtypes:
+                        entry = subtypes[cls]
+                        break
+            path, write_body = entry
+            out += path
+            write_body(value, out)
+        self._register(key, validator, write_struct_tree)
+
+        def add_subtypes(subtype, path):
+            prefix = bytearray()
+            _write_varint(prefix, len(path))
+            for i in path:
+                _write_varint(prefix, i)
+            subtypes[subtype.definition] = (
+                bytes(prefix), self.get_plan('write_body', subtype))
+            for i, (_, child) in enumerate(
+                    subtype.definition.__dict__.get('_ordinal_subtypes_', ())):
+                add_subtypes(child, path + [i])
+        add_subtypes(validator, [])
+        return write_struct_tree
+
+    def _compile_write_union(self, validator, key):
+        validate = validator.validate_type_only
+        # Maps each tag to the encoding of its indexes, and its writer or None
+        # if it's void.
+        tags = {}  # type: typing.Dict[str, typing.Tuple[bytes, typing.Optional[typing.Callable[..., typing.Any]]]] # noqa: E501
+
+        def write_union(value, out):
+            validate(value)
+            try:
+                prefix, write = tags[value._tag]
+            except KeyError:
+                raise bv.ValidationError("unknown tag '%s'" % value._tag)
+            out += prefix
+            if write is None:
+                out.append(0)
+            else:
+                data = bytearray()
+                try:
+                    write(value._value, data)
+                except bv.ValidationError as exc:
+                    exc.add_parent(value._tag)
+                    raise
+                _write_varint(out, len(data))
+                out += data
+        self._register(key, validator, write_union)
+
+        for level, cls in enumerate(_hierarchy(validator.definition, '_ordinal_tags_')):
+            for i, (tag, tag_validator) in enumerate(cls._ordinal_tags_):
+                prefix = bytearray()
+                _write_varint(prefix, level)
+                _write_varint(prefix, i)
+                if isinstance(tag_validator, bv.Void):
+                    write = None
+                else:
+                    write = self.get_plan('write', tag_validator)
+                tags[tag] = (bytes(prefix), write)
+        return write_union
+
+    def _compile_read(self, validator, key):
+        if isinstance(validator, bv.StructTree):
+            return self._compile_read_struct_tree(validator, key)
+        elif isinstance(validator, bv.Struct):
+            plan = self.get_plan('read_body', validator)
+            self._register(key, validator, plan)
+            return plan
+        elif isinstance(validator, bv.Union):
+            return self._compile_read_union(validator, key)
+        elif isinstance(validator, bv.List):
+            if self.arrays and isinstance(validator.item_validator, (bv.Integer, bv.Real)):
+                plan = self._compile_read_array(validator)
+                self._register(key, validator, plan)
+                return plan
+
+            def read_list(buf, pos):
+                n, pos = _read_varint(buf, pos)
+                items = []
+                for _ in range(n):
+                    item, pos = read_item(buf, pos)
+                    items.append(item)
+                return items, pos
+            self._register(key, validator, read_list)
+            read_item = self.get_plan('read', validator.item_validator)
+            return read_list
+        elif isinstance(validator, bv.Map):
+            def read_map(buf, pos):
+                n, pos = _read_varint(buf, pos)
+                d = {}
+                for _ in range(n):
+                    k, pos = read_key(buf, pos)
+                    d[k], pos = read_value(buf, pos)
+                return d, pos
+            self._register(key, validator, read_map)
+            read_key = self.get_plan('read', validator.key_validator)
+            read_value = self.get_plan('read', validator.value_validator)
+            return read_map
+        elif isinstance(validator, bv.Nullable):
+            def read_nullable(buf, pos):
+                try:
+                    flag = buf[pos]
+                except IndexError:
+                    raise bv.ValidationError(_compact_end_error)
+                if flag == 0:
+                    return None, pos + 1
+                elif flag == 1:
+                    return read_inner(buf, pos + 1)
+                raise bv.ValidationError('invalid null flag %d' % flag)
+            self._register(key, validator, read_nullable)
+            read_inner = self.get_plan('read', validator.validator)
+            return read_nullable
+        else:
+            plan = self._compile_read_primitive(validator)
+            self._register(key, validator, plan)
+            return plan
+
+    def _compile_read_array(self, validator):
+        """
+        Compiles a reader for a list of numbers that returns a NumPy array.
+        Floats are read straight from the buffer, without a copy.
+        """
+        item_validator = validator.item_validator
+        if isinstance(item_validator, bv.Real):
+            def read_float_array(buf, pos):
+                n, pos = _read_varint(buf, pos)
+                end = pos + 8 * n
+                if end > len(buf):
+                    raise bv.ValidationError(_compact_end_error)
+                return bv.np.frombuffer(buf, dtype='<f8', count=n, offset=pos), end
+            return read_float_array
+
+        read_item = self._compile_read_primitive(item_validator)
+        dtype = 'u8' if item_validator.minimum >= 0 else 'i8'
+
+        def read_integer_array(buf, pos):
+            n, pos = _read_varint(buf, pos)
+            items = []
+            for _ in range(n):
+                item, pos = read_item(buf, pos)
+                items.append(item)
+            try:
+                return bv.np.array(items, dtype=dtype), pos
+            except OverflowError:
+                # Report the offending item like a list would
+                for item in items:
+                    item_validator.validate(item)
+                raise
+        return read_integer_array
+
+    def _compile_read_primitive(self, validator):
+        # As with the JSON decoder, validation is left to the containing
+        # struct or union when the value is assigned, or to compact_decode().
+        if isinstance(validator, bv.Void):
+            def read_void(buf, pos):
+                return None, pos
+            return read_void
+        elif isinstance(validator, bv.Boolean):
+            def read_boolean(buf, pos):
+                try:
+                    b = buf[pos]
+                except IndexError:
+                    raise bv.ValidationError(_compact_end_error)
+                if b > 1:
+                    raise bv.ValidationError('invalid boolean %d' % b)
+                return b == 1, pos + 1
+            return read_boolean
+        elif isinstance(validator, bv.Integer):
+            signed = validator.minimum is None or validator.minimum < 0
+
+            def read_integer(buf, pos):
+                n, pos = _read_varint(buf, pos)
+                if signed:
+                    n = -(n >> 1) - 1 if n & 1 else n >> 1
+                return n, pos
+            return read_integer
+        elif isinstance(validator, bv.Real):
+            unpack_from = _compact_float.unpack_from
+
+            def read_real(buf, pos):
+                try:
+                    n, = unpack_from(buf, pos)
+                except struct.error:
+                    raise bv.ValidationError(_compact_end_error)
+                return n, pos + 8
+            return read_real
+        elif isinstance(validator, bv.String):
+            def read_string(buf, pos):
+                n, pos = _read_length(buf, pos)
+                try:
+                    s = buf[pos:pos + n].decode('utf-8')
+                except UnicodeDecodeError:
+                    raise bv.ValidationError('string is not valid UTF-8')
+                return s, pos + n
+            return read_string
+        elif isinstance(validator, bv.Bytes):
+            def read_bytes(buf, pos):
+                n, pos = _read_length(buf, pos)
+                return bytes(buf[pos:pos + n]), pos + n
+            return read_bytes
+        elif isinstance(validator, bv.Timestamp):
+            fmt = validator.format
+
+            def read_timestamp(buf, pos):
+                n, pos = _read_length(buf, pos)
+                try:
+                    s = buf[pos:pos + n].decode('utf-8')
+                    dt = _parse_timestamp(s, fmt)
+                except (UnicodeDecodeError, ValueError):
+                    raise bv.ValidationError('timestamp does not match format %r' % fmt)
+                return dt, pos + n
+            return read_timestamp
+        else:
+            raise AssertionError('Cannot handle type %r.' % validator)
+
+    def _compile_read_body(self, validator, key):
+        """
+        Compiles a reader for the levels of a struct.
+        """
+        definition = validator.definition
+        validate_fields = validator.validate_fields_only
+        frozen = getattr(definition, '_is_frozen', False)
+        strict = self.strict
+        # The name of the class of each level and its fields as (name, reader,
+        # has_default, get_default).
+        levels = []  # type: typing.List[typing.Tuple[str, typing.List[typing.Tuple[str, typing.Callable[..., typing.Any], bool, typing.Callable[[], typing.Any]]]]] # noqa: E501
+
+        def read_body(buf, pos):
+            n, pos = _read_varint(buf, pos)
+            ins = definition()
+            if frozen:
+                ins._frozen = False
+            for level, (class_name, fields) in enumerate(levels):
+                mask = 0
+                end = pos
+                if level < n:
+                    length, pos = _read_length(buf, pos)
+                    end = pos + length
+                    if length:
+                        mask, pos = _read_varint(buf, pos)
+                unknown = mask >> len(fields)
+                if unknown and strict:
+                    raise bv.ValidationError('unknown field of %s' % class_name)
+                for name, read, has_default, get_default in fields:
+                    if mask & 1:
+                        try:
+                            value, pos = read(buf, pos)
+                            setattr(ins, name, value)
+                        except bv.ValidationError as e:
+                            e.add_parent(name)
+                            raise
+                    elif has_default:
+                        setattr(ins, name, get_default())
+                    mask >>= 1
+                if unknown:
+                    pos = end
+                elif pos != end:
+                    raise bv.ValidationError('malformed compact input')
+            # Levels of a subtype this doesn't know about.
+            for _ in range(len(levels), n):
+                length, pos = _read_length(buf, pos)
+                if length and strict:
+                    raise bv.ValidationError(
+                        'unknown fields of a subtype of %s' % definition.__name__)
+                pos += length
+            validate_fields(ins)
+            if frozen:
+                ins._frozen = True
+            return ins, pos
+        self._register(key, validator, read_body)
+
+        for cls in _hierarchy(definition, '_ordinal_fields_'):
+            fields = []
+            for name, field_validator in cls._ordinal_fields_:
+                has_default = field_validator.has_default()
+                get_default = field_validator.get_default
+                if isinstance(field_validator, bv.Nullable):
+                    field_validator = field_validator.validator
+                fields.append((name, self.get_plan('read', field_validator),
+                               has_default, get_default))
+            levels.append((cls.__name__, fields))
+        return read_body
+
+    def _compile_read_struct_tree(self, validator, key):
+        strict = self.strict
+        # Maps each class of the tree to the reader of its levels.
+        read_bodies = {}  # type: typing.Dict[type, typing.Callable[..., typing.Any]]
+
+        def read_struct_tree(buf, pos):
+            depth, pos = _read_varint(buf, pos)
+            subtype = validator
+            known = True
+            for _ in range(depth):
+                i, pos = _read_varint(buf, pos)
+                if not known:
+                    continue
+                children = subtype.definition.__dict__.get('_ordinal_subtypes_', ())
+                if i < len(children):
+                    subtype = children[i][1]
+                elif strict:
+                    raise bv.ValidationError('unknown subtype of %s at index %d' % (
+                        subtype.definition.__name__, i))
+                elif subtype.definition.__dict__.get('_is_catch_all_', False):
+                    # Decode the fields this class knows about, and skip the
+                    # levels of the unknown subtype.
+                    known = False
+                else:
+                    raise bv.ValidationError(
+                        "unknown subtype of %s at index %d and '%s' is not a catch-all" %
+                        (subtype.definition.__name__, i, subtype.definition.__name__))
+            return read_bodies[subtype.definition](buf, pos)
+        self._register(key, validator, read_struct_tree)
+
+        def add_subtypes(subtype):
+            read_bodies[subtype.definition] = self.get_plan('read_body', subtype)
+            for _, child in subtype.definition.__dict__.get('_ordinal_subtypes_', ()):
+                add_subtypes(child)
+        add_subtypes(validator)
+        return read_struct_tree
+
+    def _compile_read_union(self, validator, key):
+        definition = validator.definition
+        catch_all = definition._catch_all
+        strict = self.strict
+        # The tags of each level as (tag, reader), where reader is None if the
+        # tag is void.
+        levels = []  # type: typing.List[typing.List[typing.Tuple[str, typing.Optional[typing.Callable[..., typing.Any]]]]] # noqa: E501
+
+        def read_union(buf, pos):
+            level, pos = _read_varint(buf, pos)
+            i, pos = _read_varint(buf, pos)
+            length, pos = _read_length(buf, pos)
+            end = pos + length
+            if level < len(levels) and i < len(levels[level]):
+                tag, read = levels[level][i]
+            elif not strict and catch_all:
+                return definition._get_symbol(catch_all), end
+            else:
+                raise bv.ValidationError('unknown tag of %s at level %d, index %d' % (
+                    definition.__name__, level, i))
+            if tag == catch_all:
+                raise bv.ValidationError(
+                    "unexpected use of the catch-all tag '%s'" % tag)
+            if read is None:
+                if length and strict:
+                    raise bv.ValidationError("unexpected value for void tag '%s'" % tag)
+                return definition._get_symbol(tag), end
+            try:
+                value, pos = read(buf, pos)
+                if pos != end:
+                    raise bv.ValidationError('malformed compact input')
+                return definition(tag, value), end
+            except bv.ValidationError as e:
+                e.add_parent(tag)
+                raise
+        self._register(key, validator, read_union)
+
+        for cls in _hierarchy(definition, '_ordinal_tags_'):
+            tags = []
+            for tag, tag_validator in cls._ordinal_tags_:
+                if isinstance(tag_validator, bv.Void):
+                    tags.append((tag, None))
+                else:
+                    tags.append((tag, self.get_plan('read', tag_validator)))
+            levels.append(tags)
+        return read_union
+
+
+def _compact_plan_key(kind, strict, arrays):
+    # Only readers depend on strict and arrays.
+    return (kind, strict, arrays) if kind.startswith('read') else (kind,)
+
+
+def _get_compact_plan(kind, data_type, strict=True, arrays=False):
+    arrays = arrays and bv.np is not None
+    plans = data_type.__dict__.get('_compact_plans')
+    key = _compact_plan_key(kind, strict, arrays)
+    if plans is not None and key in plans:
+        return plans[key]
+    with _plan_lock:
+        compiler = _CompactCompiler(strict, arrays)
+        plan = compiler.get_plan(kind, data_type)
+        compiler.publish()
+    return plan
+
+
+def compact_encode(data_type, obj):
+    """Encodes an object into the compact binary format.
+
+    The format identifies fields and tags by their position in the spec
+    rather than by name, so both sides must use compatible specs. See the
+    documentation of the Python backends for the changes that are compatible.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj (object): Object to be serialized.
+
+    Returns:
+        bytes: The encoding. Fields and tags that require permissions aren't
+        included.
+
+    Raises:
+        bv.ValidationError: If ``obj`` doesn't pass validation, which is done
+            like by json_encode().
+    """
+    out = bytearray()
+    _get_compact_plan('write', data_type)(obj, out)
+    return bytes(out)
+
+
+def compact_decode(data_type, serialized_obj, strict=True, arrays=False):
+    """Performs the reverse operation of compact_encode.
+
+    Args:
+        data_type (Validator): Validator for serialized_obj.
+        serialized_obj (bytes): The encoding of a single object.
+        strict (bool): If strict, then unknown fields, tags and subtypes
+            cause a ``bv.ValidationError``. Otherwise, unknown fields are
+            skipped, and unknown tags and subtypes decode as the catch-all
+            of their union or struct, if it has one.
+        arrays (bool): If true and NumPy is installed, lists of integers and
+            floats are decoded as NumPy arrays. Arrays of floats share the
+            memory of ``serialized_obj``, and are read-only if it is.
+
+    Returns:
+        The decoded object.
+    """
+    buf = bytearray(serialized_obj) if six.PY2 else serialized_obj
+    obj, pos = _get_compact_plan('read', data_type, strict, arrays)(buf, 0)
+    if pos != len(buf):
+        raise bv.ValidationError('unexpected data after compact encoding')
+    if not isinstance(data_type, (bv.Struct, bv.Union)):
+        obj = data_type.validate(obj)
+    return obj
+
+
+# --------------------------------------------------------------
+# Structural diff and patches
+#
+# A patch is a list of (op, path, value) operations that turn one value of a
+# struct or union type into another. The path is a tuple with a field name
+# for each struct and the tag for each union on the way to the value the
+# operation applies to:
+#
+# - ('set', path, value) sets a field that wasn't set.
+# - ('clear', path, None) unsets a field.
+# - ('replace', path, value) replaces a value that changed as a whole: a
+#   field of a primitive, list or map type, a struct of another subtype or a
+#   union with another tag. An empty path replaces the value itself.
+#
+# Structs of the same class and unions with the same tag are compared field
+# by field or through their value, so only what changed ends up in the patch.
+# Fields that require permissions aren't compared.
+
+_PATCH_OPS = ('set', 'clear', 'replace')
+
+
+def diff(data_type, old, new):
+    """Returns the patch that turns ``old`` into ``new``.
+
+    Args:
+        data_type (Validator): Validator for old and new.
+        old: The original value.
+        new: The new value.
+
+    Returns:
+        list: The operations that apply_patch() applies to ``old`` to get a
+        value equal to ``new``, which is empty if they're already equal.
+        Values in operations aren't copied, so they may be shared with
+        ``new``.
+    """
+    ops = []  # type: typing.List[typing.Tuple[str, typing.Tuple[str, ...], typing.Any]]
+    _diff_value(data_type, old, new, (), ops)
+    return ops
+
+
+def _diff_value(validator, old, new, path, ops):
+    if old is new:
+        return
+    if isinstance(validator, bv.Nullable):
+        if old is None or new is None:
+            ops.append(('replace', path, new))
+            return
+        validator = validator.validator
+    if isinstance(validator, bv.Struct):
+        if type(old) is not type(new):
+            ops.append(('replace', path, new))
+        else:
+            _diff_struct(old, new, path, ops)
+    elif isinstance(validator, bv.Union):
+        if type(old) is not type(new) or old._tag != new._tag:
+            ops.append(('replace', path, new))
+        elif old._value is not new._value:
+            tag_validator = type(new)._get_tag_table()[new._tag][0]
+            _diff_value(tag_validator, old._value, new._value, path + (new._tag,), ops)
+    elif not bb._values_equal(old, new):
+        ops.append(('replace', path, new))
+
+
+def _get_set_field(value, field_name):
+    """
+    Returns the value of a field of a struct, or None if it isn't set. Like
+    the encoders, this loads fields left pending by a lazy decode.
+    """
+    try:
+        field_value = getattr(value, field_name)
+    except AttributeError:
+        return None
+    if field_value is not None and getattr(value, '_%s_present' % field_name):
+        return field_value
+    return None
+
+
+def _diff_struct(old, new, path, ops):
+    for field_name, field_validator in type(new)._all_fields_:
+        old_value = _get_set_field(old, field_name)
+        new_value = _get_set_field(new, field_name)
+        if old_value is None and new_value is None:
+            continue
+        field_path = path + (field_name,)
+        if new_value is None:
+            ops.append(('clear', field_path, None))
+        elif old_value is None:
+            ops.append(('set', field_path, new_value))
+        else:
+            if isinstance(field_validator, bv.Nullable):
+                field_validator = field_validator.validator
+            _diff_value(field_validator, old_value, new_value, field_path, ops)
+
+
+def apply_patch(data_type, obj, patch):
+    """Returns the value that ``patch``, as returned by diff(), turns ``obj``
+    into. ``obj`` isn't modified: the structs and unions on the path of each
+    operation are copied, and the rest is shared with ``obj``.
+
+    Args:
+        data_type (Validator): Validator for obj.
+        obj: The value to patch.
+        patch (list): The operations to apply, in order.
+
+    Raises:
+        bv.ValidationError: An operation doesn't apply to ``obj``, for
+            example because it sets a field of a union tag that isn't set, or
+            the result isn't valid.
+    """
+    for op, path, value in patch:
+        try:
+            obj = _apply_op(data_type, obj, op, tuple(path), value)
+        except bv.ValidationError as e:
+            for name in reversed(path):
+                e.add_parent(name)
+            raise
+    return data_type.validate(obj)
+
+
+def _apply_op(validator, obj, op, path, value):
+    if op not in _PATCH_OPS:
+        raise bv.ValidationError("unknown patch operation '%s'" % op)
+    if not path:
+        if op == 'clear':
+            raise bv.ValidationError('cannot clear the patched value itself')
+        return value
+    if isinstance(validator, bv.Nullable):
+        if obj is None:
+            raise bv.ValidationError("cannot patch '%s' of a value that isn't set" % path[0])
+        validator = validator.validator
+
+    name = path[0]
+    if isinstance(validator, bv.Struct):
+        if len(path) > 1:
+            field_validator = dict(type(obj)._all_fields_).get(name)
+            if field_validator is None:
+                raise bv.ValidationError("unknown field '%s'" % name)
+            field_value = _get_set_field(obj, name)
+            if field_value is None:
+                raise bv.ValidationError("field '%s' isn't set" % name)
+            value = _apply_op(field_validator, field_value, op, path[1:], value)
+        elif not hasattr(type(obj), '_%s_present' % name):
+            raise bv.ValidationError("unknown field '%s'" % name)
+        ins = _copy_struct(obj)
+        try:
+            if op == 'clear' and len(path) == 1:
+                delattr(ins, name)
+            else:
+                setattr(ins, name, value)
+        finally:
+            if getattr(ins, '_is_frozen', False):
+                ins._frozen = True
+        return ins
+    elif isinstance(validator, bv.Union):
+        if obj._tag != name:
+            raise bv.ValidationError("tag '%s' isn't set" % name)
+        elif len(path) == 1 and op == 'clear':
+            raise bv.ValidationError("cannot clear tag '%s'" % name)
+        tag_validator = type(obj)._get_tag_table()[name][0]
+        return type(obj)(name, _apply_op(tag_validator, obj._value, op, path[1:], value))
+    raise bv.ValidationError("cannot patch '%s' of %s" % (name, bv.generic_type_name(obj)))
+
+
+def _copy_struct(value):
+    """
+    Returns a shallow copy of a generated struct that can be modified even if
+    it's frozen, in which case it must be frozen again afterwards.
+    """
+    lazy_fields = getattr(value, '_lazy_fields', None)
+    if lazy_fields is not None:
+        # The copy can't share the fields left to decode.
+        lazy_fields.load_all(value)
+    ins = copy.copy(value)
+    if lazy_fields is not None:
+        ins._lazy_fields = None
+    if getattr(ins, '_is_frozen', False):
+        ins._frozen = False
+        ins._cached_encoding = None
+    return ins
+
+
+def _get_patch_path_validator(data_type, path):
+    """
+    Returns the validator of the value at ``path`` in values of
+    ``data_type``, for encoding and decoding the values of operations.
+    """
+    validator = data_type
+    for name in path:
+        if isinstance(validator, bv.Nullable):
+            validator = validator.validator
+        if isinstance(validator, bv.Struct):
+            field_validators = _get_field_validators(validator, name)
+            if not field_validators:
+                raise bv.ValidationError("unknown field '%s'" % name)
+            # Paths don't record the subtype of struct trees, so subtypes that
+            # declare the field with different types can't be told apart.
+            for field_validator in field_validators[1:]:
+                if not _validators_match(field_validators[0], field_validator):
+                    raise bv.ValidationError(
+                        "field '%s' has different types in subtypes of %s"
+                        % (name, validator.definition.__name__))
+            validator = field_validators[0]
+        elif isinstance(validator, bv.Union):
+            entry = validator.definition._get_tag_table().get(name)
+            if entry is None:
+                raise bv.ValidationError("unknown tag '%s'" % name)
+            validator = entry[0]
+        else:
+            raise bv.ValidationError("cannot select '%s' of a %s"
+                                     % (name, type(validator).__name__))
+    return validator
+
+
+def _validators_match(a, b):
+    """
+    Whether the validators ``a`` and ``b`` accept and encode values the same
+    way, even if they're different instances.
+    """
+    if a is b:
+        return True
+    elif type(a) is not type(b):
+        return False
+    elif isinstance(a, (bv.Struct, bv.Union)):
+        return a.definition is b.definition
+    elif isinstance(a, bv.Nullable):
+        return _validators_match(a.validator, b.validator)
+    elif isinstance(a, bv.List):
+        return ((a.min_items, a.max_items) == (b.min_items, b.max_items) and
+                _validators_match(a.item_validator, b.item_validator))
+    elif isinstance(a, bv.Map):
+        return (_validators_match(a.key_validator, b.key_validator) and
+                _validators_match(a.value_validator, b.value_validator))
+
+    # The options of primitives are their public attributes.
+    def options(validator):
+        return {k: v for k, v in vars(validator).items() if not k.startswith('_')}
+    return options(a) == options(b)
+
+
+def encode_patch(data_type, patch, for_msgpack=False):
+    """Encodes a patch returned by diff() into a JSON-compatible list.
+
+    Each operation is encoded as ``[op, path]`` for ``clear`` and as
+    ``[op, path, value]`` otherwise, where the path is joined with dots and
+    the value is encoded like json_compat_obj_encode() would.
+
+    Args:
+        data_type (Validator): Validator for the values the patch applies to.
+        patch (list): The operations to encode.
+        for_msgpack (bool): Whether to encode values for msgpack, i.e. bytes
+            as binary rather than base64.
+    """
+    encoded = []
+    for op, path, value in patch:
+        dotted_path = '.'.join(path)
+        if op == 'clear':
+            encoded.append([op, dotted_path])
+        else:
+            validator = _get_patch_path_validator(data_type, path)
+            encoded.append([op, dotted_path, json_compat_obj_encode(
+                validator, value, for_msgpack=for_msgpack, use_plans=True)])
+    return encoded
+
+
+def decode_patch(data_type, obj, strict=True, for_msgpack=False):
+    """Performs the reverse operation of encode_patch.
+
+    Args:
+        data_type (Validator): Validator for the values the patch applies to.
+        obj (list): The encoded patch.
+        strict (bool): See json_compat_obj_decode(). Applies to the values of
+            operations.
+        for_msgpack (bool): See encode_patch().
+
+    Returns:
+        list: The operations, which can be passed to apply_patch().
+    """
+    if not isinstance(obj, list):
+        raise bv.ValidationError('expected list, got %s' % bv.generic_type_name(obj))
+    patch = []
+    for item in obj:
+        if not (isinstance(item, list) and 2 <= len(item) <= 3 and
+                isinstance(item[0], six.string_types) and
+                isinstance(item[1], six.string_types)):
+            raise bv.ValidationError('expected patch operation, got %r' % (item,))
+        op, dotted_path = item[0], item[1]
+        if op not in _PATCH_OPS:
+            raise bv.ValidationError("unknown patch operation '%s'" % op)
+        elif (len(item) == 2) != (op == 'clear'):
+            raise bv.ValidationError("unexpected number of arguments to '%s'" % op)
+        path = tuple(dotted_path.split('.')) if dotted_path else ()
+        value = None
+        if op != 'clear':
+            validator = _get_patch_path_validator(data_type, path)
+            try:
+                value = json_compat_obj_decode(validator, item[2], strict=strict,
+                                               for_msgpack=for_msgpack, use_plans=True)
+            except bv.ValidationError as e:
+                for name in reversed(path):
+                    e.add_parent(name)
+                raise
+        patch.append((op, path, value))
+    return patch
@@ -13,6 +13,7 @@ than being added to a project.
 from __future__ import absolute_import, unicode_literals
 
 from abc import ABCMeta, abstractmethod
+import collections
 import datetime
 import hashlib
 import math
@@ -30,6 +31,16 @@ if six.PY3:
 else:
     _binary_types = (bytes, buffer)  # noqa: E501,F821 # pylint: disable=undefined-variable,useless-suppression
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Lists of integers and floats also accept 1-dimensional NumPy arrays, which
+# are validated with vectorized checks and kept as is instead of being copied
+# into Python lists.
+_array_types = (np.ndarray,) if np is not None else ()
+
 
 class ValidationError(Exception):
     """Raised when a value doesn't pass validation by its validator."""
@@ -96,6 +107,10 @@ class Validator(object):
     """All primitive and composite data types should be a subclass of this."""
     __metaclass__ = ABCMeta
 
+    # The Redactor applied to values of fields and aliases annotated with
+    # one. Generated modules set it on the validators that have one.
+    _redact = None  # type: typing.Optional[Redactor]
+
     @abstractmethod
     def validate(self, val):
         """Validates that val is of this data type.
@@ -380,6 +395,176 @@ class Composite(Validator):
     pass
 
 
+def _invalidating(method):
+    """
+    Wraps a mutating method of ValidatedList or ValidatedDict so that it
+    marks the container as no longer validated.
+    """
+    def wrapper(self, *args, **kwargs):
+        self._validated_by = None
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = str(method.__name__)
+    return wrapper
+
+
+class ValidatedList(list):
+    """
+    The list returned by List.validate(). It remembers the validator that
+    returned it until it's modified, so that serializers can tell it doesn't
+    need to be validated again.
+
+    Copies and pickles of it are plain lists.
+    """
+
+    __slots__ = ['_validated_by']
+
+    def __init__(self, items=(), validated_by=None):
+        super(ValidatedList, self).__init__(items)
+        self._validated_by = validated_by
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__',
+              '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+              'reverse'):
+    if hasattr(list, _name):
+        setattr(ValidatedList, _name, _invalidating(getattr(list, _name)))
+
+
+class ValidatedDict(dict):
+    """
+    The dict returned by Map.validate(). See ValidatedList.
+    """
+
+    __slots__ = ['_validated_by']
+
+    def __init__(self, items=(), validated_by=None):
+        super(ValidatedDict, self).__init__(items)
+        self._validated_by = validated_by
+
+    def __reduce__(self):
+        return dict, (dict(self),)
+
+
+for _name in ('__setitem__', '__delitem__', '__ior__', 'clear', 'pop', 'popitem',
+              'setdefault', 'update'):
+    if hasattr(dict, _name):
+        setattr(ValidatedDict, _name, _invalidating(getattr(dict, _name)))
+
+
+def _read_only(method_name, type_name):
+    """
+    Returns a replacement for a mutating method of FrozenList or FrozenDict
+    that raises instead.
+    """
+    def wrapper(self, *args, **kwargs):
+        raise TypeError('cannot modify frozen %s' % type_name)
+    wrapper.__name__ = str(method_name)
+    return wrapper
+
+
+class FrozenList(ValidatedList):
+    """
+    A read-only ValidatedList, which classes generated with --frozen-types
+    store the values of their list fields as. See freeze().
+
+    Unlike those of ValidatedList, copies and pickles of it are read-only too,
+    so that copies of frozen structs stay frozen.
+    """
+
+    __slots__ = []  # type: typing.List[str]
+
+    def __reduce__(self):
+        return FrozenList, (list(self),)
+
+
+for _name in ('__setitem__', '__delitem__', '__setslice__', '__delslice__', '__iadd__',
+              '__imul__', 'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort',
+              'reverse'):
+    if hasattr(list, _name):
+        setattr(FrozenList, _name, _read_only(_name, 'list'))
+
+
+class FrozenDict(ValidatedDict):
+    """
+    A read-only ValidatedDict. See FrozenList.
+    """
+
+    __slots__ = []  # type: typing.List[str]
+
+    def __reduce__(self):
+        return FrozenDict, (dict(self),)
+
+
+for _name in ('__setitem__', '__delitem__', '__ior__', 'clear', 'pop', 'popitem',
+              'setdefault', 'update'):
+    if hasattr(dict, _name):
+        setattr(FrozenDict, _name, _read_only(_name, 'map'))
+
+
+def freeze(validator, val):
+    """
+    Returns ``val``, which must have been validated by ``validator``, with
+    its lists and maps, including nested ones, made read-only. Classes
+    generated with --frozen-types store the values of their fields as
+    returned by this, since their encodings and hashes are memoized.
+
+    NumPy arrays are copied into read-only ones, unless their memory can't
+    be written to at all. Structs and unions are returned as is: they're
+    frozen themselves if their classes are generated with the same option.
+    """
+    if isinstance(validator, Nullable):
+        if val is None:
+            return None
+        validator = validator.validator
+    if isinstance(validator, List):
+        if isinstance(val, _array_types):
+            if not _is_immutable_array(val):
+                # A read-only view could still be modified through the
+                # caller's array, or be made writeable again.
+                val = val.copy()
+                val.flags.writeable = False
+            return val
+        elif isinstance(val, FrozenList) and val._validated_by is validator:
+            return val
+        item_validator = validator.item_validator
+        if _has_containers(item_validator):
+            val = [freeze(item_validator, item) for item in val]
+        return FrozenList(val, validator)
+    elif isinstance(validator, Map):
+        if isinstance(val, FrozenDict) and val._validated_by is validator:
+            return val
+        value_validator = validator.value_validator
+        if _has_containers(value_validator):
+            val = {key: freeze(value_validator, value) for key, value in val.items()}
+        return FrozenDict(val, validator)
+    return val
+
+
+def _is_immutable_array(val):
+    """
+    Whether the memory of the NumPy array ``val`` can't be written to through
+    it or any other object, like that of arrays read from bytes.
+    """
+    base = val
+    while isinstance(base, _array_types):
+        if base.flags.writeable:
+            return False
+        base = base.base
+    return isinstance(base, bytes) or (isinstance(base, memoryview) and base.readonly)
+
+
+def _has_containers(validator):
+    """
+    Whether values of ``validator`` may be lists or maps, for freeze().
+    """
+    if isinstance(validator, Nullable):
+        validator = validator.validator
+    return isinstance(validator, (List, Map))
+
+
 class List(Composite):
     """Assumes list contents are homogeneous with respect to types."""
 
@@ -401,7 +586,8 @@ class List(Composite):
         self.max_items = max_items
 
     def validate(self, val):
-        if not isinstance(val, (tuple, list)):
+        is_array = isinstance(val, _array_types)
+        if not (is_array or isinstance(val, (tuple, list))):
             raise ValidationError('%r is not a valid list' % val)
         elif self.max_items is not None and len(val) > self.max_items:
             raise ValidationError('%r has more than %s items'
@@ -409,7 +595,70 @@ class List(Composite):
         elif self.min_items is not None and len(val) < self.min_items:
             raise ValidationError('%r has fewer than %s items'
                                   % (val, self.min_items))
-        return [self.item_validator.validate(item) for item in val]
+        elif is_array:
+            return self._validate_array(val)
+        elif self.is_validated(val):
+            return ValidatedList(val, self)
+        return ValidatedList([self.item_validator.validate(item) for item in val], self)
+
+    def _validate_array(self, val):
+        """
+        Validates a NumPy array with the same checks as the item validator,
+        but on the whole array at once. The array is returned as is, except
+        that integer arrays are converted to float64 for lists of floats.
+        """
+        item_validator = self.item_validator
+        if val.ndim != 1:
+            raise ValidationError('expected a 1-dimensional array, got %d '
+                                  'dimensions' % val.ndim)
+        kind = val.dtype.kind
+        if isinstance(item_validator, Integer):
+            if kind not in 'iu':
+                raise ValidationError('expected integer array, got %s array'
+                                      % val.dtype)
+            if len(val):
+                for bound in (int(val.min()), int(val.max())):
+                    if not (item_validator.minimum <= bound <= item_validator.maximum):
+                        raise ValidationError(
+                            '%d is not within range [%d, %d]'
+                            % (bound, item_validator.minimum, item_validator.maximum))
+        elif isinstance(item_validator, Real):
+            if kind in 'iu':
+                val = val.astype(np.float64)
+            elif kind != 'f' or val.dtype.itemsize > 8:
+                raise ValidationError('expected float array, got %s array'
+                                      % val.dtype)
+            if len(val):
+                finite = np.isfinite(val)
+                if not finite.all():
+                    raise ValidationError('%f values are not supported'
+                                          % val[~finite][0])
+                lowest, highest = float(val.min()), float(val.max())
+                if item_validator.minimum is not None and lowest < item_validator.minimum:
+                    raise ValidationError('%f is not greater than %f' %
+                                          (lowest, item_validator.minimum))
+                if item_validator.maximum is not None and highest > item_validator.maximum:
+                    raise ValidationError('%f is not less than %f' %
+                                          (highest, item_validator.maximum))
+        else:
+            raise ValidationError('arrays are only supported for lists of '
+                                  'integers or floats')
+        return val
+
+    def is_validated(self, val):
+        """
+        Whether ``val`` was returned by validate() and hasn't been modified
+        since, so that it's known to pass validation.
+        """
+        return getattr(val, '_validated_by', None) is self
+
+    def validate_if_modified(self, val):
+        """
+        Like validate(), but returns ``val`` as is if ``is_validated(val)``.
+        """
+        if self.is_validated(val):
+            return val
+        return self.validate(val)
 
 
 class Map(Composite):
@@ -426,10 +675,94 @@ class Map(Composite):
     def validate(self, val):
         if not isinstance(val, dict):
             raise ValidationError('%r is not a valid dict' % val)
-        return {
+        elif self.is_validated(val):
+            return ValidatedDict(val, self)
+        return ValidatedDict({
             self.key_validator.validate(key):
                 self.value_validator.validate(value) for key, value in val.items()
-        }
+        }, self)
+
+    def is_validated(self, val):
+        """
+        See List.is_validated().
+        """
+        return getattr(val, '_validated_by', None) is self
+
+    def validate_if_modified(self, val):
+        """
+        See List.validate_if_modified().
+        """
+        if self.is_validated(val):
+            return val
+        return self.validate(val)
+
+
+class PermissionsView(object):
+    """
+    The fields and tags of a generated struct or union class as seen by a
+    caller with a given list of permissions, i.e. the public ones merged with
+    those of each permission. Use get_permissions_view() to get a cached
+    instance rather than merging them for every value.
+
+    Attributes:
+        all_fields (list): ``_all_fields_`` followed by the
+            ``_all_<permission>_fields_`` of each permission, in order.
+        all_field_names (frozenset): The names of ``all_fields``.
+        extra_field_names (tuple): The names of the permissioned fields only.
+        extra_required_mask (int): The ``_<permission>_required_mask`` of each
+            permission combined, or None if the class doesn't track the
+            presence of its fields with a bitmask.
+        tagmap (dict): ``_tagmap`` merged with each ``_<permission>_tagmap``.
+            The first permission with a tag takes precedence.
+    """
+
+    __slots__ = ['all_fields', 'all_field_names', 'extra_field_names',
+                 'extra_required_mask', 'tagmap']
+
+    def __init__(self, definition, permissions):
+        all_fields = list(getattr(definition, '_all_fields_', ()))
+        all_field_names = set(getattr(definition, '_all_field_names_', ()))
+        extra_field_names = []  # type: typing.List[typing.Text]
+        for permission in permissions:
+            all_fields.extend(getattr(definition, '_all_{}_fields_'.format(permission), ()))
+            field_names = getattr(definition, '_all_{}_field_names_'.format(permission), ())
+            all_field_names.update(field_names)
+            extra_field_names.extend(field_names)
+        if hasattr(definition, '_required_mask'):
+            extra_required_mask = 0
+            for permission in permissions:
+                extra_required_mask |= getattr(
+                    definition, '_{}_required_mask'.format(permission), 0)
+        else:
+            extra_required_mask = None
+        tagmap = dict(getattr(definition, '_tagmap', {}))
+        for permission in reversed(permissions):
+            tagmap.update(getattr(definition, '_{}_tagmap'.format(permission), {}))
+
+        self.all_fields = all_fields
+        self.all_field_names = frozenset(all_field_names)
+        self.extra_field_names = tuple(extra_field_names)
+        self.extra_required_mask = extra_required_mask
+        self.tagmap = tagmap
+
+
+_permissions_views = {}  # type: typing.Dict[typing.Tuple[typing.Any, typing.Tuple[typing.Text, ...]], PermissionsView] # noqa: E501
+
+
+def get_permissions_view(definition, permissions):
+    """
+    Returns the PermissionsView of ``definition`` for ``permissions``, a tuple
+    of permission names, creating it on first use.
+
+    Views are keyed by the permissions in order rather than by their set,
+    since the order determines the order of ``all_fields`` and with it the
+    order of the members of encoded structs.
+    """
+    key = (definition, permissions)
+    view = _permissions_views.get(key)
+    if view is None:
+        view = _permissions_views[key] = PermissionsView(definition, permissions)
+    return view
 
 
 class Struct(Composite):
@@ -476,9 +809,14 @@ class Struct(Composite):
         This method assumes that the contents of each field have already been
         validated on assignment, so it's merely a presence check.
 
-        FIXME(kelkabany): Since the definition object does not maintain a list
-        of which fields are required, all fields are scanned.
+        Generated classes carry a _required_mask, so this is a single bitmask
+        comparison unless a field is missing. Otherwise, all fields are
+        scanned to find the missing one.
         """
+        required_mask = getattr(self.definition, '_required_mask', None)
+        if required_mask is not None and \
+                val._present_mask & required_mask == required_mask:
+            return
         for field_name in self.definition._all_field_names_:
             if not hasattr(val, field_name):
                 raise ValidationError("missing required field '%s'" %
@@ -494,11 +832,14 @@ class Struct(Composite):
         self.validate_fields_only(val)
 
         # check if type has been patched
-        for extra_permission in caller_permissions.permissions:
-            all_field_names = '_all_{}_field_names_'.format(extra_permission)
-            for field_name in getattr(self.definition, all_field_names, set()):
-                if not hasattr(val, field_name):
-                    raise ValidationError("missing required field '%s'" % field_name)
+        view = get_permissions_view(self.definition, tuple(caller_permissions.permissions))
+        required_mask = view.extra_required_mask
+        if required_mask is not None and \
+                val._present_mask & required_mask == required_mask:
+            return
+        for field_name in view.extra_field_names:
+            if not hasattr(val, field_name):
+                raise ValidationError("missing required field '%s'" % field_name)
 
     def validate_type_only(self, val):
         """
@@ -621,32 +962,80 @@ class Nullable(Validator):
     def get_default(self):
         return None
 
+# Maximum number of results remembered by each Redactor.
+_REDACT_CACHE_SIZE = 1024
+
+
 class Redactor(object):
-    def __init__(self, regex):
+    def __init__(self, regex, cache_size=_REDACT_CACHE_SIZE):
         """
         Args:
             regex: What parts of the field to redact.
+            cache_size (int): How many of the most recently redacted values
+                to remember the result for.
         """
         self.regex = regex
+        self._pattern = re.compile(regex) if regex else None
+        # Only changed through single OrderedDict operations, which the GIL
+        # makes atomic, so that cache hits don't need to take a lock.
+        self._cache = collections.OrderedDict()  # type: typing.Dict[typing.Any, typing.Any]
+        self._cache_size = cache_size
+        if hasattr(self._cache, 'move_to_end'):
+            self._touch = self._cache.move_to_end
+        else:
+            self._touch = self._touch_py2
+
+    def _touch_py2(self, key):
+        self._cache[key] = self._cache.pop(key)
 
-    @abstractmethod
     def apply(self, val):
         """Redacts information from annotated field.
         Returns: A redacted version of the string provided.
         """
+        # The type is part of the key since equal values of different types,
+        # like 1 and True, are redacted differently.
+        key = (type(val), val)
+        cache = self._cache
+        try:
+            redacted = cache[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable
+            return self._redact(val)
+        else:
+            try:
+                self._touch(key)
+            except KeyError:
+                # Evicted by another thread in the meantime.
+                pass
+            return redacted
+        redacted = self._redact(val)
+        cache[key] = redacted
+        while len(cache) > self._cache_size:
+            try:
+                cache.popitem(last=False)
+            except KeyError:
+                # Emptied by another thread in the meantime.
+                break
+        return redacted
+
+    @abstractmethod
+    def _redact(self, val):
+        """Returns a redacted version of the string provided."""
         pass
 
     def _get_matches(self, val):
-        if not self.regex:
+        if self._pattern is None:
             return None
         try:
-            return re.search(self.regex, val)
+            return self._pattern.search(val)
         except TypeError:
             return None
 
 
 class HashRedactor(Redactor):
-    def apply(self, val):
+    def _redact(self, val):
         matches = self._get_matches(val)
 
         val_to_hash = str(val) if isinstance(val, int) or isinstance(val, float) else val
@@ -654,7 +1043,7 @@ class HashRedactor(Redactor):
         try:
             # add string literal to ensure unicode
             hashed = hashlib.md5(val_to_hash.encode('utf-8')).hexdigest() + ''
-        except [AttributeError, ValueError]:
+        except (AttributeError, ValueError):
             hashed = None
 
         if matches:
@@ -666,7 +1055,7 @@ class HashRedactor(Redactor):
 
 
 class BlotRedactor(Redactor):
-    def apply(self, val):
+    def _redact(self, val):
         matches = self._get_matches(val)
         if matches:
             return '***'.join(matches.groups())
@@ -27,6 +27,8 @@ from stone.ir import (
     is_alias,
     is_boolean_type,
     is_bytes_type,
+    is_float_type,
+    is_integer_type,
     is_list_type,
     is_map_type,
     is_nullable_type,
@@ -40,6 +42,7 @@ from stone.ir import (
     is_void_type,
     RedactedBlot,
     RedactedHash,
+    unwrap,
     unwrap_aliases,
     unwrap_nullable,
 )
@@ -71,6 +74,32 @@ _cmdline_parser.add_argument(
           '{route} for the route name. This is used to translate Stone doc '
           'references to routes to references in Python docstrings.'),
 )
+_cmdline_parser.add_argument(
+    '--specialize-serializers',
+    action='store_true',
+    help=('Generate a specialized _stone_encode and _stone_decode method for '
+          'each struct and union. stone_serializers uses them instead of '
+          'walking the reflection attributes when encoding or decoding '
+          'without caller permissions, redaction or alias validators.'),
+)
+_cmdline_parser.add_argument(
+    '--hashable-structs',
+    action='store_true',
+    help=('Generate a __hash__ method for each struct so that instances can '
+          'be used as dict keys and set members. The hash is cached until a '
+          'field is set or deleted. Otherwise, structs are unhashable since '
+          'they compare by value.'),
+)
+_cmdline_parser.add_argument(
+    '--frozen-types',
+    action='store_true',
+    help=('Generate immutable structs and unions. The fields of a struct can '
+          'only be set by its constructor or when it is decoded, and lists '
+          'and maps are stored read-only, as are NumPy arrays. Instances '
+          'are hashable, and memoize their hash and their encoding when '
+          'serialized without caller permissions, redaction or alias '
+          'validators.'),
+)
 
 
 class PythonTypesBackend(CodeBackend):
@@ -123,6 +152,10 @@ class PythonTypesBackend(CodeBackend):
 
         self.emit_raw(validators_import)
 
+        if self.args.specialize_serializers:
+            self.emit('import collections')
+            self.emit()
+
         # Generate import statements for all referenced namespaces.
         self._generate_imports_for_referenced_namespaces(namespace)
 
@@ -260,8 +293,16 @@ class PythonTypesBackend(CodeBackend):
 
             self._generate_struct_class_slots(data_type)
             self._generate_struct_class_has_required_fields(data_type)
+            if self.args.frozen_types:
+                self.emit('_is_frozen = True')
+                self.emit()
+            self._generate_class_has_redactions(data_type)
             self._generate_struct_class_init(data_type)
+            self._generate_struct_class_new_validated(data_type)
             self._generate_struct_class_properties(ns, data_type)
+            if self.args.specialize_serializers:
+                self._generate_struct_class_codecs(data_type)
+            self._generate_struct_class_eq(data_type)
             self._generate_struct_class_repr(data_type)
         if data_type.has_enumerated_subtypes():
             validator = 'StructTree'
@@ -285,17 +326,62 @@ class PythonTypesBackend(CodeBackend):
 
         Slots are an optimization in Python. They reduce the memory footprint
         of instances since attributes cannot be added after declaration.
+
+        The presence of every field is tracked by a single integer bitmask,
+        ``_present_mask``, which is declared by the root of a hierarchy only,
+        along with ``_lazy_fields``, the fields left to decode by a lazy
+        decode, and the slots used by --hashable-structs and --frozen-types.
         """
         with self.block('__slots__ =', delim=('[', ']')):
+            if not data_type.parent_type:
+                self.emit("'_present_mask',")
+                self.emit("'_lazy_fields',")
+                if self.args.frozen_types:
+                    self.emit("'_frozen',")
+                    self.emit("'_cached_encoding',")
+                if self._hashable_structs:
+                    self.emit("'_cached_hash',")
             for field in data_type.fields:
                 field_name = fmt_var(field.name)
                 self.emit("'_%s_value'," % field_name)
-                self.emit("'_%s_present'," % field_name)
+        self.emit()
+
+    def _generate_class_has_redactions(self, data_type):
+        """
+        Generated encoders and memoized encodings don't redact, so with
+        --specialize-serializers or --frozen-types, classes record whether
+        their values can contain redacted fields. Serializers only use those
+        for classes that can't when redacting.
+        """
+        if not (self.args.specialize_serializers or self.args.frozen_types):
+            return
+        self.emit('_has_redactions = {}'.format(_has_reachable_redactor(data_type)))
         self.emit()
 
     def _generate_struct_class_has_required_fields(self, data_type):
+        """
+        Generates _has_required_fields along with _required_mask, the bits of
+        ``_present_mask`` that must be set for an instance to be valid, and a
+        _<caller>_required_mask for each omitted caller with required fields.
+        _field_bits maps the name of each field to its bit, for code that sets
+        slots by field name.
+        """
         has_required_fields = len(data_type.all_required_fields) > 0
         self.emit('_has_required_fields = %r' % has_required_fields)
+        field_bits = _struct_field_bits(data_type)
+        required_masks = {}  # type: typing.Dict[typing.Optional[typing.Text], int]
+        for field in _struct_fields_with_ancestors(data_type):
+            if is_nullable_type(field.data_type) or field.has_default:
+                continue
+            required_masks[field.omitted_caller] = (
+                required_masks.get(field.omitted_caller, 0) | field_bits[field.name])
+        self.emit('_required_mask = %d' % required_masks.pop(None, 0))
+        for omitted_caller, mask in sorted(required_masks.items()):
+            self.emit('_%s_required_mask = %d' % (omitted_caller, mask))
+        self.generate_multiline_list(
+            ["'{}': {}".format(fmt_var(field.name), field_bits[field.name])
+             for field in _struct_fields_with_ancestors(data_type)],
+            before='_field_bits = ', delim=('{', '}'))
         self.emit()
 
     def _generate_struct_class_reflection_attributes(self, ns, data_type):
@@ -428,8 +514,29 @@ class PythonTypesBackend(CodeBackend):
                 self.generate_multiline_list(
                     items, before=before, delim=('[', ']'), compact=False)
 
+        self._generate_ordinals(class_name, '_ordinal_fields_', data_type)
         self.emit()
 
+    def _generate_ordinals(self, class_name, attribute_name, data_type):
+        """
+        Generates a list of (name, validator) for the public fields or tags
+        defined by a struct or union itself, excluding inherited ones, in the
+        order they're declared in the spec. The compact binary format
+        identifies fields and tags by their index in it, so new ones must only
+        be appended.
+        """
+        items = []
+        for field in data_type.fields:
+            if field.omitted_caller is not None:
+                continue
+            var_name = fmt_var(field.name)
+            items.append("('{}', {}._{}_validator)".format(var_name, class_name, var_name))
+        self.generate_multiline_list(
+            items,
+            before='{}.{} = '.format(class_name, attribute_name),
+            delim=('[', ']'),
+            compact=False)
+
     def _generate_struct_class_init(self, data_type):
         """
         Generates constructor. The constructor takes all possible fields as
@@ -454,12 +561,22 @@ class PythonTypesBackend(CodeBackend):
                 self.generate_multiline_list(
                     all_parent_fields,
                     before='super({}, self).__init__'.format(class_name))
+                if self.args.frozen_types:
+                    # The parent constructor froze the instance.
+                    self.emit('self._frozen = False')
 
             # initialize each field
+            if not data_type.parent_type:
+                self.emit('self._present_mask = 0')
+                self.emit('self._lazy_fields = None')
+                if self.args.frozen_types:
+                    self.emit('self._frozen = False')
+                    self.emit('self._cached_encoding = None')
+                if self._hashable_structs:
+                    self.emit('self._cached_hash = None')
             for field in data_type.fields:
                 field_var_name = fmt_var(field.name)
                 self.emit('self._{}_value = None'.format(field_var_name))
-                self.emit('self._{}_present = False'.format(field_var_name))
 
             # handle arguments that were set
             for field in data_type.fields:
@@ -468,10 +585,43 @@ class PythonTypesBackend(CodeBackend):
                 with self.indent():
                     self.emit('self.{0} = {0}'.format(field_var_name))
 
+            if self.args.frozen_types:
+                self.emit('self._frozen = True')
+
             if lineno == self.lineno:
                 self.emit('pass')
             self.emit()
 
+    def _generate_struct_class_new_validated(self, data_type):
+        """
+        Generates _new_validated(), which creates an instance from a dict of
+        field values by writing their slots directly rather than going
+        through the validating setters. It's used by trusted decodes. Like
+        the setters, it leaves fields with a value of None unset.
+        """
+        field_bits = _struct_field_bits(data_type)
+        self.emit('@classmethod')
+        self.emit('def _new_validated(cls, values):')
+        with self.indent():
+            self.emit('"""')
+            self.emit_wrapped_text(
+                'Creates an instance without the checks done by the setters. '
+                'Only use this when each of ``values``, a dict from field name '
+                'to value, has already been validated against its field.')
+            self.emit('"""')
+            self.emit('ins = cls()')
+            for field in _struct_fields_with_ancestors(data_type):
+                field_name = fmt_var(field.name)
+                self.emit("v = values.get('{}')".format(field_name))
+                self.emit('if v is not None:')
+                with self.indent():
+                    if self._is_frozen_container(field):
+                        self.emit('v = bv.freeze(cls._{}_validator, v)'.format(field_name))
+                    self.emit('ins._{}_value = v'.format(field_name))
+                    self.emit('ins._present_mask |= {}'.format(field_bits[field.name]))
+            self.emit('return ins')
+        self.emit()
+
     def _generate_python_value(self, ns, value):
         if is_tag_ref(value):
             ref = '{}.{}'.format(class_name_for_data_type(value.union_data_type),
@@ -486,8 +636,13 @@ class PythonTypesBackend(CodeBackend):
         """
         Each field of the struct has a corresponding setter and getter.
         The setter validates the value being set.
+
+        A read-only _<field>_present property is also generated for code that
+        checks the presence of fields by name rather than by bit.
         """
+        field_bits = _struct_field_bits(data_type)
         for field in data_type.fields:
+            field_bit = field_bits[field.name]
             field_name = fmt_func(field.name)
             field_name_reserved_check = fmt_func(field.name, check_reserved=True)
             if is_nullable_type(field.data_type):
@@ -511,7 +666,11 @@ class PythonTypesBackend(CodeBackend):
                 self.emit(':rtype: {}'.format(
                     self._python_type_mapping(ns, field_dt)))
                 self.emit('"""')
-                self.emit('if self._{}_present:'.format(field_name))
+                self.emit('if self._present_mask & {}:'.format(field_bit))
+                with self.indent():
+                    self.emit('return self._{}_value'.format(field_name))
+                self.emit("elif self._lazy_fields is not None and "
+                          "self._lazy_fields.load(self, '{}'):".format(fmt_var(field.name)))
                 with self.indent():
                     self.emit('return self._{}_value'.format(field_name))
 
@@ -533,6 +692,7 @@ class PythonTypesBackend(CodeBackend):
             self.emit('@{}.setter'.format(field_name_reserved_check))
             self.emit('def {}(self, val):'.format(field_name_reserved_check))
             with self.indent():
+                self._generate_struct_frozen_check()
                 if dt_nullable:
                     self.emit('if val is None:')
                     with self.indent():
@@ -541,19 +701,276 @@ class PythonTypesBackend(CodeBackend):
                 if is_user_defined_type(field_dt):
                     self.emit('self._%s_validator.validate_type_only(val)' %
                               field_name)
+                elif self._is_frozen_container(field):
+                    self.emit('val = bv.freeze(self._{0}_validator, '
+                              'self._{0}_validator.validate(val))'.format(field_name))
                 else:
                     self.emit('val = self._{}_validator.validate(val)'.format(field_name))
+                self._generate_struct_lazy_discard(field)
                 self.emit('self._{}_value = val'.format(field_name))
-                self.emit('self._{}_present = True'.format(field_name))
+                self.emit('self._present_mask |= {}'.format(field_bit))
+                if self._hashable_structs:
+                    self.emit('self._cached_hash = None')
             self.emit()
 
             # generate deleter for field
             self.emit('@{}.deleter'.format(field_name_reserved_check))
             self.emit('def {}(self):'.format(field_name_reserved_check))
             with self.indent():
+                self._generate_struct_frozen_check()
+                self._generate_struct_lazy_discard(field)
                 self.emit('self._{}_value = None'.format(field_name))
-                self.emit('self._{}_present = False'.format(field_name))
+                self.emit('self._present_mask &= ~{}'.format(field_bit))
+                if self._hashable_structs:
+                    self.emit('self._cached_hash = None')
+            self.emit()
+
+            self.emit('@property')
+            self.emit('def _{}_present(self):'.format(field_name))
+            with self.indent():
+                self.emit('return bool(self._present_mask & {})'.format(field_bit))
+            self.emit()
+
+    def _generate_struct_frozen_check(self):
+        """
+        With --frozen-types, emits a check that raises if a field is set or
+        deleted after construction.
+        """
+        if self.args.frozen_types:
+            self.emit('if self._frozen:')
+            with self.indent():
+                self.emit("raise AttributeError('cannot modify frozen %s' % "
+                          "type(self).__name__)")
+
+    def _is_frozen_container(self, field):
+        """
+        Whether the values of ``field`` are stored read-only by way of
+        bv.freeze(), which is the case of lists and maps with --frozen-types.
+        """
+        dt, _, _ = unwrap(field.data_type)
+        return self.args.frozen_types and (is_list_type(dt) or is_map_type(dt))
+
+    def _generate_struct_lazy_discard(self, field):
+        """
+        Emits code that keeps a field that's set or deleted from being
+        overwritten by a pending lazy decode of it.
+        """
+        self.emit('if self._lazy_fields is not None:')
+        with self.indent():
+            self.emit("self._lazy_fields.discard('{}')".format(fmt_var(field.name)))
+
+    def _generate_struct_load_all(self, var):
+        """
+        Emits code that decodes the fields left pending by a lazy decode of
+        the struct ``var``, for code that reads their slots directly.
+        """
+        self.emit('if {}._lazy_fields is not None:'.format(var))
+        with self.indent():
+            self.emit('{0}._lazy_fields.load_all({0})'.format(var))
+
+    @property
+    def _hashable_structs(self):
+        # Frozen structs are always hashable.
+        return self.args.hashable_structs or self.args.frozen_types
+
+    def _generate_struct_class_codecs(self, data_type):
+        """
+        Generates _stone_encode() and _stone_decode(), which stone_serializers
+        calls in place of its generic encode_struct() and decode_struct()
+        when there are no caller permissions, redaction or alias validators
+        involved. Only public fields are handled.
+
+        Fields are read and written through their slots directly. Values of
+        string, boolean and numeric fields are used as is, since they're
+        validated on assignment. Everything else is delegated back to the
+        serializer.
+        """
+        fields = _public_struct_fields(data_type)
+        field_bits = _struct_field_bits(data_type)
+
+        self.emit('@classmethod')
+        self.emit('def _stone_encode(cls, ser, val, d):')
+        with self.indent():
+            self._generate_struct_load_all('val')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                dt, nullable, _ = unwrap(field.data_type)
+                if nullable:
+                    self.emit('v = val._{}_value'.format(field_name))
+                    self.emit('if v is not None:')
+                else:
+                    self.emit('if val._present_mask & {}:'.format(field_bits[field.name]))
+                with self.indent():
+                    if not nullable:
+                        self.emit('v = val._{}_value'.format(field_name))
+                    self._generate_codec_encode_value(dt, field_name)
+                    self.emit("d['{0}'] = v".format(field_name))
+                if not nullable and not field.has_default:
+                    self.emit('else:')
+                    with self.indent():
+                        self.emit(
+                            "raise bv.ValidationError(\"missing required field '%s'\")"
+                            % field_name)
+            self.emit('return d')
+        self.emit()
+
+        self.emit('@classmethod')
+        self.emit('def _stone_decode(cls, dec, obj):')
+        with self.indent():
+            self.emit('ins = cls()')
+            if self.args.frozen_types:
+                self.emit('ins._frozen = False')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                dt, nullable, _ = unwrap(field.data_type)
+                self.emit("if '{}' in obj:".format(field_name))
+                with self.indent():
+                    self.emit("v = obj['{}']".format(field_name))
+                    if nullable:
+                        self.emit('if v is not None:')
+                        with self.indent():
+                            self._generate_struct_codec_decode_field(field, field_bits[field.name])
+                    else:
+                        self._generate_struct_codec_decode_field(field, field_bits[field.name])
+                if (not nullable and is_struct_type(dt) and
+                        not dt.all_required_fields):
+                    # Mirrors Struct.has_default() for the field's validator.
+                    self.emit('else:')
+                    with self.indent():
+                        self.emit('ins._{0}_value = cls._{0}_validator.get_default()'.format(
+                            field_name))
+                        self.emit('ins._present_mask |= {}'.format(field_bits[field.name]))
+            for field in fields:
+                if is_nullable_type(field.data_type) or field.has_default:
+                    continue
+                field_name = fmt_var(field.name)
+                self.emit('if not ins._present_mask & {}:'.format(field_bits[field.name]))
+                with self.indent():
+                    self.emit(
+                        "raise bv.ValidationError(\"missing required field '%s'\")"
+                        % field_name)
+            if self.args.frozen_types:
+                self.emit('ins._frozen = True')
+            self.emit('return ins')
+        self.emit()
+
+    def _generate_struct_codec_decode_field(self, field, field_bit):
+        """
+        Emits code to decode ``v`` and assign it to ``field`` of ``ins`` in a
+        generated _stone_decode().
+        """
+        field_name = fmt_var(field.name)
+        dt, nullable, _ = unwrap(field.data_type)
+        validator = 'cls._{}_validator'.format(field_name)
+        decode = 'dec.json_compat_obj_decode_helper({}, v)'.format(validator)
+        self.emit('try:')
+        with self.indent():
+            if nullable and not is_nullable_type(field.data_type):
+                # An alias to a nullable type isn't treated as nullable by
+                # the setter, so defer to it.
+                self.emit('ins.{} = {}'.format(fmt_var(field.name, True), decode))
+            else:
+                if is_user_defined_type(dt):
+                    value = decode
+                elif self._is_codec_inline_type(dt) or is_integer_type(dt):
+                    value = '{}.validate(v)'.format(validator)
+                else:
+                    value = '{}.validate({})'.format(validator, decode)
+                if self._is_frozen_container(field):
+                    value = 'bv.freeze({}, {})'.format(validator, value)
+                self.emit('ins._{}_value = {}'.format(field_name, value))
+                self.emit('ins._present_mask |= {}'.format(field_bit))
+        self.emit('except bv.ValidationError as e:')
+        with self.indent():
+            self.emit("e.add_parent('{}')".format(field_name))
+            self.emit('raise')
+
+    def _is_codec_inline_type(self, data_type):
+        """
+        Whether an already-validated value of this type encodes to itself.
+        """
+        return (is_string_type(data_type) or is_boolean_type(data_type) or
+                is_float_type(data_type))
+
+    def _generate_codec_encode_value(self, data_type, field_name):
+        """
+        Emits code to replace ``v`` with its encoding in a generated
+        _stone_encode().
+        """
+        if self._is_codec_inline_type(data_type):
+            return
+        elif is_integer_type(data_type):
+            # bool is a subclass of int, but must be encoded as an integer
+            self.emit('if isinstance(v, bool):')
+            with self.indent():
+                self.emit('v = int(v)')
+        else:
+            self.emit('try:')
+            with self.indent():
+                self.emit('v = ser.encode_sub(cls._{}_validator, v)'.format(field_name))
+            self.emit('except bv.ValidationError as e:')
+            with self.indent():
+                self.emit("e.add_parent('{}')".format(field_name))
+                self.emit('raise')
+
+    def _generate_struct_class_eq(self, data_type):
+        """
+        Generates __eq__() and __ne__(), which compare the presence and value
+        of every field, including those omitted for some callers. Instances
+        are only equal to instances of the same class, since a subtype may
+        have fields its super type doesn't know of. Lists of numbers are
+        compared with bb._values_equal() since they may hold NumPy arrays.
+
+        With --hashable-structs or --frozen-types, a __hash__() consistent
+        with them is generated as well. The hash is cached until a field is set or
+        deleted, and skips list and map fields since they aren't hashable.
+        Otherwise, __hash__ is set to None since instances are mutable.
+        """
+        class_name = class_name_for_data_type(data_type)
+        fields = _struct_fields_with_ancestors(data_type)
+
+        self.emit('def __eq__(self, other):')
+        with self.indent():
+            self.emit('if not isinstance(other, {}):'.format(class_name))
+            with self.indent():
+                self.emit('return NotImplemented')
+            self._generate_struct_load_all('self')
+            self._generate_struct_load_all('other')
+            self.generate_multiline_list(
+                ['type(self) is type(other)',
+                 'self._present_mask == other._present_mask'] +
+                [('bb._values_equal(self._{0}_value, other._{0}_value)'
+                  if _may_hold_array(f.data_type) else
+                  'self._{0}_value == other._{0}_value').format(fmt_var(f.name))
+                 for f in fields],
+                before='return ', delim=('(', ')'), sep=' and', skip_last_sep=True)
+        self.emit()
+
+        self.emit('def __ne__(self, other):')
+        with self.indent():
+            self.emit('return not self == other')
+        self.emit()
+
+        if not self._hashable_structs:
+            self.emit('__hash__ = None  # type: ignore')
             self.emit()
+            return
+
+        self.emit('def __hash__(self):')
+        with self.indent():
+            self.emit('if self._cached_hash is None:')
+            with self.indent():
+                self._generate_struct_load_all('self')
+                items = ['self._present_mask']
+                for f in fields:
+                    dt, _, _ = unwrap(f.data_type)
+                    if not (is_list_type(dt) or is_map_type(dt)):
+                        items.append('self._{}_value'.format(fmt_var(f.name)))
+                self.generate_multiline_list(
+                    items, before='self._cached_hash = hash',
+                    delim=('((', '))'), compact=False)
+            self.emit('return self._cached_hash')
+        self.emit()
 
     def _generate_struct_class_repr(self, data_type):
         """
@@ -569,6 +986,7 @@ class PythonTypesBackend(CodeBackend):
         self.emit('def __repr__(self):')
         with self.indent():
             if data_type.all_fields:
+                self._generate_struct_load_all('self')
                 constructor_kwargs_fmt = ', '.join(
                     '{}={{!r}}'.format(fmt_var(f.name, True))
                     for f in data_type.all_fields)
@@ -624,6 +1042,20 @@ class PythonTypesBackend(CodeBackend):
             delim=('{', '}'),
             compact=False)
 
+        # Generate _ordinal_subtypes_: List of (tag, validator) of the direct
+        # subtypes in the order they're enumerated. Used by the compact binary
+        # format, which identifies subtypes by their index in it.
+        items = []
+        for subtype_field in data_type.get_enumerated_subtypes():
+            items.append("('{}', {})".format(
+                subtype_field.name,
+                generate_validator_constructor(ns, subtype_field.data_type)))
+        self.generate_multiline_list(
+            items,
+            before='{}._ordinal_subtypes_ = '.format(data_type.name),
+            delim=('[', ']'),
+            compact=False)
+
         # Generate _is_catch_all_ attribute:
         self.emit('{}._is_catch_all_ = {!r}'.format(
             data_type.name, data_type.is_catch_all()))
@@ -673,16 +1105,69 @@ class PythonTypesBackend(CodeBackend):
             self.emit('"""')
             self.emit()
 
+            self._generate_union_class_slots(data_type)
+            if self.args.frozen_types:
+                self._generate_union_class_frozen_attributes(data_type)
+            self._generate_class_has_redactions(data_type)
             self._generate_union_class_vars(data_type)
             self._generate_union_class_variant_creators(ns, data_type)
             self._generate_union_class_is_set(data_type)
             self._generate_union_class_get_helpers(ns, data_type)
+            if self.args.specialize_serializers:
+                self._generate_union_class_codecs(data_type)
             self._generate_union_class_repr(data_type)
         self.emit('{0}_validator = bv.Union({0})'.format(
             class_name_for_data_type(data_type)
         ))
         self.emit()
 
+    def _generate_union_class_slots(self, data_type):
+        """
+        bb.Union only declares the _tag slot. The _value slot is declared by
+        the first class in a hierarchy with a tag that has a value, so unions
+        composed of only symbols don't carry one. With --frozen-types, the
+        root of a hierarchy also declares slots for its memoized hash and
+        encoding, which are left unset by bb.Union.__init__().
+        """
+        slots = []
+        if self.args.frozen_types and not data_type.parent_type:
+            slots.extend(['_cached_hash', '_cached_encoding'])
+        if (self._union_has_values(data_type) and
+                not (data_type.parent_type and
+                     self._union_has_values(data_type.parent_type))):
+            slots.append('_value')
+        self.emit('__slots__ = [{}]'.format(', '.join(repr(slot) for slot in slots)))
+        self.emit()
+
+    def _union_has_values(self, data_type):
+        return any(not is_void_type(field.data_type) for field in data_type.all_fields)
+
+    def _generate_union_class_frozen_attributes(self, data_type):
+        """
+        With --frozen-types, unions get a __hash__() that memoizes it. Like
+        that of structs, it skips list and map values since they aren't
+        hashable. Unions have no setters, so the only other thing to freeze
+        are those values, which bb.Union stores read-only given _is_frozen.
+        """
+        self.emit('_is_frozen = True')
+        self.emit()
+        if data_type.parent_type:
+            return
+        self.emit('def __hash__(self):')
+        with self.indent():
+            self.emit('try:')
+            with self.indent():
+                self.emit('return self._cached_hash')
+            self.emit('except AttributeError:')
+            with self.indent():
+                self.emit('value = self._value')
+                self.emit('if isinstance(value, (list, dict) + bv._array_types):')
+                with self.indent():
+                    self.emit('value = None')
+                self.emit('self._cached_hash = hash((self._tag, value))')
+                self.emit('return self._cached_hash')
+        self.emit()
+
     def _generate_union_class_vars(self, data_type):
         """
         Adds a _catch_all_ attribute to each class. Also, adds a placeholder
@@ -708,7 +1193,8 @@ class PythonTypesBackend(CodeBackend):
     def _generate_union_class_reflection_attributes(self, ns, data_type):
         """
         Adds a class attribute for each union member assigned to a validator.
-        Also adds an attribute that is a map from tag names to validators.
+        Also adds an attribute that is a map from tag names to validators, and
+        the merged table of all tags used by bb.Union.
         """
         class_name = fmt_class(data_type.name)
 
@@ -750,6 +1236,8 @@ class PythonTypesBackend(CodeBackend):
                     class_name_for_data_type(data_type.parent_type, ns))
                 )
 
+        self.emit('{0}._tag_table = {0}._build_tag_table()'.format(class_name))
+        self._generate_ordinals(class_name, '_ordinal_tags_', data_type)
         self.emit()
 
     def _generate_union_class_variant_creators(self, ns, data_type):
@@ -832,6 +1320,122 @@ class PythonTypesBackend(CodeBackend):
                     self.emit('return self._value')
                 self.emit()
 
+    def _generate_union_class_codecs(self, data_type):
+        """
+        Generates _stone_encode() and _stone_decode(), which stone_serializers
+        calls in place of its generic encode_union() and decode_union() when
+        there are no caller permissions, redaction or alias validators
+        involved. _stone_decode() only handles the object form of a public,
+        non-catch-all tag; the serializer checks that before calling it.
+        """
+        fields = [f for f in data_type.all_fields if f.omitted_caller is None]
+
+        self.emit('@classmethod')
+        self.emit('def _stone_encode(cls, ser, val):')
+        with self.indent():
+            self.emit('tag = val._tag')
+            for field in fields:
+                field_name = fmt_var(field.name)
+                dt, nullable, _ = unwrap(field.data_type)
+                self.emit("if tag == '{}':".format(field_name))
+                with self.indent():
+                    symbol = "return '{0}' if ser.old_style else {{'.tag': '{0}'}}".format(
+                        field_name)
+                    if is_void_type(dt):
+                        self.emit(symbol)
+                        continue
+                    self.emit('v = val._value')
+                    if nullable:
+                        self.emit('if v is None:')
+                        with self.indent():
+                            self.emit(symbol)
+                    self._generate_codec_encode_value(dt, field_name)
+                    self.emit('if ser.old_style:')
+                    with self.indent():
+                        self.emit("return {{'{}': v}}".format(field_name))
+                    if is_struct_type(dt) and not dt.has_enumerated_subtypes():
+                        self.emit('d = collections.OrderedDict()')
+                        self.emit("d['.tag'] = '{}'".format(field_name))
+                        self.emit('d.update(v)')
+                        self.emit('return d')
+                    else:
+                        self.emit("return collections.OrderedDict((('.tag', '{0}'), "
+                                  "('{0}', v)))".format(field_name))
+            self.emit("raise bv.ValidationError(\"caller does not have access to "
+                      "'{}' tag\".format(tag))")
+        self.emit()
+
+        self.emit('@classmethod')
+        self.emit('def _stone_decode(cls, dec, obj):')
+        with self.indent():
+            self.emit("tag = obj['.tag']")
+            for field in fields:
+                field_name = fmt_var(field.name)
+                dt, nullable, _ = unwrap(field.data_type)
+                validator = 'cls._{}_validator'.format(field_name)
+                inner_validator = validator + '.validator' if nullable else validator
+                self.emit("if tag == '{}':".format(field_name))
+                with self.indent():
+                    if is_void_type(dt):
+                        self.emit('if dec.strict:')
+                        with self.indent():
+                            self.emit("if obj.get('{}') is not None:".format(field_name))
+                            with self.indent():
+                                self.emit("raise bv.ValidationError('expected null, got %s' %")
+                                self.emit("                         "
+                                          "bv.generic_type_name(obj['{}']))".format(field_name))
+                            self._generate_codec_unexpected_keys_check(field_name)
+                        self.emit("return cls._get_symbol('{}')".format(field_name))
+                        continue
+                    if is_struct_type(dt) and not dt.has_enumerated_subtypes():
+                        if nullable:
+                            self.emit('if len(obj) == 1:')
+                            with self.indent():
+                                self.emit("return cls._new_validated('{}')".format(field_name))
+                        self.emit('try:')
+                        with self.indent():
+                            self.emit('v = dec.json_compat_obj_decode_helper({}, obj)'.format(
+                                inner_validator))
+                        self.emit('except bv.ValidationError as e:')
+                        with self.indent():
+                            self.emit("e.add_parent('{}')".format(field_name))
+                            self.emit('raise')
+                        self.emit("return cls._new_validated('{}', v)".format(field_name))
+                        continue
+                    self.emit("if '{}' in obj:".format(field_name))
+                    with self.indent():
+                        self.emit("v = obj['{}']".format(field_name))
+                        if not (self._is_codec_inline_type(dt) or is_integer_type(dt)):
+                            self.emit('try:')
+                            with self.indent():
+                                self.emit('v = dec.json_compat_obj_decode_helper({}, v)'.format(
+                                    inner_validator))
+                            self.emit('except bv.ValidationError as e:')
+                            with self.indent():
+                                self.emit("e.add_parent('{}')".format(field_name))
+                                self.emit('raise')
+                    self.emit('else:')
+                    with self.indent():
+                        if nullable:
+                            self.emit('v = None')
+                        else:
+                            self.emit("raise bv.ValidationError(\"missing '{}' key\")".format(
+                                field_name))
+                    self._generate_codec_unexpected_keys_check(field_name)
+                    if not is_user_defined_type(dt):
+                        # Same validation as bb.Union.__init__()
+                        self.emit('{}.validate(v)'.format(validator))
+                    self.emit("return cls._new_validated('{}', v)".format(field_name))
+            self.emit("raise bv.ValidationError(\"unknown tag '%s'\" % tag)")
+        self.emit()
+
+    def _generate_codec_unexpected_keys_check(self, field_name):
+        self.emit('for key in obj:')
+        with self.indent():
+            self.emit("if key != '{}' and key != '.tag':".format(field_name))
+            with self.indent():
+                self.emit("raise bv.ValidationError(\"unexpected key '%s'\" % key)")
+
     def _generate_union_class_repr(self, data_type):
         """
         The __repr__() function will return a string of the class name, and
@@ -898,6 +1502,83 @@ class PythonTypesBackend(CodeBackend):
         elif isinstance(redactor, RedactedBlot):
             self.emit("{}._redact = bv.BlotRedactor({})".format(validator_name, regex))
 
+def _has_reachable_redactor(data_type):
+    """
+    Whether a field or alias with a redactor is reachable from a struct or
+    union, through its fields, the data types they contain and the enumerated
+    subtypes of structs.
+    """
+    seen = set()
+    stack = [data_type]
+    while stack:
+        dt = stack.pop()
+        if id(dt) in seen:
+            continue
+        seen.add(id(dt))
+        if is_alias(dt):
+            if dt.redactor:
+                return True
+            stack.append(dt.data_type)
+        elif is_nullable_type(dt) or is_list_type(dt):
+            stack.append(dt.data_type)
+        elif is_map_type(dt):
+            stack.extend([dt.key_data_type, dt.value_data_type])
+        elif is_struct_type(dt) or is_union_type(dt):
+            for field in dt.all_fields:
+                if field.redactor:
+                    return True
+                stack.append(field.data_type)
+            if is_struct_type(dt) and dt.has_enumerated_subtypes():
+                stack.extend(subtype.data_type for subtype in dt.get_enumerated_subtypes())
+    return False
+
+
+def _public_struct_fields(data_type):
+    """
+    Returns the fields of a struct that are visible to every caller, in the
+    same order as the generated ``_all_fields_`` attribute.
+    """
+    if data_type.parent_type:
+        fields = _public_struct_fields(data_type.parent_type)
+    else:
+        fields = []
+    return fields + [f for f in data_type.fields if f.omitted_caller is None]
+
+
+def _struct_fields_with_ancestors(data_type):
+    """
+    Returns the fields of a struct, including those of its super types and
+    those omitted for some callers, with the fields of super types first.
+    """
+    if data_type.parent_type:
+        fields = _struct_fields_with_ancestors(data_type.parent_type)
+    else:
+        fields = []
+    return fields + list(data_type.fields)
+
+
+def _may_hold_array(data_type):
+    """
+    Whether a field of this type may hold a NumPy array, i.e. whether it's a
+    list of integers or floats.
+    """
+    data_type = unwrap(data_type)[0]
+    if not is_list_type(data_type):
+        return False
+    item_type = unwrap_aliases(data_type.data_type)[0]
+    return is_integer_type(item_type) or is_float_type(item_type)
+
+
+def _struct_field_bits(data_type):
+    """
+    Returns a dict from the name of each field of a struct, including
+    inherited ones, to its bit in ``_present_mask``. A field has the same bit
+    in a struct and in all of its subtypes.
+    """
+    return {field.name: 1 << i
+            for i, field in enumerate(_struct_fields_with_ancestors(data_type))}
+
+
 def generate_validator_constructor(ns, data_type):
     """
     Given a Stone data type, returns a string that can be used to construct
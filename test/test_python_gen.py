@@ -3,20 +3,30 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import base64
+import copy
 import datetime
+import hashlib
+import io
 import json
 import shutil
 import six
+import socket
+import struct
 import subprocess
 import sys
+import threading
 import unittest
 
 import stone.backends.python_rsrc.stone_validators as bv
 
 from stone.backends.python_rsrc.stone_serializers import (
     CallerPermissionsInterface,
+    StdlibJsonCodec,
+    get_json_codec,
     json_encode,
     json_decode,
+    register_json_codec,
+    set_default_json_codec,
     _strftime as stone_strftime,
 )
 
@@ -165,6 +175,56 @@ class TestDropInModules(unittest.TestCase):
         # Passes
         l1.validate(['a'])
 
+    def test_redactors(self):
+        blot = bv.BlotRedactor('(.)[^@]*(@.*)', cache_size=2)
+        self.assertEqual(blot.apply('jane@example.com'), 'j***@example.com')
+        self.assertEqual(blot.apply('no address'), '********')
+        self.assertEqual(blot.apply(None), '********')
+        h = bv.HashRedactor(None)
+        self.assertEqual(h.apply('x'), hashlib.md5(b'x').hexdigest())
+        self.assertEqual(h.apply(1), hashlib.md5(b'1').hexdigest())
+        self.assertEqual(h.apply(True), hashlib.md5(b'True').hexdigest())
+        self.assertEqual(h.apply(1.5), hashlib.md5(b'1.5').hexdigest())
+        self.assertIsNone(h.apply(None))
+
+        # The most recently used results are remembered
+        calls = []
+        redact = blot._redact
+        blot._redact = lambda val: calls.append(val) or redact(val)
+        blot._cache.clear()
+        for val in ['a@x', 'b@x', 'a@x', 'c@x', 'a@x', 'b@x']:
+            self.assertEqual(blot.apply(val), val[0] + '***@x')
+        self.assertEqual(calls, ['a@x', 'b@x', 'c@x', 'b@x'])
+        self.assertEqual(len(blot._cache), 2)
+
+    def test_validated_containers(self):
+        l1 = bv.List(bv.String(max_length=1))
+        validated = l1.validate(['a', 'b'])
+        self.assertIsInstance(validated, bv.ValidatedList)
+        self.assertEqual(validated, ['a', 'b'])
+        self.assertTrue(l1.is_validated(validated))
+        self.assertFalse(bv.List(bv.String()).is_validated(validated))
+        self.assertIs(l1.validate_if_modified(validated), validated)
+        # Any modification drops the mark, so the list is validated again
+        for modify in (lambda l: l.append('c'), lambda l: l.__setitem__(0, 'cc'),
+                       lambda l: l.sort(), lambda l: l.pop()):
+            validated = l1.validate(['a', 'b'])
+            modify(validated)
+            self.assertFalse(l1.is_validated(validated))
+        validated = l1.validate(['a'])
+        validated += ['bb']
+        self.assertRaises(bv.ValidationError, lambda: l1.validate_if_modified(validated))
+        # Copies are plain lists
+        self.assertIs(type(copy.copy(l1.validate(['a']))), list)
+
+        m = bv.Map(bv.String(), bv.Int32())
+        validated = m.validate({'a': 1})
+        self.assertIsInstance(validated, bv.ValidatedDict)
+        self.assertTrue(m.is_validated(validated))
+        validated.update(b='x')
+        self.assertFalse(m.is_validated(validated))
+        self.assertRaises(bv.ValidationError, lambda: m.validate_if_modified(validated))
+
     def test_map_validator(self):
         m = bv.Map(bv.String(pattern="^foo.*"), bv.String(pattern=".*bar$"))
 
@@ -206,6 +266,32 @@ class TestDropInModules(unittest.TestCase):
         s = bv.Struct(C)
         self.assertRaises(bv.ValidationError, lambda: s.validate(object()))
 
+    def test_iso_8601_timestamps(self):
+        fmt = '%Y-%m-%dT%H:%M:%SZ'
+        t = bv.Timestamp(fmt)
+        for dt in (datetime.datetime(2017, 1, 2, 3, 4, 5),
+                   datetime.datetime(2017, 12, 31, 23, 59, 59, 999999),
+                   datetime.datetime(1000, 1, 1),
+                   datetime.datetime(9999, 12, 31)):
+            for _ in range(2):  # The second time hits the cache
+                self.assertEqual(json_encode(t, dt), json.dumps(dt.strftime(fmt)))
+                self.assertEqual(json_decode(t, json.dumps(dt.strftime(fmt))),
+                                 datetime.datetime.strptime(dt.strftime(fmt), fmt))
+
+        for s in ('2017-1-2T3:4:5Z', '2017-01-02T03:04:05.5Z', '2017-02-30T00:00:00Z',
+                  '2017-01-02T24:00:00Z', '0000-01-01T00:00:00Z', '2017-01-02 03:04:05',
+                  '\u0662017-01-02T03:04:05Z'):
+            try:
+                expected = datetime.datetime.strptime(s, fmt)
+            except ValueError as e:
+                with self.assertRaises(bv.ValidationError) as cm:
+                    json_decode(t, json.dumps(s))
+                self.assertEqual(str(cm.exception), e.args[0])
+            else:
+                self.assertEqual(json_decode(t, json.dumps(s)), expected)
+        with self.assertRaises(bv.ValidationError):
+            json_decode(t, '12')
+
     def test_json_encoder(self):
         self.assertEqual(json_encode(bv.Void(), None), json.dumps(None))
         self.assertEqual(json_encode(bv.String(), 'abc'), json.dumps('abc'))
@@ -225,6 +311,37 @@ class TestDropInModules(unittest.TestCase):
         self.assertEqual(json_encode(bv.Nullable(bv.String()), None), json.dumps(None))
         self.assertEqual(json_encode(bv.Nullable(bv.String()), u'abc'), json.dumps('abc'))
 
+    def test_json_codecs(self):
+        v = bv.Map(bv.String(), bv.List(bv.Nullable(bv.UInt64())))
+        value = {u'\u2650': [2**64 - 1, None, 0]}
+        for codec in ('json', 'orjson', get_json_codec('json')):
+            encoded = json_encode(v, value, json_codec=codec, as_bytes=True)
+            self.assertIsInstance(encoded, bytes)
+            self.assertEqual(json.loads(encoded.decode('utf-8')), value)
+            self.assertEqual(json.loads(json_encode(v, value, json_codec=codec)), value)
+            for data in (encoded, bytearray(encoded), memoryview(encoded),
+                         encoded.decode('utf-8')):
+                self.assertEqual(json_decode(v, data, json_codec=codec), value)
+            with self.assertRaises(bv.ValidationError) as cm:
+                json_decode(v, b'{"a": [1', json_codec=codec)
+            self.assertEqual('could not decode input as JSON', str(cm.exception))
+        self.assertRaises(ValueError, lambda: get_json_codec('nope'))
+
+        class UpperCodec(StdlibJsonCodec):
+            name = 'upper'
+
+            def dumps(self, obj):
+                return super(UpperCodec, self).dumps(obj).upper()
+
+        register_json_codec(UpperCodec())
+        try:
+            self.assertEqual(json_encode(bv.String(), 'abc', json_codec='upper'), '"ABC"')
+            set_default_json_codec('upper')
+            self.assertEqual(json_encode(bv.String(), 'abc'), '"ABC"')
+        finally:
+            set_default_json_codec('json')
+        self.assertEqual(json_encode(bv.String(), 'abc'), '"abc"')
+
     def test_json_encoder_union(self):
         # pylint: disable=attribute-defined-outside-init
         class S(object):
@@ -668,6 +785,15 @@ struct E
     b UInt64 = 10
     c Int64?
 
+struct Histogram
+    counts List(UInt32)
+    bounds List(Float64)
+
+struct Listing
+    entries List(D)
+    resources List(Resource)
+    cursor String
+
 struct DocTest
     b Boolean
         "If :val:`true` then..."
@@ -711,6 +837,9 @@ union V
 struct S
     f String
 
+struct VHolder
+    v V
+
 struct Resource
     union_closed
         file File
@@ -738,6 +867,19 @@ struct File2 extends ResourceLax
 struct Folder2 extends ResourceLax
     "Regular folder"
 
+struct Shape
+    union_closed
+        circle Circle
+        square Square
+
+struct Circle extends Shape
+    size Float64
+    label String(max_length=8)
+
+struct Square extends Shape
+    size String
+    label String(max_length=8)
+
 struct ImportTestS extends ns2.BaseS
     a String
 
@@ -763,6 +905,24 @@ struct ContainsAlias
 
 struct S3
     u ns2.BaseU = z
+
+union_closed Symbols
+    a
+    b
+
+union_closed SymbolsWithValue extends Symbols
+    c String
+
+annotation Secret = RedactedBlot("(.)[^@]*(@.*)")
+
+alias Email = String
+    @Secret
+
+struct Contact
+    email Email
+
+union_closed ContactList
+    contacts List(Contact)
 """
 
 test_ns2_spec = """\
@@ -1390,6 +1550,278 @@ class TestGeneratedPython(unittest.TestCase):
         self.assertFalse(s.has_default())
         self.assertRaises(AssertionError, s.get_default)
 
+    def test_struct_equality(self):
+        a = self.ns.A(a='x', b=1)
+        self.assertEqual(a, self.ns.A(a='x', b=1))
+        self.assertFalse(a != self.ns.A(a='x', b=1))
+        self.assertNotEqual(a, self.ns.A(a='x', b=2))
+        self.assertNotEqual(a, self.ns.A(a='x'))
+        # Instances of a subtype are never equal to those of its super type
+        self.assertNotEqual(a, self.ns.B(a='x', b=1))
+        self.assertNotEqual(self.ns.B(a='x', b=1), a)
+        self.assertNotEqual(a, 'x')
+
+        # Explicitly setting a default is a difference, as it's serialized
+        self.assertEqual(self.ns.E(), self.ns.E())
+        self.assertNotEqual(self.ns.E(), self.ns.E(a='test'))
+
+        # Nested values compare by value as well
+        self.assertEqual(self.ns.D(a='x', d=[1, None], e={'k': 'v'}),
+                         self.ns.D(a='x', d=[1, None], e={'k': 'v'}))
+        self.assertNotEqual(self.ns.D(a='x', d=[1, None], e={'k': 'v'}),
+                            self.ns.D(a='x', d=[1, None], e={'k': None}))
+
+    def test_lazy_decoding(self):
+        validator = self.sv.Struct(self.ns.C)
+        c = self.compat_obj_decode(
+            validator, {'a': 'x', 'b': 1, 'c': 'eQ==', 'd': 'nope'}, lazy=True)
+        # Fields are decoded on first access
+        self.assertEqual(c._present_mask, 0)
+        self.assertEqual(c.c, b'y')
+        self.assertEqual(c._present_mask, 0b100)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            c.d  # pylint: disable=pointless-statement
+        self.assertEqual("d: expected real number, got string", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError):
+            self.ss.force(c)
+        # Fields that are set aren't overwritten by their pending decode
+        c.a = 'z'
+        c.d = 1.5
+        self.ss.force(c)
+        self.assertEqual(repr(c), "C(a='z', b=1, c=b'y', d=1.5)"
+                         if six.PY3 else "C(a=u'z', b=1L, c='y', d=1.5)")
+        del c.b
+        with self.assertRaises(AttributeError):
+            c.b  # pylint: disable=pointless-statement
+
+        # Missing required fields are reported right away
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_decode(validator, {'a': 'x', 'b': 1, 'c': 'eQ=='}, lazy=True)
+        self.assertEqual("missing required field 'd'", str(cm.exception))
+
+        # Lazily decoded values are equal to eagerly decoded ones
+        obj = {'a': 'x', 'c': 'y', 'd': [1, None], 'e': {'k': 'v'}}
+        d = self.compat_obj_decode(self.sv.Struct(self.ns.D), obj, lazy=True)
+        self.assertEqual(d, self.compat_obj_decode(self.sv.Struct(self.ns.D), obj))
+        self.assertEqual(self.compat_obj_encode(self.sv.Struct(self.ns.D), d), obj)
+
+        # force() decodes nested values and reports the path of errors
+        s2 = self.compat_obj_decode(
+            self.sv.List(self.sv.Struct(self.ns.S2)), [{'f1': {'f1': 1}}], lazy=True)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.force(s2)
+        self.assertEqual("f1.f1: '1' expected to be a string, got integer", str(cm.exception))
+
+    def test_lazy_decoding_threads(self):
+        c = self.compat_obj_decode(
+            self.sv.Struct(self.ns.C), {'a': 'x', 'b': 1, 'c': 'eQ==', 'd': 1.5}, lazy=True)
+        decoding = threading.Event()
+        resume = threading.Event()
+        decoder = c._lazy_fields.decoder
+
+        class BlockingDecoder(object):
+            _get_setter_validate = decoder._get_setter_validate
+
+            def json_compat_obj_decode_helper(self, data_type, obj):
+                decoding.set()
+                resume.wait()
+                return decoder.json_compat_obj_decode_helper(data_type, obj)
+
+        c._lazy_fields.decoder = BlockingDecoder()
+        results = []
+
+        def read():
+            results.append(c.d)
+        threads = [threading.Thread(target=read) for _ in range(2)]
+        for thread in threads:
+            thread.daemon = True
+        try:
+            threads[0].start()
+            decoding.wait()
+            # A thread reading the field while it's decoded waits for it
+            threads[1].start()
+            threads[1].join(0.1)
+            self.assertTrue(threads[1].is_alive())
+        finally:
+            resume.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1.5, 1.5])
+
+    def test_union_tag_tables(self):
+        # Unions that set their tagmaps without building their tag table have
+        # it built on first use, rather than using that of their parent
+        class Handwritten(self.ns.bb.Union):
+            _tagmap = {'a': self.sv.String(), 'b': self.sv.Void()}
+            _catch_all = None
+        validator = self.sv.Union(Handwritten)
+        self.assertEqual(Handwritten('a', 'x')._value, 'x')
+        self.assertTrue(Handwritten._is_tag_present('b', CallerPermissionsTest([])))
+        self.assertEqual(self.compat_obj_encode(validator, Handwritten('a', 'x')),
+                         {'.tag': 'a', 'a': 'x'})
+        self.assertEqual(self.compat_obj_decode(validator, 'b'), Handwritten('b'))
+
+        class Extended(self.ns.V):
+            _tagmap = dict(self.ns.V._tagmap, t99=self.sv.String())
+        self.assertEqual(Extended('t99', 'x')._value, 'x')
+        self.assertEqual(Extended('t1', 'x')._value, 'x')
+        with self.assertRaises(AssertionError):
+            self.ns.V('t99', 'x')
+
+    def test_trusted_decoding(self):
+        values = [
+            (self.sv.Struct(self.ns.D), {'a': 'A', 'c': None, 'd': [None, 1], 'e': {'one': None}}),
+            (self.sv.Struct(self.ns.C), {'a': 'A', 'b': 1, 'c': 'AA==', 'd': 1.5}),
+            (self.sv.Struct(self.ns.S2), {}),
+            (self.sv.StructTree(self.ns.Resource), {'.tag': 'file', 'name': 'n', 'size': 1}),
+            (self.sv.Union(self.ns.V), 't0'),
+            (self.sv.Union(self.ns.V), {'.tag': 't3', 'f': 'a'}),
+            (self.sv.Union(self.ns.V), {'.tag': 't10', 't10': ['t0', 't2']}),
+        ]
+        for use_plans in (False, True):
+            # Valid input decodes the same as without trusted
+            for data_type, obj in values:
+                decoded = self.compat_obj_decode(data_type, obj, trusted=True,
+                                                 use_plans=use_plans)
+                self.assertEqual(decoded, self.compat_obj_decode(data_type, obj))
+                self.assertEqual(self.compat_obj_encode(data_type, decoded),
+                                 self.compat_obj_encode(data_type, self.compat_obj_decode(
+                                     data_type, obj)))
+
+            # Neither values nor the presence of required fields are checked
+            s = self.compat_obj_decode(self.sv.Struct(self.ns.ContainsAlias), {'s': 'x' * 20},
+                                       trusted=True, use_plans=use_plans)
+            self.assertEqual(s.s, 'x' * 20)
+            a = self.decode(self.sv.Struct(self.ns.A), json.dumps({'a': 'x'}),
+                            trusted=True, use_plans=use_plans)
+            self.assertEqual(a._present_mask, 0b1)
+            with self.assertRaises(AttributeError):
+                a.b  # pylint: disable=pointless-statement
+            v = self.compat_obj_decode(self.sv.Union(self.ns.V), {'.tag': 't1', 't1': 1},
+                                       trusted=True, use_plans=use_plans)
+            self.assertEqual(v.get_t1(), 1)
+
+            # Malformed input is still rejected
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.compat_obj_decode(self.sv.Union(self.ns.V), {'.tag': 'zzz'},
+                                       trusted=True, use_plans=use_plans)
+            self.assertEqual("unknown tag 'zzz'", str(cm.exception))
+            with self.assertRaises(self.sv.ValidationError):
+                self.compat_obj_decode(self.sv.Struct(self.ns.C), {'a': 'A', 'c': 1},
+                                       trusted=True, use_plans=use_plans)
+
+    def test_union_symbols(self):
+        v_validator = self.sv.Union(self.ns.V)
+        for use_plans in (False, True):
+            for trusted in (False, True):
+                for obj, old_style in (('t0', False), ({'.tag': 't0'}, False),
+                                       ('t0', True), ({'t0': None}, True)):
+                    self.assertIs(self.compat_obj_decode(v_validator, obj, old_style=old_style,
+                                                         trusted=trusted, use_plans=use_plans),
+                                  self.ns.V.t0)
+                # Inherited symbols decode to an instance of the class itself
+                u = self.compat_obj_decode(self.sv.Union(self.ns.UOpen), 't0',
+                                           use_plans=use_plans, trusted=trusted)
+                self.assertIs(type(u), self.ns.UOpen)
+                self.assertIs(u, self.compat_obj_decode(
+                    self.sv.Union(self.ns.UOpen), {'.tag': 't0'}, use_plans=use_plans))
+                # Tags with a nullable value aren't shared
+                t2 = self.compat_obj_decode(v_validator, 't2', use_plans=use_plans,
+                                            trusted=trusted)
+                self.assertTrue(t2.is_t2())
+                self.assertIsNot(t2, self.compat_obj_decode(v_validator, 't2'))
+
+        # Unions composed of only symbols have no _value slot
+        self.assertNotIn('_value', self.ns.Symbols.__slots__)
+        self.assertIsNone(self.ns.Symbols.a._value)
+        self.assertEqual(self.ns.Symbols.a, self.ns.Symbols('a'))
+        with self.assertRaises(AttributeError):
+            self.ns.Symbols.a.x = 1
+        self.assertIn('_value', self.ns.SymbolsWithValue.__slots__)
+        self.assertEqual(self.ns.SymbolsWithValue.c('x').get_c(), 'x')
+        self.assertIsNone(self.ns.SymbolsWithValue('a')._value)
+        self.assertIn('_value', self.ns.U.__slots__)
+        self.assertEqual(self.ns.UOpen.__slots__, [])
+
+    def test_validated_list_fields(self):
+        d = self.ns.D(a='x', d=[1, None], e={'k': 'v'})
+        validator = self.sv.Struct(self.ns.D)
+        list_validator = self.ns.D._d_validator
+        map_validator = self.ns.D._e_validator
+        self.assertTrue(list_validator.is_validated(d.d))
+        self.assertTrue(map_validator.is_validated(d.e))
+
+        # Fields that haven't been modified since they were set aren't
+        # validated again.
+        def fail(val):
+            raise AssertionError('validated %r' % val)
+        list_validator.validate = map_validator.validate = fail
+        try:
+            for use_plans in (False, True):
+                self.assertEqual(
+                    self.compat_obj_encode(validator, d, use_plans=use_plans),
+                    {'a': 'x', 'd': [1, None], 'e': {'k': 'v'}})
+        finally:
+            del list_validator.validate
+            del map_validator.validate
+
+        # Modified ones are.
+        d.d.append('x')
+        d.e['k'] = 1
+        for use_plans in (False, True):
+            with self.assertRaises(self.sv.ValidationError):
+                self.compat_obj_encode(validator, d, use_plans=use_plans)
+        del d.d[-1]
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.encode(validator, d)
+        self.assertEqual("e: '1' expected to be a string, got integer", str(cm.exception))
+
+        # Validated lists of strings are copied as is.
+        l1 = self.sv.List(self.sv.String(pattern='[a-z]+'))
+        validated = l1.validate(['a', 'b'])
+        for use_plans in (False, True):
+            encoded = self.compat_obj_encode(l1, validated, use_plans=use_plans)
+            self.assertIs(type(encoded), list)
+            self.assertEqual(encoded, ['a', 'b'])
+        validated[0] = 'A'
+        with self.assertRaises(self.sv.ValidationError):
+            self.compat_obj_encode(l1, validated, use_plans=True)
+
+    def test_presence_bitmask(self):
+        # Presence is tracked by a single slot declared by the root struct
+        self.assertIn('_present_mask', self.ns.A.__slots__)
+        self.assertNotIn('_present_mask', self.ns.C.__slots__)
+        self.assertEqual(self.ns.C.__slots__, ['_d_value'])
+
+        # Fields keep their bits in subtypes, required ones (a, b, c, d) are
+        # in the mask, defaults and nullable ones aren't.
+        self.assertEqual(self.ns.A._required_mask, 0b11)
+        self.assertEqual(self.ns.C._required_mask, 0b1111)
+        self.assertEqual(self.ns.D._required_mask, 0b11001)
+        self.assertEqual(self.ns.E._required_mask, 0)
+
+        c = self.ns.C(a='x', b=1, d=1.5)
+        self.assertEqual(c._present_mask, 0b1011)
+        self.assertTrue(c._a_present)
+        self.assertFalse(c._c_present)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.sv.Struct(self.ns.C).validate(c)
+        self.assertEqual("missing required field 'c'", str(cm.exception))
+        c.c = b'y'
+        self.sv.Struct(self.ns.C).validate(c)
+        # A subtype validates as its super type against the same bits
+        self.sv.Struct(self.ns.A).validate(c)
+        del c.a
+        self.assertEqual(c._present_mask, 0b1110)
+        with self.assertRaises(self.sv.ValidationError):
+            self.sv.Struct(self.ns.A).validate(c)
+
+        e = self.ns.E(c=None)
+        self.assertEqual(e._present_mask, 0)
+        self.assertEqual(e.a, 'test')
+        e.c = 3
+        self.assertEqual(e._present_mask, 0b100)
+
     def tearDown(self):
         # Clear output of stone tool after all tests.
         shutil.rmtree('output')
@@ -1403,6 +1835,7 @@ class TestGeneratedPython(unittest.TestCase):
             from stone_serializers import (
                 msgpack_encode,
                 msgpack_decode,
+                msgpack_decode_iter,
             )
         except ImportError:
             return
@@ -1424,6 +1857,440 @@ class TestGeneratedPython(unittest.TestCase):
         u2 = msgpack_decode(self.sv.String(), s)
         self.assertEqual(u, u2)
 
+        # Bytes are packed as bin rather than base64
+        self.assertEqual(msgpack_encode(self.sv.Bytes(), bs), b'\xc4\x02\x00\x01')
+        self.assertEqual(msgpack_encode(self.sv.Struct(self.ns.B), b, use_plans=True),
+                         msgpack_encode(self.sv.Struct(self.ns.B), b))
+        self.assertEqual(msgpack_decode(self.sv.Struct(self.ns.B),
+                                        msgpack_encode(self.sv.Struct(self.ns.B), b),
+                                        use_plans=True, trusted=True), b)
+        for data in (b'\xc1', b'\x92\x01', b'\xa1\xff'):
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                msgpack_decode(self.sv.String(), data)
+            self.assertEqual(str(cm.exception), 'could not decode input as msgpack')
+
+        # Sequences of objects are decoded as they're read
+        data_type = self.sv.Union(self.ns.V)
+        values = [self.ns.V.t0, self.ns.V.t1('x' * 100), self.ns.V.t3(self.ns.S(f='f'))]
+        data = b''.join(msgpack_encode(data_type, v) for v in values)
+        self.assertEqual(list(msgpack_decode_iter(data_type, io.BytesIO(data), chunk_size=7)),
+                         values)
+        self.assertEqual(list(msgpack_decode_iter(data_type, io.BytesIO(b''))), [])
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            list(msgpack_decode_iter(data_type, io.BytesIO(data[:-1])))
+        self.assertEqual(str(cm.exception), 'unexpected end of msgpack input')
+        it = msgpack_decode_iter(data_type, io.BytesIO(data + msgpack_encode(
+            self.sv.String(), 'zzz')))
+        self.assertEqual([next(it) for _ in values], values)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            next(it)
+        self.assertEqual(str(cm.exception), "unknown tag 'zzz'")
+
+        # Sockets are read with recv()
+        sender, receiver = socket.socketpair()
+        try:
+            sender.sendall(data)
+            sender.close()
+            self.assertEqual(list(msgpack_decode_iter(data_type, receiver)), values)
+        finally:
+            receiver.close()
+
+    def test_compact(self):
+        compact_encode = self.ss.compact_encode
+        compact_decode = self.ss.compact_decode
+
+        def check(data_type, value):
+            data = compact_encode(data_type, value)
+            self.assertEqual(compact_decode(data_type, data), value)
+            return data
+
+        c = self.ns.C(a='hi', b=-32, c=b'\x00\x01', d=1.5)
+        self.assertEqual(check(self.ns.C_validator, c),
+                         b'\x03\x05\x03\x02hi?\x04\x01\x02\x00\x01\x09\x01' +
+                         struct.pack('<d', 1.5))
+        check(self.ns.D_validator, self.ns.D(a='\u2650', b=2**64 - 1, c=None,
+                                             d=[1, None, -2**63], e={'k': None, 'l': 'v'}))
+        check(self.ns.E_validator, self.ns.E())
+        check(self.ns.ResourceLax_validator, self.ns.ResourceLax(name='r'))
+        check(self.ns.Resource_validator, self.ns.File(name='f', size=10))
+        check(self.sv.List(self.ns.Resource_validator),
+              [self.ns.File(name='f', size=10), self.ns.Folder(name='g')])
+        for v in [self.ns.V.t0, self.ns.V.t1('x'), self.ns.V.t2(None), self.ns.V.t4(None),
+                  self.ns.V.t3(self.ns.S(f='f')), self.ns.V.t5(self.ns.U.t1('u')),
+                  self.ns.V.t8(self.ns.Folder(name='g')),
+                  self.ns.V.t10([self.ns.U.t0, self.ns.U.t2]),
+                  self.ns.V.t12({'a': self.ns.U.t1('u')})]:
+            check(self.ns.V_validator, v)
+        self.assertIs(compact_decode(self.ns.V_validator,
+                                     compact_encode(self.ns.V_validator, self.ns.V.t0)),
+                      compact_decode(self.ns.V_validator,
+                                     compact_encode(self.ns.V_validator, self.ns.V.t0)))
+
+        # Names are replaced by indexes
+        f = self.ns.File(name='f', size=10)
+        self.assertLess(len(compact_encode(self.ns.Resource_validator, f)),
+                        len(self.encode(self.ns.Resource_validator, f)) // 3)
+        self.assertEqual(compact_encode(self.ns.UExtendExtend_validator,
+                                        self.ns.UExtendExtend.t4),
+                         b'\x02\x00\x00')
+
+        # Defaults are filled in and required fields checked
+        self.assertEqual(compact_decode(self.ns.E_validator, b'\x01\x00'), self.ns.E())
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_decode(self.ns.S_validator, b'\x01\x00')
+        self.assertEqual(str(cm.exception), "missing required field 'f'")
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_encode(self.ns.S_validator, self.ns.S())
+        self.assertEqual(str(cm.exception), "missing required field 'f'")
+
+        # Invalid values are rejected like by json_encode()
+        for data_type, value, error in [
+                (self.sv.String(max_length=2), 'abcdef', "'abcdef' must be at most 2 characters, got 6"),  # noqa: E501
+                (self.sv.Int32(), 2**40, '1099511627776 is not within range [-2147483648, 2147483647]'),  # noqa: E501
+                (self.sv.UInt32(), -1, '-1 is not within range [0, 4294967295]'),
+                (self.sv.Float64(), 'x', 'expected real number, got string'),
+                (self.sv.Boolean(), 1, '1 is not a valid boolean'),
+                (self.sv.List(self.sv.UInt64()), [1, -5], '-5 is not within range [0, 18446744073709551615]'),  # noqa: E501
+                (self.sv.Map(self.sv.String(), self.sv.Int32()), {'k': 'v'}, 'expected integer, got string')]:  # noqa: E501
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                compact_encode(data_type, value)
+            self.assertEqual(str(cm.exception), error)
+        d = self.ns.D(a='x', d=[1], e={})
+        d.d.append('bad')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_encode(self.ns.D_validator, d)
+        self.assertEqual(str(cm.exception), 'd: expected integer, got string')
+        h = self.ns.Histogram(counts=[1], bounds=[])
+        h.counts.append(-5)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_encode(self.ns.Histogram_validator, h)
+        self.assertEqual(str(cm.exception), 'counts: -5 is not within range [0, 4294967295]')
+        items = ['x']
+        v = self.ns.V.t9(items)
+        items.append(1)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_encode(self.ns.V_validator, v)
+        self.assertEqual(str(cm.exception), "t9: '1' expected to be a string, got integer")
+
+        # Malformed input
+        for data in (b'', b'\x01\x05\x01', b'\x01\x03\x01\x01\xff', b'\x01\x00\x00'):
+            with self.assertRaises(self.sv.ValidationError):
+                compact_decode(self.ns.S_validator, data)
+
+        # Fields, tags and subtypes added later are only accepted when not
+        # strict.
+        s = b'\x01\x04\x03\x01f\x00'
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_decode(self.ns.S_validator, s)
+        self.assertEqual(str(cm.exception), 'unknown field of S')
+        self.assertEqual(compact_decode(self.ns.S_validator, s, strict=False),
+                         self.ns.S(f='f'))
+        b = compact_encode(self.ns.C_validator, c)
+        with self.assertRaises(self.sv.ValidationError):
+            compact_decode(self.ns.B_validator, b)
+        self.assertEqual(compact_decode(self.ns.B_validator, b, strict=False),
+                         self.ns.B(a='hi', b=-32, c=b'\x00\x01'))
+
+        u = b'\x00\x63\x01\x00'
+        with self.assertRaises(self.sv.ValidationError):
+            compact_decode(self.ns.V_validator, u)
+        self.assertEqual(compact_decode(self.ns.V_validator, u, strict=False),
+                         self.ns.V.other)
+        with self.assertRaises(self.sv.ValidationError):
+            compact_decode(self.ns.U_validator, u, strict=False)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_decode(self.ns.V_validator,
+                           compact_encode(self.ns.V_validator, self.ns.V.other))
+        self.assertEqual(str(cm.exception), "unexpected use of the catch-all tag 'other'")
+
+        r = b'\x01\x05\x02\x03\x01\x01r\x02\x01\x00'
+        with self.assertRaises(self.sv.ValidationError):
+            compact_decode(self.ns.ResourceLax_validator, r)
+        self.assertEqual(compact_decode(self.ns.ResourceLax_validator, r, strict=False),
+                         self.ns.ResourceLax(name='r'))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            compact_decode(self.ns.Resource_validator, r, strict=False)
+        self.assertEqual(str(cm.exception),
+                         "unknown subtype of Resource at index 5 and 'Resource' is not a "
+                         "catch-all")
+
+    def test_columnar(self):
+        data_type = self.sv.List(self.ns.D_validator)
+        values = [self.ns.D(a='x', b=1, c='c', d=[1, None], e={}),
+                  self.ns.D(a='y', d=[], e={'k': None}),
+                  self.ns.D(a='z', b=3, d=[2], e={})]
+        encoded = {
+            'length': 3,
+            'columns': {
+                'a': ['x', 'y', 'z'],
+                'b': {'present': base64.b64encode(b'\x05').decode('ascii'), 'values': [1, 3]},
+                'c': {'present': base64.b64encode(b'\x01').decode('ascii'), 'values': ['c']},
+                'd': [[1, None], [], [2]],
+                'e': [{}, {'k': None}, {}],
+            },
+        }
+        for use_plans in (False, True):
+            self.assertEqual(self.compat_obj_encode(data_type, values, use_plans=use_plans,
+                                                    columnar=True), encoded)
+            for trusted in (False, True):
+                decoded = self.compat_obj_decode(data_type, encoded, use_plans=use_plans,
+                                                 trusted=trusted, columnar=True)
+                self.assertEqual(decoded, values)
+                self.assertEqual(decoded[1].b, 10)
+        self.assertEqual(self.compat_obj_encode(data_type, [], columnar=True),
+                         {'length': 0, 'columns': {}})
+        self.assertEqual(self.compat_obj_decode(data_type, {'length': 0}, columnar=True), [])
+        self.assertEqual(self.decode(data_type, self.encode(data_type, values, columnar=True),
+                                     columnar=True), values)
+
+        # Lists of structs are encoded by column wherever they are, but not
+        # lists of structs with enumerated subtypes.
+        contacts = self.ns.ContactList.contacts([self.ns.Contact(email='a@b.c')])
+        self.assertEqual(self.compat_obj_encode(self.ns.ContactList_validator, contacts,
+                                                columnar=True),
+                         {'.tag': 'contacts',
+                          'contacts': {'length': 1, 'columns': {'email': ['a@b.c']}}})
+        self.assertEqual(self.compat_obj_decode(
+            self.ns.ContactList_validator,
+            self.compat_obj_encode(self.ns.ContactList_validator, contacts, columnar=True),
+            columnar=True), contacts)
+        resources = [self.ns.File(name='f', size=1)]
+        resources_type = self.sv.List(self.ns.Resource_validator)
+        self.assertEqual(self.compat_obj_encode(resources_type, resources, columnar=True),
+                         self.compat_obj_encode(resources_type, resources))
+
+        if hasattr(self.ss, 'msgpack_encode'):
+            self.assertEqual(self.ss.msgpack_decode(
+                data_type, self.ss.msgpack_encode(data_type, values, columnar=True),
+                columnar=True), values)
+
+        # Malformed columns are rejected
+        for use_plans in (False, True):
+            for obj, message in [
+                    ([], 'expected columns, got list'),
+                    ({'length': '3'}, 'expected length, got string'),
+                    ({'length': 1, 'rows': []}, "unexpected key 'rows'"),
+                    ({'length': 2, 'columns': {'a': ['x']}}, 'a: expected 2 values, got 1'),
+                    ({'length': 2, 'columns': {'a': {'present': 'AQ==', 'values': []}}},
+                     'a: expected 1 values, got 0'),
+                    ({'length': 9, 'columns': {'a': {'present': 'AQ==', 'values': ['x']}}},
+                     'a: presence bitmap has the wrong size'),
+                    ({'length': 1, 'columns': {'a': {'present': 1, 'values': ['x']}}},
+                     'a: invalid presence bitmap'),
+                    ({'length': 1, 'columns': {'a': [1]}},
+                     "a: '1' expected to be a string, got integer"),
+                    ({'length': 1, 'columns': {'a': ['x'], 'z': [1]}}, "unknown field 'z'"),
+                    ({'length': 1, 'columns': {'d': [[]], 'e': [{}]}},
+                     "missing required field 'a'")]:
+                with self.assertRaises(self.sv.ValidationError) as cm:
+                    self.compat_obj_decode(data_type, obj, use_plans=use_plans, columnar=True)
+                self.assertEqual(str(cm.exception), message)
+            self.assertEqual(
+                self.compat_obj_decode(data_type, {'length': 1, 'columns': {
+                    'a': ['x'], 'd': [[]], 'e': [{}], 'z': [1]}},
+                    use_plans=use_plans, strict=False, columnar=True),
+                [self.ns.D(a='x', d=[], e={})])
+
+    @unittest.skipIf(bv.np is None, 'NumPy is not installed')
+    def test_numpy_arrays(self):
+        np = bv.np
+        counts = np.array([3, 0, 7], dtype=np.int64)
+        bounds = np.array([0.5, 1.0, 2.5])
+        h = self.ns.Histogram(counts=counts, bounds=bounds)
+        self.assertIs(h.counts, counts)
+        self.assertIs(h.bounds, bounds)
+        self.assertEqual(h, self.ns.Histogram(counts=[3, 0, 7], bounds=[0.5, 1.0, 2.5]))
+        self.assertNotEqual(h, self.ns.Histogram(counts=[3, 0], bounds=[0.5, 1.0, 2.5]))
+
+        encoded = {'counts': [3, 0, 7], 'bounds': [0.5, 1.0, 2.5]}
+        for use_plans in (False, True):
+            obj = self.compat_obj_encode(self.ns.Histogram_validator, h, use_plans=use_plans)
+            self.assertEqual(obj, encoded)
+            self.assertIs(type(obj['counts'][0]), int)
+        self.assertEqual(json.loads(self.ss.json_encode(self.ns.Histogram_validator, h)),
+                         encoded)
+        sink = bytearray()
+        self.ss.json_encode_to(self.ns.Histogram_validator, h, sink)
+        self.assertEqual(json.loads(sink.decode('utf-8')), encoded)
+
+        # Floats are packed as is, and can be decoded back into arrays.
+        data = self.ss.compact_encode(self.ns.Histogram_validator, h)
+        self.assertEqual(data, self.ss.compact_encode(
+            self.ns.Histogram_validator, self.ns.Histogram(counts=[3, 0, 7],
+                                                           bounds=[0.5, 1.0, 2.5])))
+        decoded = self.ss.compact_decode(self.ns.Histogram_validator, data, arrays=True)
+        self.assertIsInstance(decoded.counts, np.ndarray)
+        self.assertIsInstance(decoded.bounds, np.ndarray)
+        self.assertEqual(decoded, h)
+        self.assertEqual(self.ss.compact_decode(self.ns.Histogram_validator, data), h)
+        self.assertIsInstance(
+            self.ss.compact_decode(self.ns.Histogram_validator, data).bounds, list)
+
+        # Arrays get the same checks as lists, on the whole array at once.
+        for field, value, message in [
+                ('counts', np.array([1, -1]), '-1 is not within range [0, 4294967295]'),
+                ('counts', np.array([2 ** 32]), '4294967296 is not within range [0, 4294967295]'),
+                ('counts', np.array([1.0]), 'expected integer array, got float64 array'),
+                ('counts', np.array([[1]]), 'expected a 1-dimensional array, got 2 dimensions'),
+                ('bounds', np.array([1.0, np.nan]), 'nan values are not supported'),
+                ('bounds', np.array(['x']), 'expected float array, got <U1 array')]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                setattr(self.ns.Histogram(), field, value)
+            self.assertEqual(str(cm.exception), message)
+        h.bounds = np.array([1, 2], dtype=np.int32)
+        self.assertEqual(h.bounds.dtype, np.float64)
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.sv.List(self.sv.String()).validate(np.array(['x']))
+        self.assertEqual(str(cm.exception),
+                         'arrays are only supported for lists of integers or floats')
+
+    def test_field_masks(self):
+        ns = self.ns
+        listing = ns.Listing(
+            entries=[ns.D(a='x', b=1, d=[2], e={}), ns.D(a='y', c='c', d=[], e={})],
+            resources=[ns.File(name='f', size=3), ns.Folder(name='g')],
+            cursor='abc')
+        mask = self.ss.FieldMask(ns.Listing_validator, {'entries': {'a', 'b'}, 'cursor': None})
+        for use_plans in (False, True):
+            self.assertEqual(
+                self.compat_obj_encode(ns.Listing_validator, listing, use_plans=use_plans,
+                                       fields=mask),
+                {'entries': [{'a': 'x', 'b': 1}, {'a': 'y'}], 'cursor': 'abc'})
+        self.assertEqual(
+            self.compat_obj_encode(ns.Listing_validator, listing,
+                                   fields={'resources': ['name', 'size']}),
+            {'resources': [{'.tag': 'file', 'name': 'f', 'size': 3},
+                           {'.tag': 'folder', 'name': 'g'}]})
+        self.assertEqual(
+            self.compat_obj_encode(ns.Listing_validator, listing, fields=['cursor']),
+            {'cursor': 'abc'})
+        self.assertEqual(
+            self.compat_obj_encode(ns.Listing_validator, listing, fields=mask, columnar=True),
+            {'entries': {'length': 2, 'columns': {'a': ['x', 'y'], 'b': {
+                'present': base64.b64encode(b'\x01').decode('ascii'), 'values': [1]}}},
+             'cursor': 'abc'})
+        self.assertEqual(self.ss.json_encode(ns.Listing_validator, listing, fields=mask),
+                         '{"entries": [{"a": "x", "b": 1}, {"a": "y"}], "cursor": "abc"}')
+
+        # Fields that aren't selected are neither decoded nor validated.
+        obj = {'entries': [{'a': 'x', 'c': 1, 'd': 'bad'}], 'resources': None, 'cursor': 'abc'}
+        for trusted in (False, True):
+            decoded = self.compat_obj_decode(ns.Listing_validator, obj, fields=mask,
+                                             trusted=trusted)
+            self.assertEqual(decoded.cursor, 'abc')
+            self.assertEqual(decoded.entries[0].a, 'x')
+            self.assertEqual(decoded.entries[0].b, 10)
+            self.assertFalse(decoded.entries[0]._d_present)
+            self.assertFalse(decoded._resources_present)
+        decoded = self.compat_obj_decode(
+            ns.Listing_validator,
+            {'resources': [{'.tag': 'file', 'name': 'f', 'size': 3}, {'.tag': 'folder'}]},
+            fields={'resources': {'size'}})
+        self.assertEqual(decoded.resources[0].size, 3)
+        self.assertIsInstance(decoded.resources[1], ns.Folder)
+        self.assertEqual(
+            self.compat_obj_decode(ns.Listing_validator, self.compat_obj_encode(
+                ns.Listing_validator, listing, fields=mask, columnar=True),
+                fields=mask, columnar=True).entries[1].a, 'y')
+        for obj, message in [
+                ({'entries': [{'b': 1}]}, "entries: missing required field 'a'"),
+                ({'entries': [{'a': 1}], 'cursor': 'abc'}, "entries.a: '1' expected to be a "
+                                                           "string, got integer"),
+                ({'entries': [], 'cursor': 'abc', 'z': 1}, "unknown field 'z'")]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.compat_obj_decode(ns.Listing_validator, obj, fields=mask)
+            self.assertEqual(str(cm.exception), message)
+        self.assertEqual(self.compat_obj_decode(ns.Listing_validator,
+                                                {'entries': [], 'cursor': 'abc', 'z': 1},
+                                                fields=mask, strict=False).cursor, 'abc')
+
+        # Plans are compiled once per mask and set of options.
+        self.assertEqual(len(mask._encode_plans), 2)
+        for fields, message in [
+                ({'entries': {'z'}}, "unknown field 'entries.z'"),
+                ({'entries': {'e': {'a'}}}, "cannot select fields of 'entries.e', which is "
+                                            "not a struct"),
+                ('cursor', "expected a collection of field names, got 'cursor'")]:
+            with self.assertRaises(ValueError) as cm:
+                self.ss.FieldMask(ns.Listing_validator, fields)
+            self.assertEqual(str(cm.exception), message)
+        with self.assertRaises(ValueError):
+            self.compat_obj_encode(ns.D_validator, listing.entries[0], fields=mask)
+
+    def test_patches(self):
+        ns = self.ns
+        diff, apply_patch = self.ss.diff, self.ss.apply_patch
+        entries = [ns.D(a='x', d=[1], e={})]
+        old = ns.Listing(entries=entries, resources=[ns.File(name='f', size=1)], cursor='c1')
+        new = ns.Listing(entries=entries, resources=[ns.File(name='f', size=1)], cursor='c2')
+        self.assertEqual(diff(ns.Listing_validator, old, new), [('replace', ('cursor',), 'c2')])
+        self.assertEqual(diff(ns.Listing_validator, old, old), [])
+
+        old_d = ns.D(a='x', c='c', d=[1], e={})
+        new_d = ns.D(a='x', b=2, d=[1, 2], e={})
+        patch = diff(ns.D_validator, old_d, new_d)
+        self.assertEqual(patch, [('set', ('b',), 2), ('clear', ('c',), None),
+                                 ('replace', ('d',), [1, 2])])
+        self.assertEqual(apply_patch(ns.D_validator, old_d, patch), new_d)
+        self.assertEqual(old_d, ns.D(a='x', c='c', d=[1], e={}))
+
+        # Structs of the same class and unions with the same tag are compared
+        # through their fields and value.
+        self.assertEqual(diff(ns.S2_validator, ns.S2(f1=ns.OptionalS(f1='a')),
+                              ns.S2(f1=ns.OptionalS(f1='b', f2=4))),
+                         [('replace', ('f1', 'f1'), 'b'), ('set', ('f1', 'f2'), 4)])
+        self.assertEqual(diff(ns.V_validator, ns.V.t3(ns.S(f='a')), ns.V.t3(ns.S(f='b'))),
+                         [('replace', ('t3', 'f'), 'b')])
+        self.assertEqual(diff(ns.V_validator, ns.V.t3(ns.S(f='a')), ns.V.t1('a')),
+                         [('replace', (), ns.V.t1('a'))])
+        self.assertEqual(diff(ns.Resource_validator, ns.File(name='f', size=1),
+                              ns.Folder(name='f')), [('replace', (), ns.Folder(name='f'))])
+        self.assertEqual(apply_patch(ns.V_validator, ns.V.t3(ns.S(f='a')),
+                                     [('replace', ('t3', 'f'), 'b')]), ns.V.t3(ns.S(f='b')))
+
+        # Patches can be encoded and decoded
+        patch = diff(ns.Listing_validator, old, ns.Listing(
+            entries=[ns.D(a='y', d=[1], e={})], resources=[], cursor='c1'))
+        encoded = self.ss.encode_patch(ns.Listing_validator, patch)
+        self.assertEqual(encoded, [['replace', 'entries', [{'a': 'y', 'd': [1], 'e': {}}]],
+                                   ['replace', 'resources', []]])
+        self.assertEqual(self.ss.decode_patch(ns.Listing_validator, json.loads(json.dumps(
+            encoded))), patch)
+        self.assertEqual(self.ss.encode_patch(ns.D_validator, diff(ns.D_validator, old_d, new_d)),
+                         [['set', 'b', 2], ['clear', 'c'], ['replace', 'd', [1, 2]]])
+
+        # Fields that subtypes of a struct tree declare with different types
+        # can't be encoded or decoded, since paths don't record the subtype
+        self.assertEqual(
+            self.ss.encode_patch(ns.Shape_validator, [('set', ('label',), 'x')]),
+            [['set', 'label', 'x']])
+        patch = diff(ns.Shape_validator, ns.Circle(size=1.0), ns.Circle(size=2.0))
+        for f, arg in [(self.ss.encode_patch, patch),
+                       (self.ss.decode_patch, [['set', 'size', 2.0]])]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                f(ns.Shape_validator, arg)
+            self.assertEqual(str(cm.exception),
+                             "field 'size' has different types in subtypes of Shape")
+
+        for obj, message in [
+                ({}, 'expected list, got dict'),
+                ([['bogus', 'b', 1]], "unknown patch operation 'bogus'"),
+                ([['clear', 'c', 1]], "unexpected number of arguments to 'clear'"),
+                ([['set', 'z', 1]], "unknown field 'z'"),
+                ([['set', 'b', 'x']], "b: expected integer, got string")]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.ss.decode_patch(ns.D_validator, obj)
+            self.assertEqual(str(cm.exception), message)
+        for data_type, obj, patch, message in [
+                (ns.D_validator, old_d, [('clear', ('a',), None)], "missing required field 'a'"),
+                (ns.D_validator, old_d, [('set', ('b',), 'x')],
+                 "b: expected integer, got string"),
+                (ns.V_validator, ns.V.t1('a'), [('replace', ('t3', 'f'), 'b')],
+                 "t3.f: tag 't3' isn't set")]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                apply_patch(data_type, obj, patch)
+            self.assertEqual(str(cm.exception), message)
+
     def test_alias_validators(self):
 
         def aliased_string_validator(val):
@@ -1473,6 +2340,640 @@ class TestGeneratedPython(unittest.TestCase):
         s = self.ns.S3()
         assert s.u == self.ns2.BaseU.z
 
+    def test_encode_plans(self):
+        values = [
+            (self.sv.Struct(self.ns.C), self.ns.C(a='test', b=123, c=b'\x00', d=3.14)),
+            (self.sv.Struct(self.ns.D), self.ns.D(a='a', c=None, d=[1, None], e={'k': None})),
+            (self.sv.Struct(self.ns.E), self.ns.E()),
+            (self.sv.StructTree(self.ns.Resource), self.ns.File(name='test.doc', size=100)),
+            (self.sv.List(self.sv.Struct(self.ns.S)), [self.ns.S('a'), self.ns.S('b')]),
+            (self.sv.Union(self.ns.V), self.ns.V.t0),
+            (self.sv.Union(self.ns.V), self.ns.V.t2(None)),
+            (self.sv.Union(self.ns.V), self.ns.V.t3(self.ns.S('a'))),
+            (self.sv.Union(self.ns.V), self.ns.V.t4(None)),
+            (self.sv.Union(self.ns.V), self.ns.V.t7(self.ns.Folder(name='x'))),
+            (self.sv.Union(self.ns.V), self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('b')])),
+            (self.sv.Union(self.ns.V), self.ns.V.t12({'k': self.ns.U.t2})),
+            (self.sv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), datetime.datetime(2017, 1, 2, 3, 4, 5)),
+            (self.sv.UInt32(), True),
+        ]
+        for old_style in (False, True):
+            for data_type, value in values:
+                self.assertEqual(
+                    self.compat_obj_encode(data_type, value, old_style=old_style,
+                                           use_plans=True),
+                    self.compat_obj_encode(data_type, value, old_style=old_style))
+
+        # Plans are compiled once per validator and set of options
+        serializer = self.ss.StoneToPythonPrimitiveSerializer(None, None, False, False, False)
+        validator = self.sv.List(self.sv.Struct(self.ns.S))
+        plan = serializer.get_encode_plan(validator)
+        serializer2 = self.ss.StoneToPythonPrimitiveSerializer(None, None, False, False, False)
+        self.assertIs(plan, serializer2.get_encode_plan(validator))
+        serializer3 = self.ss.StoneToPythonPrimitiveSerializer(None, None, False, True, False)
+        self.assertIsNot(plan, serializer3.get_encode_plan(validator))
+
+        # Errors are reported the same way
+        d = self.ns.D(a='a', d=[1], e={})
+        d.d.append('x')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d, use_plans=True)
+        self.assertEqual("d: expected integer, got string", str(cm.exception))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), self.ns.D(), use_plans=True)
+        self.assertEqual("missing required field 'a'", str(cm.exception))
+
+        def aliased_string_validator(val):
+            if ' ' in val:
+                raise self.sv.ValidationError('No spaces allowed')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_encode(
+                self.sv.Struct(self.ns.ContainsAlias),
+                self.ns.ContainsAlias(s='hi there'),
+                alias_validators={self.ns.AliasedString_validator: aliased_string_validator},
+                use_plans=True)
+        self.assertEqual("s: No spaces allowed", str(cm.exception))
+
+    def test_json_encode_to(self):
+        values = [
+            (self.sv.Struct(self.ns.C), self.ns.C(a='test', b=123, c=b'\x00', d=3.14)),
+            (self.sv.Struct(self.ns.D), self.ns.D(a='\u2650', c=None, d=[1, None],
+                                                  e={'k': None, 'l': 'v'})),
+            (self.sv.Struct(self.ns.E), self.ns.E()),
+            (self.sv.StructTree(self.ns.Resource), self.ns.File(name='test.doc', size=100)),
+            (self.sv.List(self.sv.Struct(self.ns.S)), [self.ns.S('a'), self.ns.S('b')]),
+            (self.sv.List(self.sv.String()), []),
+            (self.sv.Union(self.ns.V), self.ns.V.t0),
+            (self.sv.Union(self.ns.V), self.ns.V.t2(None)),
+            (self.sv.Union(self.ns.V), self.ns.V.t3(self.ns.S('a'))),
+            (self.sv.Union(self.ns.V), self.ns.V.t4(self.ns.S('a'))),
+            (self.sv.Union(self.ns.V), self.ns.V.t7(self.ns.Folder(name='x'))),
+            (self.sv.Union(self.ns.V), self.ns.V.t10([self.ns.U.t0, self.ns.U.t1('b')])),
+            (self.sv.Union(self.ns.V), self.ns.V.t12({'k': self.ns.U.t2})),
+            (self.sv.Nullable(self.sv.Int32()), None),
+            (self.sv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), datetime.datetime(2017, 1, 2, 3, 4, 5)),
+        ]
+        for old_style in (False, True):
+            for data_type, value in values:
+                expected = self.encode(data_type, value, old_style=old_style)
+                sink = bytearray(b'x')
+                self.ss.json_encode_to(data_type, value, sink, old_style=old_style)
+                self.assertEqual(sink[1:].decode('utf-8'), expected)
+                text = io.StringIO()
+                self.ss.json_encode_to(data_type, value, text, old_style=old_style)
+                self.assertEqual(text.getvalue(), expected)
+
+        # Output is passed on in chunks
+        serializer = self.ss.StoneToJsonStreamSerializer(None, None, False, False, False)
+        serializer.chunk_size = 10
+        chunks = []
+        value = [self.ns.S('f' * 5)] * 20
+        serializer.encode_to(self.sv.List(self.sv.Struct(self.ns.S)), value, chunks.append)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(''.join(chunks),
+                         self.encode(self.sv.List(self.sv.Struct(self.ns.S)), value))
+        stream = io.BytesIO()
+        self.ss.json_encode_to(self.sv.List(self.sv.Struct(self.ns.S)), value, stream)
+        self.assertEqual(stream.getvalue().decode('utf-8'), ''.join(chunks))
+
+        # A bytearray is restored on failure
+        sink = bytearray(b'prefix')
+        d = self.ns.D(a='a', d=[1], e={})
+        d.d.append('x')
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.ss.json_encode_to(self.sv.List(self.sv.Struct(self.ns.D)), [d], sink)
+        self.assertEqual("d: expected integer, got string", str(cm.exception))
+        self.assertEqual(sink, bytearray(b'prefix'))
+
+    def test_json_decode_iter(self):
+        def decode_iter(data_type, serialized_obj, chunk_size=3, **kwargs):
+            for stream in (io.BytesIO(serialized_obj.encode('utf-8')),
+                           io.StringIO(serialized_obj)):
+                items = list(self.ss.json_decode_iter(
+                    data_type, stream, chunk_size=chunk_size, **kwargs))
+            return items
+
+        s_list = self.sv.List(self.sv.Struct(self.ns.S))
+        value = [self.ns.S('a\u2650 "[{,') for _ in range(10)]
+        self.assertEqual(
+            repr(decode_iter(s_list, self.encode(s_list, value))),
+            repr(self.decode(s_list, self.encode(s_list, value))))
+        self.assertEqual(decode_iter(s_list, ' [ ] '), [])
+
+        u_list = self.sv.List(self.sv.Union(self.ns.V))
+        value = [self.ns.V.t0, self.ns.V.t9(['a', 'b']), self.ns.V.t11({'k': 12345}),
+                 self.ns.V.t12({'k': self.ns.U.t1('x\\')})]
+        self.assertEqual(decode_iter(u_list, self.encode(u_list, value)), value)
+
+        self.assertEqual(
+            decode_iter(self.sv.List(self.sv.Nullable(self.sv.Float64())),
+                        '[1.5, null,-10e3]'),
+            [1.5, None, -10e3])
+        self.assertEqual(
+            decode_iter(self.sv.List(self.sv.Bytes()), '["YQ==","Yg=="]', chunk_size=1),
+            [b'a', b'b'])
+
+        # A list field of a struct
+        d = self.ns.D(a='a', d=[1, None, 3], e={'k': '[1]'})
+        serialized = self.encode(self.sv.Struct(self.ns.D), d)
+        self.assertEqual(decode_iter(self.sv.Struct(self.ns.D), serialized, field='d'),
+                         [1, None, 3])
+        self.assertEqual(decode_iter(self.sv.Struct(self.ns.D), '{"a": "a"}', field='d'), [])
+
+        # Errors
+        for data_type, serialized_obj, kwargs, message in [
+                (s_list, '{}', {}, 'expected list, got dict'),
+                (s_list, '[{"f": "a"}, {}]', {}, "missing required field 'f'"),
+                (self.sv.List(self.sv.Int32()), '[1, "2"]', {}, 'expected integer, got string'),
+                (self.sv.Struct(self.ns.D), '{"d": [1, 2.5]}', {'field': 'd'},
+                 'd: expected integer, got float'),
+                (s_list, '[{"f": "a"},]', {}, 'could not decode input as JSON'),
+                (s_list, '[{"f": "a"}', {}, 'could not decode input as JSON'),
+                (s_list, '[{"f": "a"}] x', {}, 'could not decode input as JSON'),
+                (self.sv.Struct(self.ns.D), '{"d": [] "a": 1}', {'field': 'd'},
+                 'could not decode input as JSON'),
+        ]:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                decode_iter(data_type, serialized_obj, **kwargs)
+            self.assertEqual(message, str(cm.exception))
+
+        # Items are decoded as they're read
+        stream = io.BytesIO(b'[{"f": "a"}, {"f": "b"}, oops')
+        items = self.ss.json_decode_iter(s_list, stream, chunk_size=4)
+        self.assertEqual(next(items).f, 'a')
+        self.assertEqual(next(items).f, 'b')
+        with self.assertRaises(self.sv.ValidationError):
+            next(items)
+
+    def test_codec(self):
+        data_type = self.sv.List(self.sv.Union(self.ns.V))
+        value = [self.ns.V.t0, self.ns.V.t3(self.ns.S('a')), self.ns.V.t9(['a', 'b']),
+                 self.ns.V.t12({'k': self.ns.U.t1('x')})]
+        codec = self.ss.Codec(data_type)
+        serialized = codec.encode(value)
+        self.assertEqual(serialized, self.encode(data_type, value))
+        self.assertEqual(codec.encode(value, as_bytes=True), serialized.encode('utf-8'))
+        self.assertEqual(codec.compat_obj_encode(value),
+                         self.compat_obj_encode(data_type, value))
+        self.assertEqual(repr(codec.decode(serialized)), repr(value))
+        self.assertEqual(repr(codec.compat_obj_decode(json.loads(serialized))), repr(value))
+        self.assertEqual(codec.encode_many([value, []]), [serialized, '[]'])
+        self.assertEqual(repr(codec.decode_many([serialized, b'[]'])), repr([value, []]))
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            codec.decode('[{".tag": "t9"}]')
+        self.assertEqual("missing 't9' key", str(cm.exception))
+
+        timestamp = self.ss.Codec(self.sv.Timestamp('%Y-%m-%dT%H:%M:%SZ'), use_plans=False)
+        self.assertEqual(timestamp.decode('"2017-01-02T03:04:05Z"'),
+                         datetime.datetime(2017, 1, 2, 3, 4, 5))
+
+        # A codec can be shared between threads, even before its plans are
+        # compiled.
+        codec = self.ss.Codec(self.sv.List(self.sv.Union(self.ns.V)))
+        results = []
+
+        def work():
+            for _ in range(20):
+                results.append(repr(codec.decode(codec.encode(value))) == repr(value))
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 160)
+
+        # The module-level functions reuse codecs up to a limit
+        data_type = self.sv.Struct(self.ns.S)
+        self.encode(data_type, self.ns.S('a'))
+        codec_count = len(self.ss._codec_cache)
+        self.encode(data_type, self.ns.S('b'))
+        self.assertEqual(len(self.ss._codec_cache), codec_count)
+        for _ in range(self.ss._CODEC_CACHE_SIZE + 1):
+            self.encode(self.sv.Struct(self.ns.S), self.ns.S('a'))
+        self.assertEqual(len(self.ss._codec_cache), self.ss._CODEC_CACHE_SIZE)
+
+    def test_encode_decode_many(self):
+        data_type = self.sv.Struct(self.ns.D)
+        good = self.ns.D(a='a', d=[1, None], e={'k': 'v'})
+        bad = self.ns.D(a='b', d=[], e={})
+        bad.d.append('x')
+        results = self.ss.json_encode_many(data_type, [good, bad, self.ns.D(), good])
+        self.assertEqual(len(results), 4)
+        self.assertEqual(results[0], self.encode(data_type, good))
+        self.assertEqual(results[3], results[0])
+        self.assertIsInstance(results[1], self.sv.ValidationError)
+        self.assertEqual("d: expected integer, got string", str(results[1]))
+        self.assertEqual("missing required field 'a'", str(results[2]))
+        self.assertEqual(
+            self.ss.json_encode_many(data_type, [good], as_bytes=True),
+            [results[0].encode('utf-8')])
+
+        results = self.ss.json_decode_many(
+            data_type, [results[0], '{"a": "a", "d": []}', b'{', results[0].encode('utf-8'),
+                        '{"d": [], "e": {}}'],
+            strict=False)
+        self.assertEqual([repr(r) for r in results[::3]], [repr(good)] * 2)
+        self.assertEqual("missing required field 'e'", str(results[1]))
+        self.assertEqual('could not decode input as JSON', str(results[2]))
+        self.assertEqual("missing required field 'a'", str(results[4]))
+
+        # Codecs raise on the first error unless asked not to.
+        codec = self.ss.Codec(data_type)
+        with self.assertRaises(self.sv.ValidationError):
+            codec.encode_many([good, bad])
+        self.assertEqual(len(codec.decode_many(['{}', '{}'], return_errors=True)), 2)
+
+    def assert_same_decoding(self, data_type, obj, **kwargs):
+        try:
+            expected = self.compat_obj_decode(data_type, obj, **kwargs)
+        except self.sv.ValidationError as e:
+            with self.assertRaises(self.sv.ValidationError) as cm:
+                self.compat_obj_decode(data_type, obj, use_plans=True, **kwargs)
+            self.assertEqual(str(e), str(cm.exception))
+        else:
+            self.assertEqual(
+                repr(self.compat_obj_decode(data_type, obj, use_plans=True, **kwargs)),
+                repr(expected))
+
+    def test_decode_plans(self):
+        values = [
+            (self.sv.Struct(self.ns.D), {'a': 'A', 'c': None, 'd': [None, 1], 'e': {'one': None}}),
+            (self.sv.Struct(self.ns.D), {'a': 'A', 'b': None}),
+            (self.sv.Struct(self.ns.D), {'a': 'A', 'd': [], 'e': {}, 'z': 1}),
+            (self.sv.Struct(self.ns.E), None),
+            (self.sv.Struct(self.ns.S2), {}),
+            (self.sv.Struct(self.ns.C), {'a': 'A', 'b': 1, 'c': 'AA==', 'd': 1.5}),
+            (self.sv.StructTree(self.ns.Resource), {'.tag': 'file', 'name': 'n', 'size': 1}),
+            (self.sv.StructTree(self.ns.Resource), {'.tag': 'symlink', 'name': 'n'}),
+            (self.sv.StructTree(self.ns.ResourceLax), {'.tag': 'symlink', 'name': 'n'}),
+            (self.sv.List(self.sv.Struct(self.ns.S)), [{'f': 'a'}, {'f': 'b'}]),
+            (self.sv.List(self.sv.Struct(self.ns.S)), [{'f': 'a'}, {'g': 'b'}]),
+            (self.sv.Union(self.ns.V), 't0'),
+            (self.sv.Union(self.ns.V), 't1'),
+            (self.sv.Union(self.ns.V), {'.tag': 't2'}),
+            (self.sv.Union(self.ns.V), {'.tag': 't3', 'f': 'a'}),
+            (self.sv.Union(self.ns.V), {'.tag': 't4'}),
+            (self.sv.Union(self.ns.V), {'.tag': 't5', 't5': 't0'}),
+            (self.sv.Union(self.ns.V), {'.tag': 't7', 'name': 'n', '.tag.x': 1}),
+            (self.sv.Union(self.ns.V), {'.tag': 't10', 't10': ['t0', 't2']}),
+            (self.sv.Union(self.ns.V), {'.tag': 't11', 't11': {'a': 1}}),
+            (self.sv.Union(self.ns.V), {'.tag': 'unknown'}),
+            (self.sv.Union(self.ns.V), 'unknown'),
+            (self.sv.Union(self.ns.V), {'t6': None}),
+            (self.sv.Union(self.ns.V), {'t9': ['a']}),
+            (self.sv.Union(self.ns.U), {'.tag': 't0', 'x': 1}),
+        ]
+        for strict in (True, False):
+            for old_style in (False, True):
+                for data_type, obj in values:
+                    self.assert_same_decoding(data_type, obj, strict=strict, old_style=old_style)
+
+        # Plans are compiled once per validator and set of options
+        decoder = self.ss.PythonPrimitiveToStoneDecoder(None, None, False, False, True)
+        validator = self.sv.List(self.sv.Struct(self.ns.S))
+        plan = decoder.get_decode_plan(validator)
+        decoder2 = self.ss.PythonPrimitiveToStoneDecoder(None, None, False, False, True)
+        self.assertIs(plan, decoder2.get_decode_plan(validator))
+        decoder3 = self.ss.PythonPrimitiveToStoneDecoder(None, None, False, False, False)
+        self.assertIsNot(plan, decoder3.get_decode_plan(validator))
+
+
+class TestSpecializedGeneratedPython(TestGeneratedPython):
+    """
+    Runs the TestGeneratedPython tests against code generated with
+    --specialize-serializers.
+    """
+
+    module_names = ('ns', 'ns2', 'stone_base', 'stone_serializers', 'stone_validators')
+
+    def setUp(self):
+        p = subprocess.Popen(
+            [sys.executable,
+             '-m',
+             'stone.cli',
+             'python_types',
+             'output_specialized',
+             '-',
+             '--',
+             '--specialize-serializers',
+             '--hashable-structs'],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, stderr = p.communicate(
+            input=(test_spec + test_ns2_spec).encode('utf-8'))
+        if p.wait() != 0:
+            raise AssertionError('Could not execute stone tool: %s' %
+                                 stderr.decode('utf-8'))
+
+        # Import the generated modules under their usual names, restoring the
+        # modules of the other test cases afterwards.
+        self.saved_modules = {}
+        for name in self.module_names:
+            if name in sys.modules:
+                self.saved_modules[name] = sys.modules.pop(name)
+        sys.path.insert(0, 'output_specialized')
+        self.ns2 = __import__('ns2')
+        self.ns = __import__('ns')
+        self.sv = __import__('stone_validators')
+        self.ss = __import__('stone_serializers')
+        self.encode = self.ss.json_encode
+        self.compat_obj_encode = self.ss.json_compat_obj_encode
+        self.decode = self.ss.json_decode
+        self.compat_obj_decode = self.ss.json_compat_obj_decode
+
+    def tearDown(self):
+        sys.path.remove('output_specialized')
+        for name in self.module_names:
+            sys.modules.pop(name, None)
+        sys.modules.update(self.saved_modules)
+        shutil.rmtree('output_specialized')
+
+    def test_struct_hashing(self):
+        # Generated with --hashable-structs
+        a = self.ns.A(a='x', b=1)
+        self.assertEqual(hash(a), hash(self.ns.A(a='x', b=1)))
+        self.assertEqual(len({a, self.ns.A(a='x', b=1), self.ns.A(a='y', b=1)}), 2)
+
+        # The cached hash is dropped when a field changes
+        h = hash(a)
+        a.a = 'y'
+        self.assertEqual(hash(a), hash(self.ns.A(a='y', b=1)))
+        del a.b
+        self.assertEqual(hash(a), hash(self.ns.A(a='y')))
+        a.a = 'x'
+        a.b = 1
+        self.assertEqual(hash(a), h)
+
+        # List and map fields don't contribute to the hash
+        d = self.ns.D(a='x', d=[1], e={})
+        self.assertEqual(hash(d), hash(self.ns.D(a='x', d=[1], e={})))
+        self.assertIn(self.ns.D(a='x', d=[1], e={}), {d: 1})
+
+    def test_specialized_codecs(self):
+        self.assertIn('_stone_encode', self.ns.D.__dict__)
+        self.assertIn('_stone_decode', self.ns.V.__dict__)
+
+        d = self.ns.D(a='A', b=1, d=[1, None], e={'k': 'v', 'n': None})
+        e = self.ns.E(c=None)
+        self.assertEqual(
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d),
+            {'a': 'A', 'b': 1, 'd': [1, None], 'e': {'k': 'v', 'n': None}})
+        self.assertEqual(
+            self.compat_obj_encode(self.sv.Struct(self.ns.E), e), {})
+        self.assertEqual(
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d, use_plans=True),
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d))
+
+        # When redacting, the generated methods are only bypassed for classes
+        # whose values can contain redacted fields.
+        self.assertEqual(
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d, should_redact=True),
+            self.compat_obj_encode(self.sv.Struct(self.ns.D), d))
+        serializer = self.ss.StoneToPythonPrimitiveSerializer(
+            None, None, for_msgpack=False, old_style=False, should_redact=True)
+        self.assertFalse(self.ns.D._has_redactions)
+        self.assertTrue(serializer._is_specialized(self.ns.D))
+        self.assertTrue(self.ns.Contact._has_redactions)
+        self.assertTrue(self.ns.ContactList._has_redactions)
+        self.assertFalse(serializer._is_specialized(self.ns.ContactList))
+        contacts = self.ns.ContactList.contacts([self.ns.Contact(email='jane@example.com')])
+        for use_plans in (False, True):
+            self.assertEqual(
+                self.compat_obj_encode(self.sv.Union(self.ns.ContactList), contacts,
+                                       should_redact=True, use_plans=use_plans),
+                {'.tag': 'contacts', 'contacts': [{'email': 'j***@example.com'}]})
+
+        v = self.compat_obj_decode(
+            self.sv.Union(self.ns.V), {'.tag': 't5', 't5': 't0'})
+        self.assertEqual(v, self.ns.V.t5(self.ns.U.t0))
+        self.assertIsNone(self.compat_obj_decode(
+            self.sv.Union(self.ns.V), {'.tag': 't6'}).get_t6())
+        # Tags unknown to the class still go through the generic decoder.
+        with self.assertRaises(self.sv.ValidationError) as cm:
+            self.compat_obj_decode(self.sv.Union(self.ns.V), {'.tag': 'zzz'})
+        self.assertEqual("unknown tag 'zzz'", str(cm.exception))
+
+
+class TestFrozenGeneratedPython(unittest.TestCase):
+    """
+    Tests code generated with --frozen-types.
+    """
+
+    module_names = TestSpecializedGeneratedPython.module_names
+
+    def setUp(self):
+        p = subprocess.Popen(
+            [sys.executable,
+             '-m',
+             'stone.cli',
+             'python_types',
+             'output_frozen',
+             '-',
+             '--',
+             '--frozen-types'],
+            stdin=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        _, stderr = p.communicate(
+            input=(test_spec + test_ns2_spec).encode('utf-8'))
+        if p.wait() != 0:
+            raise AssertionError('Could not execute stone tool: %s' %
+                                 stderr.decode('utf-8'))
+
+        self.saved_modules = {}
+        for name in self.module_names:
+            if name in sys.modules:
+                self.saved_modules[name] = sys.modules.pop(name)
+        sys.path.insert(0, 'output_frozen')
+        self.ns2 = __import__('ns2')
+        self.ns = __import__('ns')
+        self.sv = __import__('stone_validators')
+        self.ss = __import__('stone_serializers')
+
+    def tearDown(self):
+        sys.path.remove('output_frozen')
+        for name in self.module_names:
+            sys.modules.pop(name, None)
+        sys.modules.update(self.saved_modules)
+        shutil.rmtree('output_frozen')
+
+    def test_frozen_structs(self):
+        c = self.ns.C(a='x', b=1, c=b'y', d=1.5)
+        self.assertEqual(c.a, 'x')
+        self.assertEqual(c.d, 1.5)
+        with self.assertRaises(AttributeError) as cm:
+            c.a = 'z'
+        self.assertEqual('cannot modify frozen C', str(cm.exception))
+        with self.assertRaises(AttributeError):
+            c.d = 2.5
+        with self.assertRaises(AttributeError):
+            del c.b
+        self.assertEqual(c.a, 'x')
+
+        # Frozen structs are hashable
+        self.assertEqual(hash(c), hash(self.ns.C(a='x', b=1, c=b'y', d=1.5)))
+        self.assertIn(self.ns.C(a='x', b=1, c=b'y', d=1.5), {c})
+
+        # Decoded structs are frozen as well
+        validator = self.sv.Struct(self.ns.C)
+        for use_plans in (False, True):
+            decoded = self.ss.json_compat_obj_decode(
+                validator, {'a': 'x', 'b': 1, 'c': 'eQ==', 'd': 1.5},
+                use_plans=use_plans)
+            self.assertEqual(decoded, c)
+            with self.assertRaises(AttributeError):
+                decoded.a = 'z'
+
+    def test_frozen_containers(self):
+        validator = self.sv.Struct(self.ns.D)
+        d = self.ns.D(a='x', d=[1], e={'k': 'v'})
+        encoded = self.ss.json_encode(validator, d)
+        with self.assertRaises(TypeError) as cm:
+            d.d.append(2)
+        self.assertEqual('cannot modify frozen list', str(cm.exception))
+        with self.assertRaises(TypeError):
+            d.d += [2]
+        with self.assertRaises(TypeError) as cm:
+            d.e['k'] = 'w'
+        self.assertEqual('cannot modify frozen map', str(cm.exception))
+        self.assertEqual(d.d, [1])
+        self.assertEqual(self.ss.json_encode(validator, d), encoded)
+        self.assertEqual(hash(d), hash(self.ns.D(a='x', d=[1], e={'k': 'v'})))
+
+        # Lists and maps are frozen whichever way the struct is created
+        obj = {'a': 'x', 'd': [1], 'e': {'k': 'v'}}
+        for kwargs in ({}, {'use_plans': True}, {'trusted': True}, {'lazy': True}):
+            decoded = self.ss.json_compat_obj_decode(validator, obj, **kwargs)
+            self.assertIsInstance(decoded.d, self.sv.FrozenList)
+            self.assertIsInstance(decoded.e, self.sv.FrozenDict)
+        copied = copy.deepcopy(d)
+        self.assertEqual(copied, d)
+        with self.assertRaises(TypeError):
+            copied.d.append(2)
+
+        # and so are the values of unions, including nested ones
+        v = self.ns.V.t9(['x'])
+        with self.assertRaises(TypeError):
+            v.get_t9().append('y')
+        v = self.ss.json_compat_obj_decode(
+            self.sv.Union(self.ns.V), {'.tag': 't9', 't9': ['x']}, trusted=True)
+        self.assertIsInstance(v.get_t9(), self.sv.FrozenList)
+        nested = self.sv.freeze(self.sv.List(self.sv.Map(self.sv.String(), self.sv.Int32())),
+                                [{'k': 1}])
+        with self.assertRaises(TypeError):
+            nested[0]['k'] = 2
+
+    def test_frozen_lazy_decoding(self):
+        c = self.ss.json_compat_obj_decode(
+            self.sv.Struct(self.ns.C), {'a': 'x', 'b': 1, 'c': 'eQ==', 'd': 1.5}, lazy=True)
+        loaded = []
+        decoder = c._lazy_fields.decoder
+
+        class CheckingDecoder(object):
+            _get_setter_validate = decoder._get_setter_validate
+
+            def json_compat_obj_decode_helper(self, data_type, obj):
+                # The instance stays frozen while its fields are decoded
+                loaded.append(c._frozen)
+                return decoder.json_compat_obj_decode_helper(data_type, obj)
+
+        c._lazy_fields.decoder = CheckingDecoder()
+        self.assertEqual(c.d, 1.5)
+        self.assertEqual(c, self.ns.C(a='x', b=1, c=b'y', d=1.5))
+        self.assertEqual(loaded, [True] * 4)
+        with self.assertRaises(AttributeError):
+            c.d = 2.5
+
+    @unittest.skipIf(bv.np is None, 'NumPy is not installed')
+    def test_frozen_arrays(self):
+        np = bv.np
+        counts = np.array([3, 0, 7], dtype=np.int64)
+        h = self.ns.Histogram(counts=counts, bounds=[0.5])
+        validator = self.sv.Struct(self.ns.Histogram)
+        encoded = self.ss.json_encode(validator, h)
+        h_hash = hash(h)
+        with self.assertRaises(ValueError):
+            h.counts[0] = 4
+        # The array is copied, so changing the original doesn't affect it
+        counts[0] = 4
+        self.assertEqual(h.counts.tolist(), [3, 0, 7])
+        self.assertEqual(self.ss.json_encode(validator, h), encoded)
+        self.assertEqual(hash(h), h_hash)
+        # Read-only arrays are copied too unless their memory can't be written
+        counts.flags.writeable = False
+        self.assertIsNot(self.ns.Histogram(counts=counts, bounds=[0.5]).counts, counts)
+        counts = np.frombuffer(b'\x01\x00\x00\x00', dtype='<u4')
+        self.assertIs(self.ns.Histogram(counts=counts, bounds=[0.5]).counts, counts)
+
+    def test_patches(self):
+        d = self.ns.D(a='x', d=[1, None], e={'k': 'v'})
+        validator = self.sv.Struct(self.ns.D)
+        self.assertEqual(self.ss.json_compat_obj_encode(validator, d)['a'], 'x')
+        patched = self.ss.apply_patch(validator, d, [('replace', ('a',), 'y')])
+        self.assertEqual(patched.a, 'y')
+        self.assertEqual(d.a, 'x')
+        self.assertEqual(self.ss.json_compat_obj_encode(validator, patched)['a'], 'y')
+        with self.assertRaises(AttributeError):
+            patched.a = 'z'
+
+    def test_memoized_encodings(self):
+        d = self.ns.D(a='x', d=[1, None], e={'k': 'v'})
+        validator = self.sv.Struct(self.ns.D)
+        for use_plans in (False, True):
+            encoded = self.ss.json_compat_obj_encode(validator, d, use_plans=use_plans)
+            self.assertEqual(encoded, {'a': 'x', 'd': [1, None], 'e': {'k': 'v'}})
+            self.assertIsNotNone(d._cached_encoding)
+            # Callers get a copy of the memoized encoding, which they can modify
+            encoded['a'] = 'y'
+            encoded['d'].append(2)
+            self.assertEqual(
+                self.ss.json_compat_obj_encode(validator, d, use_plans=use_plans),
+                {'a': 'x', 'd': [1, None], 'e': {'k': 'v'}})
+            self.assertEqual(self.ss.json_encode(validator, d, use_plans=use_plans),
+                             json.dumps({'a': 'x', 'd': [1, None], 'e': {'k': 'v'}}))
+        listing = self.ns.Listing(entries=[d], resources=[], cursor='c')
+        encoded = self.ss.json_compat_obj_encode(self.sv.Struct(self.ns.Listing), listing)
+        encoded['entries'][0]['a'] = 'y'
+        self.assertEqual(self.ss.json_compat_obj_encode(validator, d)['a'], 'x')
+
+        # Encodings depend on the serializer's options
+        self.assertEqual(
+            self.ss.json_compat_obj_encode(self.sv.Struct(self.ns.A), self.ns.A(a='x', b=True)),
+            {'a': 'x', 'b': 1})
+        c = self.ns.C(a='x', b=1, c=b'y', d=1.5)
+        self.assertEqual(
+            self.ss.json_compat_obj_encode(self.sv.Struct(self.ns.C), c)['c'], 'eQ==')
+        self.assertEqual(
+            self.ss.json_compat_obj_encode(self.sv.Struct(self.ns.C), c, for_msgpack=True)['c'],
+            b'y')
+        # and on the type a struct is encoded as
+        self.assertEqual(
+            self.ss.json_compat_obj_encode(self.sv.Struct(self.ns.A), c), {'a': 'x', 'b': 1})
+        self.assertEqual(self.ss.json_encode(self.sv.Struct(self.ns.C), c),
+                         json.dumps({'a': 'x', 'b': 1, 'c': 'eQ==', 'd': 1.5}))
+
+        # Unions memoize their encoding and hash too
+        u = self.ns.U.t1('x')
+        encoded = self.ss.json_compat_obj_encode(self.sv.Union(self.ns.U), u)
+        self.assertEqual(encoded, {'.tag': 't1', 't1': 'x'})
+        self.assertIsNotNone(u._cached_encoding)
+        self.assertEqual(self.ss.json_compat_obj_encode(self.sv.Union(self.ns.U), u), encoded)
+        self.assertEqual(
+            self.ss.json_compat_obj_encode(self.sv.Union(self.ns.U), u, old_style=True),
+            {'t1': 'x'})
+        self.assertEqual(hash(u), hash(self.ns.U.t1('x')))
+
+    def test_union_hashes(self):
+        # List and map values are left out of the hash, like with structs
+        for v in (self.ns.V.t9(['a']), self.ns.V.t11({'k': 1}),
+                  self.ns.V.t10([self.ns.U.t0])):
+            self.assertEqual(hash(v), hash(copy.copy(v)))
+            self.assertIn(v, {v})
+        self.assertNotEqual(self.ns.V.t9(['a']), self.ns.V.t9(['b']))
+        self.assertEqual(len({self.ns.V.t9(['a']), self.ns.V.t9(['b'])}), 2)
+        # including when they're fields of structs
+        h = self.ns.VHolder(v=self.ns.V.t9(['a']))
+        self.assertEqual(hash(h), hash(self.ns.VHolder(v=self.ns.V.t9(['a']))))
+
 # Adapted from:
 # http://code.activestate.com/recipes/306860-proleptic-gregorian-dates-and-strftime-before-1900/
 # Make sure that the day names are in order from 0001/01/01 until
@@ -3313,6 +4814,139 @@ class TestAnnotationsGeneratedPython(unittest.TestCase):
             self.compat_obj_encode(self.sv.Union(self.ns3.U), ui,
                 caller_permissions=self.internal_and_alpha_cp, should_redact=True), json_data)
 
+    def test_decoding_with_plans(self):
+        values = [
+            (self.sv.Struct(self.ns3.A), {
+                'a': 'A', 'b': 1, 'c': 'C', 'd': [{'a': 'A', 'b': 'B'}],
+                'e': {}, 'f': {'a': 'A', 'b': 'B'}, 'g': 4,
+            }),
+            (self.sv.Struct(self.ns3.A), {'a': 'A', 'g': 4}),
+            (self.sv.StructTree(self.ns3.Resource), {
+                '.tag': 'file', 'name': 'N', 'size': 1, 'x': {'a': 'A', 'b': 'B'}, 'y': 'Y',
+            }),
+            (self.sv.Union(self.ns3.U), {'.tag': 't1', 't1': 'x'}),
+            (self.sv.Union(self.ns3.U), {'.tag': 't2', 't2': [{'a': 'A', 'b': 'B'}]}),
+            (self.sv.Union(self.ns3.UOpen), {'.tag': 't6', 't6': 'x'}),
+            (self.sv.Union(self.ns3.UOpen), 't_void'),
+        ]
+        for cp in (self.default_cp, self.internal_cp, self.alpha_cp, self.internal_and_alpha_cp):
+            for strict in (True, False):
+                for data_type, obj in values:
+                    kwargs = dict(caller_permissions=cp, strict=strict)
+                    try:
+                        expected = self.compat_obj_decode(data_type, obj, **kwargs)
+                    except self.sv.ValidationError as e:
+                        with self.assertRaises(self.sv.ValidationError) as cm:
+                            self.compat_obj_decode(data_type, obj, use_plans=True, **kwargs)
+                        self.assertEqual(str(e), str(cm.exception))
+                    else:
+                        self.assertEqual(
+                            repr(self.compat_obj_decode(data_type, obj, use_plans=True,
+                                                        **kwargs)),
+                            repr(expected))
+
+    def test_encoding_with_plans(self):
+        ai = self.ns3.A(
+            a='A', b=1, c='C', d=[self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST')],
+            e={'e1': 'e2'}, f=self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST'), g=4)
+        fi = self.ns3.File(name='N', size=1, x=self.ns3.X(a='A', b='B'), y='Y-hash-Y')
+        values = [
+            (self.sv.Struct(self.ns3.A), ai),
+            (self.sv.StructTree(self.ns3.Resource), fi),
+            (self.sv.Union(self.ns3.U), self.ns3.U.t1('t1-hash-t1')),
+            (self.sv.Union(self.ns3.UOpen), self.ns3.UOpen.t5('t5')),
+            (self.sv.Union(self.ns3.U2), self.ns3.U2.t2({'key': 'test_str'})),
+        ]
+        for cp in (self.default_cp, self.internal_cp, self.alpha_cp, self.internal_and_alpha_cp):
+            for should_redact in (False, True):
+                for data_type, value in values:
+                    try:
+                        expected = self.compat_obj_encode(
+                            data_type, value, caller_permissions=cp,
+                            should_redact=should_redact)
+                    except self.sv.ValidationError as e:
+                        with self.assertRaises(self.sv.ValidationError) as cm:
+                            self.compat_obj_encode(
+                                data_type, value, caller_permissions=cp,
+                                should_redact=should_redact, use_plans=True)
+                        self.assertEqual(str(e), str(cm.exception))
+                    else:
+                        self.assertEqual(
+                            self.compat_obj_encode(
+                                data_type, value, caller_permissions=cp,
+                                should_redact=should_redact, use_plans=True),
+                            expected)
+
+    def test_permissions_views(self):
+        view = self.sv.get_permissions_view(self.ns3.B, ('internal', 'alpha'))
+        self.assertIs(view, self.sv.get_permissions_view(self.ns3.B, ('internal', 'alpha')))
+        self.assertEqual(
+            [name for name, _ in view.all_fields],
+            [name for name, _ in self.ns3.B._all_fields_ + self.ns3.B._all_internal_fields_ +
+             self.ns3.B._all_alpha_fields_])
+        self.assertEqual(
+            view.all_field_names,
+            self.ns3.B._all_field_names_ | self.ns3.B._all_internal_field_names_ |
+            self.ns3.B._all_alpha_field_names_)
+        self.assertEqual(
+            set(view.extra_field_names),
+            self.ns3.B._all_internal_field_names_ | self.ns3.B._all_alpha_field_names_)
+        self.assertEqual(self.sv.get_permissions_view(self.ns3.B, ()).extra_field_names, ())
+
+        view = self.sv.get_permissions_view(self.ns3.UOpen, ('alpha',))
+        self.assertEqual(set(view.tagmap), {'t0', 't2', 't3', 't4', 't6', 'other'})
+        self.assertTrue(self.ns3.UOpen._is_tag_present('t6', self.alpha_cp))
+        self.assertFalse(self.ns3.UOpen._is_tag_present('t6', self.internal_cp))
+        self.assertFalse(self.ns3.UOpen._is_tag_present('t6', self.default_cp))
+        self.assertIs(self.ns3.UOpen._get_val_data_type('t5', self.internal_and_alpha_cp),
+                      self.ns3.UOpen._internal_tagmap['t5'])
+        self.assertIs(self.ns3.UOpen._get_val_data_type('t0', self.alpha_cp),
+                      self.ns3.UOpen._tagmap['t0'])
+        with self.assertRaises(KeyError):
+            self.ns3.UOpen._get_val_data_type('t5', self.alpha_cp)
+
+        table = self.ns3.UOpen._tag_table
+        all_tags = set(self.ns3.UOpen._tagmap)
+        for permission in self.ns3.UOpen._permissioned_tagmaps:
+            all_tags.update(getattr(self.ns3.UOpen, '_{}_tagmap'.format(permission)))
+        self.assertEqual(set(table), all_tags)
+        self.assertEqual(table['t0'], (self.ns3.UOpen._tagmap['t0'], self.ns3.bb._TAG_VOID, None))
+        self.assertEqual(table['t5'][2], 'internal')
+        self.assertEqual(table['t6'][2], 'alpha')
+        self.assertEqual(self.ns3.UOpen('t6', 'x').get_t6(), 'x')
+
+    def test_encoding_to_sink(self):
+        ai = self.ns3.A(
+            a='A', b=1, c='C', d=[self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST')],
+            e={'e1': 'e2'}, f=self.ns3.X(a='TEST-blot-TEST', b='TEST-hash-TEST'), g=4)
+        fi = self.ns3.File(name='N', size=1, x=self.ns3.X(a='A', b='B'), y='Y-hash-Y')
+        values = [
+            (self.sv.Struct(self.ns3.A), ai),
+            (self.sv.StructTree(self.ns3.Resource), fi),
+            (self.sv.Union(self.ns3.U), self.ns3.U.t1('t1-hash-t1')),
+            (self.sv.Union(self.ns3.UOpen), self.ns3.UOpen.t5('t5')),
+            (self.sv.Union(self.ns3.U2), self.ns3.U2.t2({'key': 'test_str'})),
+        ]
+        for cp in (self.default_cp, self.internal_cp, self.alpha_cp, self.internal_and_alpha_cp):
+            for should_redact in (False, True):
+                for data_type, value in values:
+                    sink = bytearray()
+                    try:
+                        expected = self.encode(
+                            data_type, value, caller_permissions=cp,
+                            should_redact=should_redact)
+                    except self.sv.ValidationError as e:
+                        with self.assertRaises(self.sv.ValidationError) as cm:
+                            self.ss.json_encode_to(
+                                data_type, value, sink, caller_permissions=cp,
+                                should_redact=should_redact)
+                        self.assertEqual(str(e), str(cm.exception))
+                    else:
+                        self.ss.json_encode_to(
+                            data_type, value, sink, caller_permissions=cp,
+                            should_redact=should_redact)
+                        self.assertEqual(sink.decode('utf-8'), expected)
+
 
 if __name__ == '__main__':
     unittest.main()